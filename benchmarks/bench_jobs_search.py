@@ -0,0 +1,64 @@
+'''
+Compares the job search index with a linear fnmatch scan, as done by `find` before it, on a catalog of
+generated job names.
+
+    python benchmarks/bench_jobs_search.py [jobs_count]
+'''
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import fnmatch
+import random
+import sys
+import timeit
+
+from skype_bot.jobs_index import JobsIndex
+
+
+PROJECTS = ['rocky', 'alfasim', 'ben10', 'esss', 'souring', 'kraken', 'eden', 'mars', 'coilib', 'sci20']
+BRANCHES = ['master', 'fb-{}', 'rb-{}.{}', 'hotfix-{}']
+PLATFORMS = ['win64', 'win32', 'linux64', 'centos7', 'osx']
+KINDS = ['', '-docs', '-perf', '-nightly', '-deploy']
+
+
+def generate_jobs(count, seed=0):
+    rand = random.Random(seed)
+    jobs = set()
+    while len(jobs) < count:
+        branch = rand.choice(BRANCHES).format(rand.randint(1, 3000), rand.randint(0, 9))
+        jobs.add('{}{}-{}-{}{}'.format(
+            rand.choice(PROJECTS), rand.randint(10, 60), branch, rand.choice(PLATFORMS), rand.choice(KINDS)))
+    return sorted(jobs)
+
+
+def linear_scan(jobs, pattern):
+    return [job_name for job_name in jobs if fnmatch.fnmatch(job_name, pattern)]
+
+
+def main(jobs_count=50000, repeat=20):
+    jobs = generate_jobs(jobs_count)
+
+    build_time = timeit.timeit(lambda: JobsIndex(jobs), number=1)
+    index = JobsIndex(jobs)
+    print('{} jobs, index built in {:.2f}s'.format(len(jobs), build_time))
+    print('{:<40} {:>8} {:>12} {:>12}'.format('query', 'matches', 'linear (ms)', 'index (ms)'))
+
+    queries = [
+        ('rocky30*', True),
+        ('rocky30*fb-12*linux64', True),
+        ('*-nightly', True),
+        ('*fb-1234*', True),
+        ('alfasim42-master-win64', False),
+        ('fb-1234', False),
+        ('alfsaim42-mastre-win64', False),
+    ]
+    for query, is_glob in queries:
+        # the linear scan only supports globs: substring queries are wrapped in wildcards
+        linear_pattern = query if is_glob else '*{}*'.format(query)
+        linear_time = timeit.timeit(lambda: linear_scan(jobs, linear_pattern), number=repeat) / repeat
+        index_time = timeit.timeit(lambda: index.search(query), number=repeat) / repeat
+        print('{:<40} {:>8} {:>12.2f} {:>12.2f}'.format(
+            query, len(index.search(query)), linear_time * 1000, index_time * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
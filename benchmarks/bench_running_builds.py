@@ -0,0 +1,101 @@
+'''
+Compares the running builds query on the computers executors with the scan of the last build of every
+job, as done by `status` before it, on a simulated Jenkins instance.
+
+The Jenkins responses are generated and served by a mocked session: the timings cover the download size
+(reported) and the parsing of the responses, not the time Jenkins takes to build them.
+
+    python benchmarks/bench_running_builds.py [jobs_count] [running_count]
+'''
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import random
+import sys
+import timeit
+
+import mock
+
+from skype_bot import jenkins_jobs
+
+jenkins_config = {'url' : 'http://jenkins/', 'user' : 'user', 'token' : 'token'}
+
+NODES_COUNT = 20
+EXECUTORS_COUNT = 4
+
+
+def generate_build(job_name, number, building, node):
+    return {
+        '_class' : 'hudson.model.FreeStyleBuild',
+        'url' : 'http://jenkins/job/{}/{}/'.format(job_name, number),
+        'building' : building,
+        'number' : number,
+        'duration' : 0 if building else 123456,
+        'builtOn' : node,
+        'timestamp' : 1500000000000 + number,
+        'result' : None if building else 'SUCCESS',
+        'estimatedDuration' : 123456,
+        'actions' : [
+            {'_class' : 'hudson.model.CauseAction', 'causes' : [{
+                '_class' : 'hudson.model.Cause$UserIdCause',
+                'shortDescription' : 'Started by user User',
+                'userId' : 'user_{}'.format(number % 50),
+                'userName' : 'User',
+            }]},
+            {}, {}, {},
+        ],
+    }
+
+
+def generate_instance(jobs_count, running_count, seed=0):
+    '''
+    :return: (jobs response, computers response)
+    '''
+    rand = random.Random(seed)
+    running_jobs = set(rand.sample(range(jobs_count), running_count))
+
+    jobs = []
+    executors = dict(('node_{}'.format(i), []) for i in range(NODES_COUNT))
+    for i in range(jobs_count):
+        job_name = 'project_{}-linux64'.format(i)
+        node = 'node_{}'.format(rand.randrange(NODES_COUNT))
+        build = generate_build(job_name, rand.randint(1, 2000), i in running_jobs, node)
+        jobs.append({'_class' : 'hudson.model.FreeStyleProject', 'fullName' : job_name, 'lastBuild' : build})
+        if build['building']:
+            executors[node].append({'currentExecutable' : build})
+
+    computers = []
+    for node, node_executors in sorted(executors.items()):
+        node_executors += [{'currentExecutable' : None}] * max(EXECUTORS_COUNT - len(node_executors), 0)
+        computers.append({'displayName' : node, 'executors' : node_executors, 'oneOffExecutors' : []})
+
+    return json.dumps({'jobs' : jobs}), json.dumps({'computer' : computers})
+
+
+def serve(jobs_response, computers_response):
+    def request(method, url, **kwargs):
+        text = computers_response if '/computer/' in url else jobs_response
+        return mock.Mock(status_code=200, text=text)
+    return mock.patch('requests.Session.request', side_effect=request)
+
+
+def main(jobs_count=20000, running_count=40, repeat=10):
+    jobs_response, computers_response = generate_instance(jobs_count, running_count)
+
+    with serve(jobs_response, computers_response):
+        scanned_jobs = jenkins_jobs.scan_building_jobs(jenkins_config)
+        running_jobs = jenkins_jobs.get_running_builds(jenkins_config)
+        assert sorted((name, build['number']) for name, build in scanned_jobs.items()) == \
+            sorted((name, build['number']) for name, build in running_jobs.items())
+
+        scan_time = timeit.timeit(lambda: jenkins_jobs.scan_building_jobs(jenkins_config), number=repeat) / repeat
+        executors_time = timeit.timeit(lambda: jenkins_jobs.get_running_builds(jenkins_config), number=repeat) / repeat
+
+    print('{} jobs, {} running'.format(jobs_count, running_count))
+    print('{:<20} {:>14} {:>10}'.format('query', 'response (KB)', 'time (ms)'))
+    print('{:<20} {:>14.1f} {:>10.2f}'.format('jobs scan', len(jobs_response) / 1024, scan_time * 1000))
+    print('{:<20} {:>14.1f} {:>10.2f}'.format('executors', len(computers_response) / 1024, executors_time * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
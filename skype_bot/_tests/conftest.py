@@ -0,0 +1,15 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import pytest
+
+from skype_bot import jenkins_jobs
+
+
+@pytest.fixture(autouse=True)
+def clear_jenkins_clients():
+    '''
+    Jenkins clients keep their circuit breaker state: each test starts with new ones.
+    '''
+    jenkins_jobs._clients.clear()
+    yield
+    jenkins_jobs._clients.clear()
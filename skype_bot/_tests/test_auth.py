@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import time
+
+import jwt
+import mock
+import OpenSSL.crypto
+import pytest
+
+from skype_bot.auth import Auth
+
+
+def _make_certificate():
+    key = OpenSSL.crypto.PKey()
+    key.generate_key(OpenSSL.crypto.TYPE_RSA, 2048)
+
+    cert = OpenSSL.crypto.X509()
+    cert.get_subject().CN = 'skype_bot'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, str('sha256'))
+
+    der_cert = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_ASN1, cert)
+    pem_key = OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, key)
+    return base64.b64encode(der_cert).decode('ascii'), pem_key
+
+
+def _make_token(pem_key, kid, exp):
+    # Auth._get_headers expects a header that decodes without extra padding
+    token = jwt.encode({'exp' : exp}, pem_key, algorithm='RS256', headers={'kid' : kid}).decode('ascii')
+    assert len(token.split('.')[0]) % 4 == 0
+    return token
+
+
+@pytest.fixture
+def signing_key():
+    return _make_certificate()
+
+
+@pytest.fixture
+def auth(signing_key):
+    b64_cert, _pem_key = signing_key
+
+    token_response = mock.Mock(status_code=200, content='{"access_token" : "bearer", "expires_in" : 3600}')
+    keys_response = mock.Mock()
+    keys_response.json.return_value = {'keys' : [{'kid' : 'key_01', 'x5c' : [b64_cert]}]}
+
+    session = mock.Mock()
+    session.post.return_value = token_response
+    session.get.return_value = keys_response
+    return Auth('bot_app_id', 'bot_password', start_refresher=False, session=session)
+
+
+def test_verify_request_uses_parsed_keys(auth, signing_key):
+    _b64_cert, pem_key = signing_key
+    token = _make_token(pem_key, 'key_01', int(time.time()) + 600)
+
+    assert list(auth.public_keys.keys()) == ['key_01']
+
+    with mock.patch('OpenSSL.crypto.load_certificate') as load_certificate:
+        assert auth.verify_request('Bearer ' + token)
+        assert auth.verify_request('Bearer ' + token)
+        assert load_certificate.call_count == 0
+
+    with pytest.raises(Exception):
+        auth.verify_request('Bearer ' + _make_token(pem_key, 'key_02', int(time.time()) + 600))
+
+
+def test_verified_tokens_cache(auth, signing_key):
+    _b64_cert, pem_key = signing_key
+    token = _make_token(pem_key, 'key_01', int(time.time()) + 600)
+
+    with mock.patch('jwt.decode', wraps=jwt.decode) as decode:
+        assert auth.verify_request('Bearer ' + token)
+        assert auth.verify_request('Bearer ' + token)
+        assert auth.verify_request('Bearer ' + token)
+        assert decode.call_count == 1
+
+    stats = auth.get_verified_tokens_stats()
+    assert stats['size'] == 1
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+    # expired tokens are verified again (and rejected)
+    expired_token = _make_token(pem_key, 'key_01', int(time.time()) - 600)
+    assert not auth.verify_request('Bearer ' + expired_token)
+    assert auth.get_verified_tokens_stats()['size'] == 1
+
+
+def test_bearer_token_refresh(auth):
+    # expires_in returned by the token endpoint is used
+    assert auth.bearer_token_exp_time - time.time() == pytest.approx(3600, abs=5)
+
+    session = auth.session
+    session.post.reset_mock()
+    session.post.return_value = mock.Mock(status_code=200, content='{"access_token" : "new_bearer", "expires_in" : 7200}')
+
+    # token about to expire while a refresh is in progress: current token is returned
+    auth.bearer_token_exp_time = time.time() + 60
+    with auth._refresh_lock:
+        with mock.patch('threading.Thread') as thread_mock:
+            assert auth.get_bearer_token() == 'bearer'
+            assert thread_mock.call_count == 0
+
+    # otherwise it is renewed in background
+    assert auth.get_bearer_token() == 'bearer'
+    with auth._refresh_lock:
+        assert auth.bearer_token == 'new_bearer'
+    assert session.post.call_count == 1
+    assert auth.bearer_token_exp_time - time.time() == pytest.approx(7200, abs=5)
+
+    # expired token is requested on the spot
+    auth.bearer_token = None
+    assert auth.get_bearer_token() == 'new_bearer'
+    assert session.post.call_count == 2
+
+    # server keys are renewed based on their own expiration
+    assert not auth._is_expiring(auth.server_keys_exp_time)
@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from skype_bot.cache import ExpiringCache
+
+
+def test_expiring_cache():
+    cache = ExpiringCache(max_size=2, ttl=60)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b' is the least recently used entry
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    cache.set('d', 4, expires_at=time.time() - 1)
+    assert cache.get('d', 'expired') == 'expired'
+
+    assert cache.get_stats() == {'size' : 1, 'max_size' : 2, 'hits' : 3, 'misses' : 2}
+
+
+def test_events_deduplicator():
+    import mongomock
+    from skype_bot.dedup import EventsDeduplicator, MongoEventsDeduplicator
+
+    build_info = {'event' : 'jenkins.job.completed', 'job_name' : 'job_a', 'number' : '1'}
+
+    deduplicator = EventsDeduplicator()
+    assert deduplicator.reserve(build_info)
+    assert not deduplicator.reserve(build_info)
+    assert deduplicator.reserve(dict(build_info, number='2'))
+    assert deduplicator.reserve(dict(build_info, event='jenkins.job.started'))
+    # events without a build number can't be identified
+    assert deduplicator.reserve({'event' : 'jenkins.job.started', 'job_name' : 'job_a'})
+    assert deduplicator.reserve({'event' : 'jenkins.job.started', 'job_name' : 'job_a'})
+
+    # released events can be handled again, committed ones can't
+    deduplicator.release(build_info)
+    assert deduplicator.reserve(build_info)
+    deduplicator.commit(build_info)
+    assert not deduplicator.reserve(build_info)
+
+    # several processes sharing the same collection
+    collection = mongomock.MongoClient().db.jenkins_events
+    deduplicator = MongoEventsDeduplicator(collection)
+    assert deduplicator.reserve(build_info)
+    assert not MongoEventsDeduplicator(collection).reserve(build_info)
+    deduplicator.release(build_info)
+    assert MongoEventsDeduplicator(collection).reserve(build_info)
+
+    # reservations of a stopped process expire
+    other_build_info = dict(build_info, number='2')
+    assert MongoEventsDeduplicator(collection, reservation_timeout=-1).reserve(other_build_info)
+    deduplicator = MongoEventsDeduplicator(collection)
+    assert deduplicator.reserve(other_build_info)
+    deduplicator.commit(other_build_info)
+    assert not MongoEventsDeduplicator(collection, reservation_timeout=-1).reserve(other_build_info)
+
+
+def test_session_store():
+    import mongomock
+    from skype_bot.sessions import MongoSessionStore, SessionStore, encode_jobs
+
+    jobs = ['project_{}_linux64'.format(i) for i in range(1000)]
+    assert len(encode_jobs(jobs)) < len(''.join(jobs)) / 4
+
+    store = SessionStore(max_bytes=len(encode_jobs(jobs)) + 10)
+    store.set_jobs('skype_1', 'jobs_list', jobs)
+    assert store.get_jobs('skype_1', 'jobs_list') == jobs
+    assert store.get_jobs('skype_2', 'jobs_list') is None
+
+    # over the memory budget, the least recently used list is evicted
+    store.set_jobs('skype_2', 'jobs_list', jobs)
+    assert store.get_jobs('skype_1', 'jobs_list') is None
+    assert store.get_jobs('skype_2', 'jobs_list') == jobs
+
+    store.set_jobs('skype_2', 'jobs_list', [])
+    assert store.get_jobs('skype_2', 'jobs_list') == []
+    store.set_jobs('skype_2', 'jobs_list', None)
+    assert store.get_jobs('skype_2', 'jobs_list') is None
+    assert store.get_stats()['weight'] == 0
+
+    collection = mongomock.MongoClient().db.user_sessions
+    store = MongoSessionStore(collection, ttl=60)
+    store.set_jobs('skype_1', 'jobs_list', jobs[:2])
+    # seen from another process
+    assert MongoSessionStore(collection).get_jobs('skype_1', 'jobs_list') == jobs[:2]
+
+    store.ttl = -1
+    store.set_jobs('skype_1', 'jobs_list', jobs[:2])
+    assert store.get_jobs('skype_1', 'jobs_list') is None
@@ -0,0 +1,73 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+import pytest
+
+from skype_bot.circuit_breaker import Bulkhead, BulkheadFullError, CircuitBreaker, CircuitOpenError
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('service', failure_threshold=2, reset_timeout=60)
+
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open()
+
+    breaker.record_failure()
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # a single trial call once the reset timeout elapsed
+    breaker.opened_at -= 60
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # which opens the circuit again if it fails
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # or if its outcome is never known
+    breaker.opened_at -= 60
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.trial_started_at -= 60
+    breaker.before_call()
+    breaker.record_success()
+    assert not breaker.is_open()
+    breaker.before_call()
+
+
+def test_bulkhead():
+    bulkhead = Bulkhead('service', max_concurrent_calls=1, timeout=0.05)
+
+    with bulkhead:
+        with pytest.raises(BulkheadFullError):
+            with bulkhead:
+                pass
+    assert bulkhead.active_calls == 0
+
+    # waiting calls get the slot when released
+    bulkhead.timeout = 5
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with bulkhead:
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    entered.wait(5)
+    threading.Timer(0.05, release.set).start()
+    with bulkhead:
+        assert bulkhead.active_calls == 1
+    thread.join()
@@ -0,0 +1,269 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mock
+import mongomock
+import pytest
+
+from skype_bot.delivery import DeliveryQueue
+
+
+def test_delivery_queue():
+    send_function = mock.Mock(side_effect=[429, 503, 200])
+    render_function = mock.Mock(return_value=('conversation_id', 'message'))
+
+    delivery_queue = DeliveryQueue(send_function, workers=2, retry_delay=0.0, coalesce_window=0)
+    # retries are scheduled on timers, run them right away
+    with mock.patch.object(DeliveryQueue, '_schedule', lambda self, delay, function, *args: self._put(function, *args)):
+        delivery_queue.put(render_function, 'build_info')
+        delivery_queue.join()
+
+    render_function.assert_called_once_with('build_info')
+    assert send_function.call_args_list == [mock.call('conversation_id', 'message')] * 3
+
+
+def test_delivery_queue_drops_after_max_retries():
+    send_function = mock.Mock(return_value=500)
+
+    delivery_queue = DeliveryQueue(send_function, workers=0, max_retries=2, coalesce_window=0)
+    with mock.patch.object(DeliveryQueue, '_schedule', lambda self, delay, function, *args: function(*args)):
+        delivery_queue.deliver('conversation_id', 'message')
+
+    assert send_function.call_count == 3
+
+    # final statuses are not retried
+    send_function = mock.Mock(return_value=404)
+    delivery_queue = DeliveryQueue(send_function, workers=0, coalesce_window=0)
+    delivery_queue.deliver('conversation_id', 'message')
+    assert send_function.call_count == 1
+
+
+def test_delivery_queue_coalesce():
+    send_function = mock.Mock(return_value=200)
+    delivery_queue = DeliveryQueue(send_function, workers=0, coalesce_window=1.0, max_message_size=20)
+
+    scheduled = []
+    with mock.patch.object(DeliveryQueue, '_schedule', lambda self, *args: scheduled.append(args)):
+        delivery_queue.deliver('conversation_1', 'message 1')
+        delivery_queue.deliver('conversation_2', 'message 2')
+        delivery_queue.deliver('conversation_1', 'message 3')
+        assert send_function.call_count == 0
+
+        # exceeds max_message_size
+        delivery_queue.deliver('conversation_1', 'message 4')
+        send_function.assert_called_once_with('conversation_1', 'message 1\n\nmessage 3')
+
+    for delay, function, conversation_id, pending in scheduled:
+        assert delay == 1.0
+        function(conversation_id, pending)
+
+    assert send_function.call_args_list == [
+        mock.call('conversation_1', 'message 1\n\nmessage 3'),
+        mock.call('conversation_2', 'message 2'),
+        mock.call('conversation_1', 'message 4'),
+    ]
+
+
+def test_delivery_queue_follow_up():
+    import threading
+
+    send_function = mock.Mock(return_value=200)
+    release = threading.Event()
+
+    def get_follow_up(build_info):
+        release.wait(5)
+        return [('conversation_1', 'follow up ' + build_info)]
+
+    # collecting the follow up doesn't hold the delivery workers
+    delivery_queue = DeliveryQueue(send_function, workers=1, enrichment_workers=1, coalesce_window=0)
+    delivery_queue.put(lambda build_info: ('conversation_1', 'message ' + build_info), '1', follow_up=get_follow_up)
+    delivery_queue.put(lambda build_info: ('conversation_2', 'message ' + build_info), '2')
+    delivery_queue._queue.join()
+    assert send_function.call_args_list == [mock.call('conversation_1', 'message 1'),
+                                            mock.call('conversation_2', 'message 2')]
+    release.set()
+    delivery_queue.join()
+    assert send_function.call_args_list[-1] == mock.call('conversation_1', 'follow up 1')
+
+    # and the follow up is sent after the message, even if collected first
+    send_function.reset_mock()
+    delivery_queue = DeliveryQueue(send_function, workers=0, enrichment_workers=0, coalesce_window=1.0)
+    scheduled = []
+    with mock.patch.object(DeliveryQueue, '_schedule', lambda self, *args: scheduled.append(args)):
+        delivery_queue.put(lambda build_info: ('conversation_1', 'message ' + build_info), '3', follow_up=get_follow_up)
+        assert send_function.call_count == 0
+        while scheduled:
+            _delay, function, conversation_id, pending = scheduled.pop(0)
+            function(conversation_id, pending)
+
+    assert send_function.call_args_list == [mock.call('conversation_1', 'message 3'),
+                                            mock.call('conversation_1', 'follow up 3')]
+
+
+def test_rate_limiter():
+    from skype_bot.rate_limiter import RateLimiter, parse_retry_after
+
+    rate_limiter = RateLimiter(rate=100, burst=3, conversation_rate=1, conversation_burst=2)
+    assert rate_limiter.acquire('conversation_1') == 0
+    assert rate_limiter.acquire('conversation_1') == 0
+    assert 0 < rate_limiter.acquire('conversation_1') <= 1
+    assert rate_limiter.acquire('conversation_2') == 0
+    # global burst
+    assert rate_limiter.acquire('conversation_3') > 0
+
+    assert rate_limiter.throttled('conversation_2', '30') == 30
+    assert rate_limiter.get_delay('conversation_2') == pytest.approx(30, abs=1)
+
+    stats = rate_limiter.get_stats()
+    assert stats['level'] < 1
+    assert sorted(stats['conversations'].keys()) == ['conversation_1', 'conversation_2']
+
+    assert parse_retry_after(None) == 1.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470) == 10
+
+
+def test_delivery_queue_rate_limited():
+    from skype_bot.rate_limiter import RateLimiter
+
+    rate_limiter = RateLimiter(conversation_rate=1, conversation_burst=1)
+    send_function = mock.Mock(side_effect=[429, 200, 200])
+    delivery_queue = DeliveryQueue(send_function, workers=0, max_retries=0, coalesce_window=0,
+                                   rate_limiter=rate_limiter)
+
+    scheduled = []
+    with mock.patch.object(DeliveryQueue, '_schedule', lambda self, *args: scheduled.append(args)):
+        delivery_queue.deliver('conversation_1', 'message 1')
+        delivery_queue.deliver('conversation_1', 'message 2')
+
+    # throttled message is deferred even with no retries left, and so is the message over the rate
+    assert send_function.call_count == 1
+    assert len(scheduled) == 2
+    assert delivery_queue.get_stats()['deferred'] == 2
+
+    for _delay, function, conversation_id, message, attempt, entry_ids, deferrals in scheduled:
+        assert deferrals == 1
+        rate_limiter._conversation_buckets[conversation_id].level = 1
+        function(conversation_id, message, attempt, entry_ids, deferrals)
+
+    assert send_function.call_args_list == [
+        mock.call('conversation_1', 'message 1'),
+        mock.call('conversation_1', 'message 1'),
+        mock.call('conversation_1', 'message 2'),
+    ]
+    assert delivery_queue.get_stats()['deferred'] == 0
+
+
+def test_delivery_queue_max_deferrals():
+    from skype_bot.rate_limiter import RateLimiter
+
+    rate_limiter = RateLimiter(conversation_rate=1, conversation_burst=1)
+    send_function = mock.Mock(return_value=429)
+    delivery_queue = DeliveryQueue(send_function, workers=0, coalesce_window=0, rate_limiter=rate_limiter,
+                                   max_deferrals=2)
+
+    def schedule(self, delay, function, *args):
+        rate_limiter._conversation_buckets['conversation_1'] = mock.Mock(get_delay=lambda now: 0)
+        function(*args)
+
+    with mock.patch.object(DeliveryQueue, '_schedule', schedule):
+        delivery_queue.deliver('conversation_1', 'message 1')
+
+    assert send_function.call_count == 3
+    assert delivery_queue.get_stats()['deferred'] == 0
+
+
+def test_delivery_queue_reply():
+    from skype_bot.rate_limiter import RateLimiter
+
+    rate_limiter = RateLimiter(conversation_rate=1, conversation_burst=1)
+    send_function = mock.Mock(return_value=200)
+    delivery_queue = DeliveryQueue(send_function, workers=0, coalesce_window=0, rate_limiter=rate_limiter,
+                                   max_reply_wait=0.0)
+
+    assert delivery_queue.reply('conversation_1', 'answer 1') == 200
+    # replies take tokens too: over the rate, the reply is queued
+    scheduled = []
+    with mock.patch.object(DeliveryQueue, '_schedule', lambda self, *args: scheduled.append(args)):
+        assert delivery_queue.reply('conversation_1', 'answer 2') is None
+    assert send_function.call_args_list == [mock.call('conversation_1', 'answer 1')]
+    assert len(scheduled) == 1
+
+
+def test_delivery_queue_outbox():
+    from datetime import datetime
+    from skype_bot.outbox import MongoOutbox
+
+    collection = mongomock.MongoClient().db.outbox
+    outbox = MongoOutbox(collection, ack_batch_size=2)
+    send_function = mock.Mock(side_effect=[200, 500, 200, 200])
+    delivery_queue = DeliveryQueue(send_function, workers=0, max_retries=0, coalesce_window=0, outbox=outbox)
+
+    delivery_queue.deliver('conversation_1', 'message 1')
+    # acknowledgements are written in batches
+    assert outbox.collection.count_documents({'delivered_at' : None}) == 1
+
+    delivery_queue.deliver('conversation_2', 'message 2')
+    delivery_queue.deliver('conversation_3', 'message 3')
+    assert outbox.collection.count_documents({}) == 3
+    assert [e['message'] for e in outbox.iter_undelivered()] == ['message 2']
+
+    # claimed by the first process
+    other_outbox = MongoOutbox(collection, ack_batch_size=1)
+    other_queue = DeliveryQueue(send_function, workers=0, max_retries=0, coalesce_window=0, outbox=other_outbox)
+    other_queue.replay()
+    assert send_function.call_count == 3
+
+    # undelivered message is sent again once the claim expired
+    collection.update_many({}, {'$set' : {'claimed_until' : datetime(2000, 1, 1)}})
+    other_queue.replay()
+    assert send_function.call_args_list[-1] == mock.call('conversation_2', 'message 2')
+    assert list(outbox.iter_undelivered()) == []
+    assert outbox.collection.count_documents({}) == 3
+
+
+def test_delivery_queue_sqlite_outbox(tmpdir):
+    from skype_bot.outbox import SqliteOutbox
+
+    path = str(tmpdir.join('skype_bot.db'))
+    outbox = SqliteOutbox(path, ack_batch_size=1)
+    send_function = mock.Mock(side_effect=[500, 200, 200])
+    delivery_queue = DeliveryQueue(send_function, workers=0, max_retries=0, coalesce_window=0, outbox=outbox)
+    delivery_queue.put(lambda build_info: ('conversation_1', 'build ' + build_info['number']), {'number' : '1'})
+    delivery_queue.deliver('conversation_2', 'message 2')
+    assert [e['render'] for e in outbox.iter_undelivered()] == ['<lambda>']
+
+    # claimed by the first process until the claim expires
+    other_outbox = SqliteOutbox(path, ack_batch_size=1)
+    other_queue = DeliveryQueue(send_function, workers=0, max_retries=0, coalesce_window=0, outbox=other_outbox)
+    other_queue.register(lambda build_info: ('conversation_1', 'build ' + build_info['number']), '<lambda>')
+    assert list(other_outbox.claim_undelivered()) == []
+
+    other_outbox._connection.execute('UPDATE outbox SET claimed_until = 0')
+    other_outbox._connection.commit()
+    other_queue.replay()
+    assert send_function.call_args_list[-1] == mock.call('conversation_1', 'build 1')
+    assert list(outbox.iter_undelivered()) == []
+
+
+def test_delivery_queue_outbox_tasks():
+    from datetime import datetime
+    from skype_bot.outbox import MongoOutbox
+
+    collection = mongomock.MongoClient().db.outbox
+    send_function = mock.Mock(return_value=200)
+
+    def get_message(build_info):
+        raise RuntimeError('Process stopped')
+
+    # stored before being rendered
+    delivery_queue = DeliveryQueue(send_function, workers=0, coalesce_window=0, outbox=MongoOutbox(collection))
+    delivery_queue.put(get_message, {'number' : '1'})
+    entry = collection.find_one()
+    assert (entry['render'], entry['args'], entry['delivered_at']) == ('get_message', [{'number' : '1'}], None)
+
+    collection.update_many({}, {'$set' : {'claimed_until' : datetime(2000, 1, 1)}})
+    outbox = MongoOutbox(collection, ack_batch_size=1)
+    delivery_queue = DeliveryQueue(send_function, workers=0, coalesce_window=0, outbox=outbox)
+    delivery_queue.register(lambda build_info: ('conversation_1', 'build ' + build_info['number']), 'get_message')
+    delivery_queue.replay()
+    send_function.assert_called_once_with('conversation_1', 'build 1')
+    assert list(outbox.iter_undelivered()) == []
@@ -0,0 +1,14 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mock
+
+from skype_bot.http_session import create_session
+
+
+def test_create_session():
+    session = create_session({'pool_maxsize' : 8, 'read_timeout' : 10})
+    assert session.timeout == (5.0, 10)
+    assert session.get_adapter('https://api.skype.net')._pool_maxsize == 8
+    with mock.patch('requests.Session.request') as request:
+        session.post('https://api.skype.net/v3/conversations/id/activities')
+        assert request.call_args[1]['timeout'] == (5.0, 10)
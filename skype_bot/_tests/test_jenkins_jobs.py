@@ -0,0 +1,246 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+import mock
+import pytest
+
+from skype_bot import jenkins_jobs
+
+jenkins_config = {
+    'url' : 'http://jenkins/',
+    'user' : 'user',
+    'token' : 'token',
+}
+
+
+def _mock_response(content, status_code=200):
+    response = mock.Mock(status_code=status_code, text=content, content=content)
+    response.iter_content.side_effect = lambda size: (content[i:i + size] for i in range(0, len(content), size))
+    return response
+
+
+def test_get_build_test_errors():
+    report = json.dumps({'suites' : [{'cases' : [
+        {'name' : 'test_1', 'status' : 'PASSED'},
+        {'name' : 'test_2', 'status' : 'FAILED'},
+        {'name' : 'test_3', 'status' : 'REGRESSION'},
+    ]}]}).encode('utf-8')
+
+    with mock.patch('requests.Session.request', return_value=_mock_response(report)) as request_mock:
+        errors = jenkins_jobs.get_build_test_errors('job_a', 3, jenkins_config, timeout=5)
+        assert [e['name'] for e in errors] == ['test_2', 'test_3']
+        assert request_mock.call_args[1]['timeout'] == 5
+
+        # reports over the size limit are not parsed
+        assert jenkins_jobs.get_build_test_errors('job_a', 3, jenkins_config, max_size=len(report) - 1) == []
+
+
+def test_jenkins_client():
+    client = jenkins_jobs.get_client(jenkins_config)
+    assert jenkins_jobs.get_client(dict(jenkins_config)) is client
+    assert jenkins_jobs.get_client(dict(jenkins_config, user='other_user')) is client
+    assert jenkins_jobs.get_client(dict(jenkins_config, url='http://other-jenkins/')) is not client
+
+    # credentials are given with each request, the shared session is left untouched
+    assert client.session.auth is None
+
+    jobs = json.dumps({'jobs' : [{'fullName' : 'job_a'}, {'fullName' : 'job_b'}]})
+    with mock.patch('requests.Session.request', return_value=_mock_response(jobs)) as request_mock:
+        assert jenkins_jobs.list_jobs(jenkins_config) == ['job_a', 'job_b']
+        assert request_mock.call_args[0] == ('GET', 'http://jenkins/api/json?tree=jobs[fullName]')
+        assert request_mock.call_args[1]['timeout'] == jenkins_jobs.endpoint_timeouts['jobs']
+        assert request_mock.call_args[1]['auth'] == ('user', 'token')
+
+        jenkins_jobs.list_jobs(dict(jenkins_config, user='other_user', token='other_token'))
+        assert request_mock.call_args[1]['auth'] == ('other_user', 'other_token')
+        assert client.session.auth is None
+
+    # timeouts read from YAML come as lists
+    config = dict(jenkins_config, url='http://yaml-jenkins/', timeouts={'jobs' : [1, 2], 'job' : 3})
+    with mock.patch('requests.Session.request', return_value=_mock_response(jobs)) as request_mock:
+        assert jenkins_jobs.list_jobs(config) == ['job_a', 'job_b']
+        assert request_mock.call_args[1]['timeout'] == (1, 2)
+    assert jenkins_jobs.get_client(config).timeouts['job'] == 3
+
+    with mock.patch('requests.Session.request', return_value=_mock_response('', status_code=404)):
+        assert jenkins_jobs.list_jobs(jenkins_config) == []
+        assert jenkins_jobs.get_building_jobs(jenkins_config) == {}
+        assert not jenkins_jobs.post_jenkins_json_request('job/job_a/build', jenkins_config)
+
+    # clients of the least recently used urls are dropped
+    with mock.patch.object(jenkins_jobs._clients, 'max_size', 2):
+        jenkins_jobs.get_client(dict(jenkins_config, url='http://jenkins_2/'))
+        jenkins_jobs.get_client(dict(jenkins_config, url='http://jenkins_3/'))
+    assert len(jenkins_jobs._clients) == 2
+    assert jenkins_jobs.get_client(jenkins_config) is not client
+
+
+def test_get_running_builds():
+    def _build(url, number, user_id='user_1', **kwargs):
+        build = {
+            'url' : url, 'number' : number, 'building' : True, 'timestamp' : 0, 'duration' : 0,
+            'estimatedDuration' : 10, 'result' : None,
+            'actions' : [{}, {'causes' : [{'userId' : user_id, 'userName' : 'User'}]}],
+        }
+        build.update(kwargs)
+        return build
+
+    computers = json.dumps({'computer' : [
+        {
+            'displayName' : 'master',
+            'executors' : [{'currentExecutable' : None}],
+            'oneOffExecutors' : [{'currentExecutable' : _build('http://jenkins/job/folder/job/pipeline/3/', 3)}],
+        },
+        {
+            'displayName' : 'node_1',
+            'executors' : [
+                {'currentExecutable' : _build('http://jenkins/job/job_a/12/', 12, builtOn='node_1')},
+                {'currentExecutable' : _build('http://jenkins/job/job_a/11/', 11, builtOn='node_1')},
+                # pipeline step running on a node
+                {'currentExecutable' : {'url' : None, 'number' : None}},
+            ],
+            'oneOffExecutors' : [],
+        },
+    ]})
+
+    with mock.patch('requests.Session.request', return_value=_mock_response(computers)) as request_mock:
+        building_jobs = jenkins_jobs.get_building_jobs(jenkins_config)
+        assert request_mock.call_args[0][1].startswith('http://jenkins/computer/api/json?tree=computer[')
+
+    assert sorted(building_jobs) == ['folder/pipeline', 'job_a']
+    assert building_jobs['job_a']['number'] == 12
+    assert building_jobs['job_a']['userId'] == 'user_1'
+    assert building_jobs['folder/pipeline']['builtOn'] == 'master'
+
+    # jobs are scanned only when not allowed to read the computers
+    jobs = json.dumps({'jobs' : [{'fullName' : 'job_b', 'lastBuild' : _build('http://jenkins/job/job_b/2/', 2)}]})
+
+    def request(status_code):
+        def _request(method, url, **kwargs):
+            if url.startswith('http://jenkins/computer/'):
+                return _mock_response('', status_code=status_code)
+            return _mock_response(jobs)
+        return _request
+
+    with mock.patch('requests.Session.request', side_effect=request(403)) as request_mock:
+        assert sorted(jenkins_jobs.query_building_jobs(jenkins_config)) == ['job_b']
+        assert request_mock.call_count == 2
+    with mock.patch('requests.Session.request', side_effect=request(503)) as request_mock:
+        assert jenkins_jobs.query_building_jobs(jenkins_config) is None
+        assert request_mock.call_count == 1
+
+    assert jenkins_jobs.get_build_job_name('http://jenkins/job/a%20b/1/', jenkins_config) == 'a b'
+    assert jenkins_jobs.get_build_job_name('http://jenkins/view/all/', jenkins_config) is None
+
+
+def test_build_job():
+    job = {
+        'lastBuild' : {'number' : 3, 'actions' : [{}, {'parameters' : [
+            {'name' : 'BRANCH', 'value' : 'master'},
+            {'name' : 'REMOVED', 'value' : 'x'},
+        ]}]},
+        'property' : [{}, {'parameterDefinitions' : [{'name' : 'BRANCH'}, {'name' : 'DEBUG'}]}],
+        'actions' : [{}],
+    }
+    requests_log = []
+
+    def request(method, url, **kwargs):
+        requests_log.append((method, url))
+        if method == 'GET':
+            return _mock_response(json.dumps(job))
+        return _mock_response('', status_code=post_status[0])
+
+    post_status = [201]
+    with mock.patch('requests.Session.request', side_effect=request):
+        assert jenkins_jobs.build_job('job_a', jenkins_config) == (0, 'Build triggered: job_a')
+        assert requests_log == [
+            ('GET', 'http://jenkins/job/job_a/api/json?tree=lastBuild[number,actions[parameters[name,value]]],'
+                    'property[parameterDefinitions[name]],actions[parameterDefinitions[name]]'),
+            ('POST', 'http://jenkins/job/job_a/buildWithParameters?BRANCH=master'),
+        ]
+
+        # parameter definitions are cached
+        del requests_log[:]
+        assert jenkins_jobs.rebuild_job('job_a', jenkins_config) == (0, 'Rebuild triggered: job_a')
+        assert requests_log[0] == ('GET', 'http://jenkins/job/job_a/api/json?tree=lastBuild[number,actions[parameters[name,value]]]')
+        assert len(requests_log) == 2
+
+        # or a new build has a parameter added since they were cached
+        job['lastBuild'] = {'number' : 4, 'actions' : [{'parameters' : [
+            {'name' : 'BRANCH', 'value' : 'master'},
+            {'name' : 'ADDED', 'value' : 'y'},
+        ]}]}
+        job['property'][1]['parameterDefinitions'].append({'name' : 'ADDED'})
+        del requests_log[:]
+        assert jenkins_jobs.rebuild_job('job_a', jenkins_config) == (0, 'Rebuild triggered: job_a')
+        assert 'property[parameterDefinitions[name]]' in requests_log[1][1]
+        assert requests_log[2] == ('POST', 'http://jenkins/job/job_a/buildWithParameters?BRANCH=master&ADDED=y')
+        del requests_log[:]
+        jenkins_jobs.rebuild_job('job_a', jenkins_config)
+        assert len(requests_log) == 2
+
+        # until a build fails to be triggered
+        post_status[0] = 400
+        assert jenkins_jobs.rebuild_job('job_a', jenkins_config) == jenkins_jobs.FAIL_TO_RETRIEVE
+        del requests_log[:]
+        jenkins_jobs.rebuild_job('job_a', jenkins_config)
+        assert 'property[parameterDefinitions[name]]' in requests_log[0][1]
+
+        # never built job without parameters
+        job = {'lastBuild' : None, 'property' : [], 'actions' : []}
+        post_status[0] = 201
+        del requests_log[:]
+        assert jenkins_jobs.build_job('job_b', jenkins_config) == (0, 'Build triggered: job_b')
+        assert requests_log[-1] == ('POST', 'http://jenkins/job/job_b/build')
+
+
+def test_jenkins_unavailable():
+    import requests
+
+    config = dict(jenkins_config, url='http://unavailable-jenkins/', circuit_breaker={'failure_threshold' : 2})
+    with mock.patch('requests.Session.request', side_effect=requests.ConnectionError) as request_mock:
+        assert jenkins_jobs.list_jobs(config) == []
+        assert jenkins_jobs.is_jenkins_available(config)
+        assert jenkins_jobs.query_building_jobs(config) is None
+        assert not jenkins_jobs.is_jenkins_available(config)
+
+        # failing fast, without requesting Jenkins
+        request_count = request_mock.call_count
+        assert jenkins_jobs.get_building_jobs(config) == {}
+        assert jenkins_jobs.build_job('job_a', config) == jenkins_jobs.FAIL_TO_RETRIEVE
+        assert request_mock.call_count == request_count
+
+    assert request_mock.call_args[1]['timeout'] == jenkins_jobs.endpoint_timeouts['building_jobs']
+
+
+def test_jenkins_client_guards():
+    import requests
+
+    config = dict(jenkins_config, circuit_breaker={'failure_threshold' : 1})
+    client = jenkins_jobs.get_client(config)
+    active_calls = []
+
+    def iter_content(size):
+        active_calls.append(client.bulkhead.active_calls)
+        yield b'{"suites"'
+        raise requests.ConnectionError()
+
+    # the bulkhead slot is held while the test report is read, and failures to read it are recorded
+    response = _mock_response(b'')
+    response.iter_content.side_effect = iter_content
+    with mock.patch('requests.Session.request', return_value=response):
+        assert jenkins_jobs.get_build_test_errors('job_a', 3, config) == []
+    assert active_calls == [1]
+    assert client.bulkhead.active_calls == 0
+    assert response.close.called
+    assert not jenkins_jobs.is_jenkins_available(config)
+
+    # any exception of a trial call opens the circuit again, instead of leaving it half open
+    client.circuit_breaker.opened_at -= client.circuit_breaker.reset_timeout
+    with mock.patch('requests.Session.request', side_effect=ValueError):
+        with pytest.raises(ValueError):
+            client.get('api/json')
+    assert client.circuit_breaker.state == client.circuit_breaker.OPEN
+    assert client.bulkhead.active_calls == 0
+
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
 import time
 import urllib
 from datetime import datetime
@@ -9,6 +10,7 @@ import pytest
 
 import mongomock
 from skype_bot.bot import Bot
+from skype_bot.running_builds import RunningBuilds
 from skype_bot.users_bot import UsersBot
 
 bot_config = {
@@ -26,13 +28,15 @@ bot_config = {
 
 @pytest.fixture(scope='module')
 def bot():
-    with mock.patch.object(UsersBot, '_get_jenkins_db', return_value=mongomock.MongoClient().db):
+    with mock.patch.object(UsersBot, '_get_jenkins_db', return_value=mongomock.MongoClient().db), \
+            mock.patch.object(Bot, '_get_auth'):
         yield Bot({
             'bot_name' : 'bot_name',
             'bot_password' : 'bot_password',
             'bot_app_id' : 'bot_app_id',
             'jenkins' : {'url' : '/'},
-            'mongodb' : {'url' : None}
+            'mongodb' : {'url' : None},
+            'delivery' : {'workers' : 0, 'enrichment_workers' : 0, 'coalesce_window' : 0},
         })
 
 
@@ -55,17 +59,29 @@ def test_job_started(bot):
 
     encoded_params = urllib.urlencode(params)
 
+    # unregistered users are not notified, and not looked up again
     with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
         with app.test_client() as c:
             resp = c.get('/job/started?' + encoded_params)
             assert resp.status_code == 200
-            assert send_mock.call_count == 1
-            send_mock.assert_called_with(None, None)
+            assert send_mock.call_count == 0
+            assert app.users_bot.is_unknown_jenkins_id(jenkins_id)
 
     # register user
     with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
         app._handle_delivered_message('jenkins_id: {}'.format(jenkins_id), 'message', 'conversation_id', 'sender_name', 'sender_id')
 
+    assert not app.users_bot.is_unknown_jenkins_id(jenkins_id)
+
+    # repeated events are ignored
+    with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
+        with app.test_client() as c:
+            resp = c.get('/job/started?' + encoded_params)
+            assert resp.status_code == 200
+            assert send_mock.call_count == 0
+
+    params['number'] = '2'
+    encoded_params = urllib.urlencode(params)
     with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
         with app.test_client() as c:
             resp = c.get('/job/started?' + encoded_params)
@@ -103,4 +119,187 @@ def test_job_started(bot):
                 '\nResult: <b>SUCCESS</b>'
                 '\nDuration: <b>82.31</b>'
                 '\nStarted: <b>2017-01-01 00:00:00</b>'
-            )
\ No newline at end of file
+            )
+
+def test_job_events(bot):
+    app = bot
+
+    start_date = datetime(2017, 1, 1)
+    timestamp = '%d' % (time.mktime(start_date.timetuple()) * 1000)
+
+    with mock.patch.object(Bot, 'send', return_value=200):
+        app._handle_delivered_message('jenkins_id: events_user', 'message', 'events_conversation', 'sender_name',
+                                      'events_sender')
+
+    events = [
+        {
+            'event' : 'jenkins.job.started',
+            'timestamp' : timestamp,
+            'number' : '1',
+            'userId' : 'events_user',
+            'job_name' : 'job_a',
+            'builtOn' : 'node',
+            'url' : 'job/job_a/1/',
+        },
+        {
+            'event' : 'jenkins.job.started',
+            'timestamp' : timestamp,
+            'number' : '1',
+            'userId' : 'unregistered_user',
+            'job_name' : 'job_b',
+            'builtOn' : 'node',
+            'url' : 'job/job_b/1/',
+        },
+        {
+            'event' : 'jenkins.job.completed',
+            'duration' : '60000',
+            'timestamp' : timestamp,
+            'number' : '1',
+            'userId' : 'events_user',
+            'job_name' : 'job_c',
+            'result' : 'SUCCESS',
+            'url' : 'job/job_c/1/',
+        },
+    ]
+
+    with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
+        with app.test_client() as c:
+            resp = c.post('/job/events', data=json.dumps(events), content_type='application/json')
+            assert resp.status_code == 200
+            assert send_mock.call_args_list == [
+                mock.call(
+                    u'events_conversation',
+                    '(skate) <b>Started:</b> <a href="/job/job_a">job_a</a>'
+                    '\nStarted: <b>2017-01-01 00:00:00</b>'
+                    '\nBuilt On: <b>node</b>'
+                ),
+                mock.call(
+                    u'events_conversation',
+                    ';) <b>Finished:</b> <a href="/job/job_c">job_c</a>'
+                    '\nResult: <b>SUCCESS</b>'
+                    '\nDuration: <b>1.00</b>'
+                    '\nStarted: <b>2017-01-01 00:00:00</b>'
+                ),
+            ]
+
+            resp = c.post('/job/events', data=json.dumps({'event' : 'jenkins.job.started'}),
+                          content_type='application/json')
+            assert resp.status_code == 400
+
+    assert app.users_bot._get_user_history('events_user') == ['job_a']
+
+    # invalid events are rejected one by one
+    events = [
+        'jenkins.job.started',
+        dict(events[0], number='2', timestamp=None),
+        dict(events[0], number='x'),
+        dict(events[0], number='3'),
+    ]
+    with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
+        with app.test_client() as c:
+            resp = c.post('/job/events', data=json.dumps(events), content_type='application/json')
+            assert resp.status_code == 200
+            assert resp.data == b'3 invalid events rejected'
+            assert send_mock.call_count == 1
+
+    # events without user are not notified, but still applied to the running builds
+    app.users_bot.running_builds = RunningBuilds()
+    anonymous_events = [
+        dict(events[3], number='4', userId=None),
+        dict(events[3], number='5', userId=None, job_name=None),
+    ]
+    with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
+        with app.test_client() as c:
+            resp = c.post('/job/events', data=json.dumps(anonymous_events), content_type='application/json')
+            assert resp.data == b'2 invalid events rejected'
+            assert send_mock.call_count == 0
+    assert list(app.users_bot.running_builds.get_user_builds(None)) == ['job_a']
+    app.users_bot.running_builds = None
+
+    # nor can an event failing to be formatted
+    messages = app.users_bot.get_events_messages([dict(events[3], timestamp='x'), events[3]])
+    assert [conversation_id for conversation_id, _message in messages] == ['events_conversation']
+
+
+def test_job_completed_test_errors(bot):
+    app = bot
+
+    with mock.patch.object(Bot, 'send', return_value=200):
+        app._handle_delivered_message('jenkins_id: failing_user', 'message', 'failing_conversation', 'sender_name',
+                                      'failing_sender')
+
+    params = {
+        'event' : 'jenkins.job.completed',
+        'duration' : '60000',
+        'timestamp' : '%d' % (time.mktime(datetime(2017, 1, 1).timetuple()) * 1000),
+        'number' : '7',
+        'userId' : 'failing_user',
+        'job_name' : 'job_a',
+        'result' : 'FAILURE',
+        'url' : 'job/job_a/7/',
+    }
+    test_errors = [{'name' : 'test_{}'.format(i), 'status' : 'FAILED'} for i in range(12)]
+
+    with mock.patch.object(Bot, 'send', return_value=200) as send_mock, \
+            mock.patch('skype_bot.users_bot.get_build_test_errors', return_value=test_errors) as get_errors_mock:
+        with app.test_client() as c:
+            resp = c.get('/job/completed?' + urllib.urlencode(params))
+            assert resp.status_code == 200
+
+        assert get_errors_mock.call_args[0][:2] == ('job_a', 7)
+        assert send_mock.call_count == 2
+        assert send_mock.call_args_list[0][0][1].startswith('(no) <b>Finished:</b>')
+        assert send_mock.call_args_list[1] == mock.call(
+            u'failing_conversation',
+            '(no) <b>Errors:</b> <a href="/job/job_a">job_a</a> 12\n' +
+            ''.join('   <b>test_{}</b>\n'.format(i) for i in range(10)) +
+            '<b>There is more</b>\n'
+        )
+
+
+def test_job_event_retried_after_failure(bot):
+    app = bot
+
+    with mock.patch.object(Bot, 'send', return_value=200):
+        app._handle_delivered_message('jenkins_id: retried_user', 'message', 'retried_conversation', 'sender_name',
+                                      'retried_sender')
+
+    params = {
+        'event' : 'jenkins.job.started',
+        'timestamp' : '%d' % (time.mktime(datetime(2017, 1, 1).timetuple()) * 1000),
+        'number' : '1',
+        'userId' : 'retried_user',
+        'job_name' : 'retried_job',
+        'url' : 'job/retried_job/1/',
+    }
+
+    # the event could not be stored: Jenkins retry is not a duplicate
+    with mock.patch.object(app.delivery_queue, 'put', side_effect=RuntimeError('outbox unavailable')):
+        with app.test_client() as c:
+            resp = c.get('/job/started?' + urllib.urlencode(params))
+            assert resp.status_code == 500
+
+    with mock.patch.object(Bot, 'send', return_value=200) as send_mock:
+        with app.test_client() as c:
+            c.get('/job/started?' + urllib.urlencode(params))
+            c.get('/job/started?' + urllib.urlencode(params))
+        assert send_mock.call_count == 1
+
+
+def test_started_message_without_history(bot):
+    app = bot
+
+    with mock.patch.object(Bot, 'send', return_value=200):
+        app._handle_delivered_message('jenkins_id: history_user', 'message', 'history_conversation', 'sender_name',
+                                      'history_sender')
+
+    build_info = {
+        'timestamp' : '%d' % (time.mktime(datetime(2017, 1, 1).timetuple()) * 1000),
+        'number' : '1',
+        'userId' : 'history_user',
+        'job_name' : 'job_a',
+    }
+    with mock.patch.object(UsersBot, '_add_user_history', side_effect=RuntimeError('history unavailable')):
+        conversation_id, message = app.users_bot.get_started_message(build_info)
+    assert conversation_id == 'history_conversation'
+    assert message.startswith('(skate) <b>Started:</b>')
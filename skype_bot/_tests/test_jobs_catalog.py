@@ -0,0 +1,72 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+import mock
+
+from skype_bot.jobs_catalog import JobsCatalog
+
+
+def test_jobs_catalog():
+    catalog = JobsCatalog({'url' : 'jenkins/'}, refresh_interval=60)
+
+    with mock.patch('skype_bot.jenkins_jobs.list_jobs', return_value=['job_1', 'job_2']) as list_jobs:
+        assert catalog.get_jobs() == ['job_1', 'job_2']
+        assert catalog.get_jobs() == ['job_1', 'job_2']
+        assert list_jobs.call_count == 1
+
+        # on demand
+        catalog.refresh()
+        assert list_jobs.call_count == 2
+
+    # a failed refresh keeps the previous jobs
+    with mock.patch('skype_bot.jenkins_jobs.list_jobs', return_value=[]):
+        catalog.refresh()
+    assert catalog.get_jobs() == ['job_1', 'job_2']
+
+
+def test_jobs_catalog_single_flight():
+    catalog = JobsCatalog({'url' : 'jenkins/'}, refresh_interval=60)
+    release = threading.Event()
+
+    def list_jobs(config):
+        release.wait(5)
+        return ['job_1']
+
+    results = []
+    with mock.patch('skype_bot.jenkins_jobs.list_jobs', side_effect=list_jobs) as list_jobs_mock:
+        threads = [threading.Thread(target=lambda: results.append(catalog.get_jobs())) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert results == [['job_1']] * 5
+        assert list_jobs_mock.call_count == 1
+
+
+def test_jobs_catalog_single_flight_failure():
+    catalog = JobsCatalog({'url' : 'jenkins/'}, refresh_interval=60)
+    release = threading.Event()
+
+    def list_jobs(config):
+        release.wait(5)
+        return []
+
+    # callers waiting for a failed first load don't request Jenkins again
+    results = []
+    with mock.patch('skype_bot.jenkins_jobs.list_jobs', side_effect=list_jobs) as list_jobs_mock:
+        threads = [threading.Thread(target=lambda: results.append(catalog.get_jobs())) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert results == [[]] * 5
+        assert list_jobs_mock.call_count == 1
+
@@ -0,0 +1,34 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import fnmatch
+
+from skype_bot.jobs_index import JobsIndex
+
+
+jobs = ['job_1', 'job_12', 'job_2', 'job_21', 'Project_linux64', 'project_win64', 'tools-[docs]']
+
+
+def test_jobs_index_glob():
+    index = JobsIndex(jobs)
+
+    for pattern in ['job*', 'job*1', '*64', '*_?', 'job_[12]', 'Project*', 'project*', '*', 'none*']:
+        assert index.search(pattern) == fnmatch.filter(jobs, pattern), pattern
+    assert index.search('job*', limit=2) == ['job_1', 'job_12']
+
+
+def test_jobs_index_substring():
+    index = JobsIndex(jobs)
+
+    # exact match first, then by position and length
+    assert index.search('job_1') == ['job_1', 'job_12']
+    assert index.search('b_2') == ['job_2', 'job_21']
+    assert index.search('PROJECT') == ['project_win64', 'Project_linux64']
+    assert index.search('64') == ['project_win64', 'Project_linux64']
+
+
+def test_jobs_index_fuzzy():
+    index = JobsIndex(jobs)
+
+    assert index.search('projcet_linux64') == ['Project_linux64']
+    assert index.search('project_win32') == ['project_win64', 'Project_linux64']
+    assert index.search('unrelated') == []
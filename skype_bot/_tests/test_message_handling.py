@@ -18,7 +18,11 @@ bot_config = {
 
     'jenkins' : {
         'url' : '/',
-    }
+    },
+
+    'storage' : {
+        'path' : ':memory:',
+    },
 }
 
 # @mock.patch.object(Bot, 'send', return_value=200)
@@ -0,0 +1,157 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mock
+import mongomock
+
+from skype_bot.running_builds import RunningBuilds
+from skype_bot.users_bot import UsersBot
+
+
+def _build_info(job_name, number, user_id='user_1'):
+    return {'job_name' : job_name, 'number' : str(number), 'userId' : user_id, 'timestamp' : '0', 'builtOn' : 'node'}
+
+
+def test_running_builds():
+    collection = mongomock.MongoClient().db.running_builds
+    builds = RunningBuilds(collection)
+
+    builds.started(_build_info('job_a', 1))
+    builds.started(_build_info('job_b', 1))
+    builds.started(_build_info('job_c', 1, user_id='user_2'))
+    # a late event of an older build is ignored
+    builds.completed(_build_info('job_a', 0))
+    assert sorted(builds.get_user_builds('user_1')) == ['job_a', 'job_b']
+    assert len(builds) == 3
+
+    builds.completed(_build_info('job_b', 1))
+    assert sorted(builds.get_user_builds('user_1')) == ['job_a']
+    # a started event received after the completed one is ignored
+    builds.completed(_build_info('job_f', 1))
+    builds.started(_build_info('job_f', 1))
+    assert sorted(builds.get_user_builds('user_1')) == ['job_a']
+    assert builds.get_user_builds('user_3') == {}
+
+    # persisted
+    builds.flush()
+    assert sorted(RunningBuilds(collection).get_user_builds('user_1')) == ['job_a']
+
+    # missed events are repaired, events received while Jenkins is queried are kept
+    def get_building_jobs():
+        builds.started(_build_info('job_d', 1))
+        builds.completed(_build_info('job_c', 1))
+        return {
+            'job_c' : {'number' : 1, 'userId' : 'user_2'},
+            'job_e' : {'number' : 5, 'userId' : 'user_1'},
+        }
+
+    added, removed = builds.reconcile(get_building_jobs)
+    assert added == {'job_e'}
+    assert removed == {'job_a'}
+    assert sorted(builds.get_user_builds('user_1')) == ['job_d', 'job_e']
+    assert builds.get_user_builds('user_2') == {}
+    builds.flush()
+    assert sorted(RunningBuilds(collection).get_user_builds('user_1')) == ['job_d', 'job_e']
+
+    # Jenkins not reachable: nothing changes
+    assert builds.reconcile(lambda: None) is None
+    assert len(builds) == 2
+
+
+def test_running_builds_writes_order():
+    import threading
+
+    collection = mongomock.MongoClient().db.running_builds
+    release = threading.Event()
+    replace_one = collection.replace_one
+
+    def slow_replace_one(*args, **kwargs):
+        release.wait(5)
+        return replace_one(*args, **kwargs)
+
+    builds = RunningBuilds(collection)
+    with mock.patch.object(collection, 'replace_one', side_effect=slow_replace_one):
+        # the callers don't wait for the database, which gets the writes in order
+        builds.started(_build_info('job_a', 1))
+        builds.completed(_build_info('job_a', 1))
+        builds.started(_build_info('job_a', 2))
+        assert collection.count() == 0
+        release.set()
+        builds.flush()
+
+    assert [(d['_id'], d['number']) for d in collection.find()] == [('job_a', 2)]
+
+
+def test_status_from_running_builds():
+    with mock.patch.object(UsersBot, '_get_jenkins_db', return_value=mongomock.MongoClient().db), \
+            mock.patch.object(RunningBuilds, 'start_reconciler'):
+        app = UsersBot({'jenkins' : {'url' : 'jenkins/'}, 'mongodb' : {'url' : None}, 'running_builds' : {'enabled' : True}})
+
+    app._register_jenkins_user('user_1', 'conversation_1', 'User', 'skype_1')
+    app.update_running_builds(dict(_build_info('job_a', 1), event=app.STARTED_EVENT))
+    app.update_running_builds(dict(_build_info('job_b', 1, user_id='user_2'), event=app.STARTED_EVENT))
+    # jobs in folders are known by their full name, as reported by Jenkins
+    app.update_running_builds(dict(_build_info('job_c', 1), url='job/folder/job/job_c/1/', event=app.STARTED_EVENT))
+    assert sorted(app.running_builds.get_user_builds('user_1')) == ['folder/job_c', 'job_a']
+    app.update_running_builds(dict(_build_info('job_c', 1), url='job/folder/job/job_c/1/', event=app.COMPLETED_EVENT))
+
+    with mock.patch('skype_bot.jenkins_jobs.query_building_jobs') as get_building_jobs:
+        msg = app.handle_message('status', 'message', 'conversation_1', 'User', 'skype_1')
+        assert get_building_jobs.call_count == 0
+    assert 'There are 2 jobs running!' in msg
+    assert 'You have 1 jobs running:' in msg
+    assert '>job_a<' in msg
+
+    app.update_running_builds(dict(_build_info('job_a', 1), event=app.COMPLETED_EVENT))
+    assert 'You have none jobs running!' in app.handle_message('status', 'message', 'conversation_1', 'User', 'skype_1')
+
+
+def test_building_jobs_snapshot():
+    import threading
+    import time
+    from skype_bot.running_builds import BuildingJobsSnapshot
+
+    release = threading.Event()
+    building_jobs = {'job_a' : {'userId' : 'user_1'}, 'job_b' : {'userId' : 'user_2'}}
+
+    def get_building_jobs():
+        release.wait(5)
+        return building_jobs
+
+    get_building_jobs_mock = mock.Mock(side_effect=get_building_jobs)
+    snapshot = BuildingJobsSnapshot(get_building_jobs_mock, ttl=60)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(snapshot.get_user_builds('user_1'))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [(2, {'job_a' : {'userId' : 'user_1'}})] * 5
+    assert get_building_jobs_mock.call_count == 1
+
+    snapshot.taken_at -= 60
+    assert snapshot.get_user_builds('user_2') == (2, {'job_b' : {'userId' : 'user_2'}})
+    assert get_building_jobs_mock.call_count == 2
+
+
+def test_stale_building_jobs_snapshot():
+    from skype_bot.running_builds import BuildingJobsSnapshot
+
+    building_jobs = [None]
+    snapshot = BuildingJobsSnapshot(lambda: building_jobs[0], ttl=60)
+    assert snapshot.get_user_builds('user_1') == (None, {})
+    assert snapshot.stale
+
+    building_jobs[0] = {'job_a' : {'userId' : 'user_1'}}
+    snapshot.taken_at -= 60
+    assert snapshot.get_user_builds('user_1') == (1, {'job_a' : {'userId' : 'user_1'}})
+    assert not snapshot.stale
+
+    # Jenkins failing: the previous snapshot is kept
+    building_jobs[0] = None
+    snapshot.taken_at -= 60
+    assert snapshot.get_user_builds('user_1') == (1, {'job_a' : {'userId' : 'user_1'}})
+    assert snapshot.stale
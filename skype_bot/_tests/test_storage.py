@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mock
+import mongomock
+import pytest
+
+from skype_bot.storage import JobsHistory, MongoStorage, SqliteStorage
+
+
+@pytest.fixture(params=['mongodb', 'sqlite'])
+def storage(request, tmpdir):
+    if request.param == 'mongodb':
+        return MongoStorage(mongomock.MongoClient().db, history_size=3)
+    else:
+        return SqliteStorage(str(tmpdir.join('skype_bot.db')), history_size=3)
+
+
+def test_storage_users(storage):
+    assert storage.find_user('skype_id', 'skype_1') is None
+
+    _id = storage.save_user({'jenkins_id' : 'jenkins_1', 'skype_id' : 'skype_1', 'conversation_id' : 'conversation_1'})
+    storage.save_user({'jenkins_id' : 'jenkins_2', 'skype_id' : 'skype_2', 'conversation_id' : 'conversation_2'})
+
+    user_info = storage.find_user('jenkins_id', 'jenkins_1')
+    assert user_info['_id'] == _id
+    assert user_info['skype_id'] == 'skype_1'
+
+    user_info['jenkins_token'] = 'token_1'
+    assert storage.save_user(user_info) == _id
+    assert storage.find_user('skype_id', 'skype_1')['jenkins_token'] == 'token_1'
+
+    assert sorted(u['jenkins_id'] for u in storage.iter_users()) == ['jenkins_1', 'jenkins_2']
+    assert sorted(u['skype_id'] for u in storage.find_users_by_jenkins_ids(['jenkins_2', 'jenkins_3'])) == ['skype_2']
+
+
+def test_storage_history(storage):
+    assert storage.get_history('jenkins_1') == []
+
+    storage.add_history([('jenkins_1', 'job_1'), ('jenkins_1', 'job_2'), ('jenkins_2', 'job_1')])
+    storage.add_history([('jenkins_1', 'job_1')])
+    assert storage.get_history('jenkins_1') == ['job_1', 'job_2']
+
+    storage.add_history([('jenkins_1', 'job_3'), ('jenkins_1', 'job_4')])
+    assert storage.get_history('jenkins_1') == ['job_4', 'job_3', 'job_1']
+    assert storage.get_history('jenkins_1', limit=1) == ['job_4']
+    assert storage.get_history('jenkins_2') == ['job_1']
+
+
+def test_jobs_history_concurrent_updates():
+    collection = mongomock.MongoClient().db.users_jobs
+    jobs_history = JobsHistory(collection, max_size=3)
+    jobs_history.add_jobs([('jenkins_1', 'job_1'), ('jenkins_1', 'job_2')])
+
+    # another process updates the history between the read and the write
+    find_one = collection.find_one
+
+    def find_one_then_update(*args, **kwargs):
+        user_history = find_one(*args, **kwargs)
+        if collection.find_one.call_count == 1:
+            collection.update_one({'jenkins_id' : 'jenkins_1'}, {'$set' : {'history' : ['job_3', 'job_2', 'job_1']}})
+        return user_history
+
+    with mock.patch.object(collection, 'find_one', side_effect=find_one_then_update):
+        jobs_history.add_jobs([('jenkins_1', 'job_1')])
+
+    assert jobs_history.get_jobs_history('jenkins_1') == ['job_1', 'job_3', 'job_2']
+
+
+def test_mongo_indexes():
+    jenkins_db = mongomock.MongoClient().db
+    mongo_storage = MongoStorage(jenkins_db)
+    mongo_storage.ensure_indexes()
+
+    assert jenkins_db.skype_users.index_information()['skype_id_1']['unique']
+    assert 'jenkins_id_1' in jenkins_db.skype_users.index_information()
+    assert jenkins_db.users_jobs.index_information()['jenkins_id_1']['unique']
+
+    explain = {'queryPlanner' : {'winningPlan' : {'stage' : 'FETCH', 'inputStage' : {'stage' : 'COLLSCAN'}}}}
+    with mock.patch.object(mongomock.collection.Cursor, 'explain', return_value=explain, create=True):
+        assert mongo_storage.check_query_plans() == [
+            ('skype_users', 'skype_id'), ('skype_users', 'jenkins_id'), ('users_jobs', 'jenkins_id')]
+
+
+def test_jobs_history():
+    jobs_history = JobsHistory(mongomock.MongoClient().db.users_jobs, max_size=3)
+    for job_name in ['job_1', 'job_2', 'job_1', 'job_3']:
+        jobs_history.add_job('jenkins_1', job_name)
+    assert jobs_history.get_jobs_history('jenkins_1') == ['job_3', 'job_1', 'job_2']
+
+    jobs_history.add_jobs([('jenkins_1', 'job_4'), ('jenkins_2', 'job_1'), ('jenkins_1', 'job_2')])
+    assert jobs_history.get_jobs_history('jenkins_1') == ['job_2', 'job_4', 'job_3']
+    assert jobs_history.get_jobs_history('jenkins_1', limit=1) == ['job_2']
+    assert jobs_history.get_jobs_history('jenkins_2') == ['job_1']
+    assert jobs_history.get_jobs_history('jenkins_3') == []
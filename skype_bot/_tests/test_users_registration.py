@@ -21,10 +21,7 @@ def users_bot():
 def test_find_build_jobs(users_bot):
     app = users_bot
 
-    print(app._users_db.count())
     app._register_jenkins_user('jenkins_id', 'conversation_id', 'skype_name', 'skype_id')
-    print(app._users_db)
-    print(app._users_db.count())
 
     assert app.handle_message('job*', 'message', 'conversation_id', 'Test User', 'skype_id') == 'Unknown command: job*'
 
@@ -87,3 +84,47 @@ def test_user_registration(users_bot):
     with patch('skype_bot.jenkins_jobs.rebuild_job', return_value=200):
         assert app.handle_message('rebuild: 1'.format(jenkins_id), 'message', 'conversation_id', 'Test User', 'test_id') == \
             'Build requested: <a href="jenkins/job/job_name_2">job_name_2</a>'
+
+
+def test_users_directory():
+    from skype_bot.users_bot import UsersDirectory
+
+    from skype_bot.cache import ExpiringCache
+    from skype_bot.storage import MongoStorage
+
+    mongo_storage = MongoStorage(mongomock.MongoClient().db)
+    users_db = mongo_storage.users_db
+    users_db.insert_one({'jenkins_id' : 'jenkins_1', 'skype_id' : 'skype_1', 'conversation_id' : 'conversation_1'})
+
+    unknown_jenkins_ids = ExpiringCache()
+    directory = UsersDirectory(mongo_storage, unknown_jenkins_ids)
+    directory.load()
+
+    with patch.object(users_db, 'find_one', wraps=users_db.find_one) as find_one:
+        assert directory.get_by_skype_id('skype_1')['jenkins_id'] == 'jenkins_1'
+        assert directory.get_by_jenkins_id('jenkins_1')['conversation_id'] == 'conversation_1'
+        assert find_one.call_count == 0
+
+    # write-through, re-indexing the new jenkins id
+    user_info = directory.get_by_skype_id('skype_1')
+    user_info['jenkins_id'] = 'jenkins_2'
+    directory.save(user_info)
+    assert directory.get_by_jenkins_id('jenkins_2')['skype_id'] == 'skype_1'
+    assert users_db.find_one({'skype_id' : 'skype_1'})['jenkins_id'] == 'jenkins_2'
+    assert directory.get_by_jenkins_id('jenkins_1') is None
+
+    # users added by other instances are looked up
+    users_db.insert_one({'jenkins_id' : 'jenkins_3', 'skype_id' : 'skype_3', 'conversation_id' : 'conversation_3'})
+    assert sorted(directory.get_by_jenkins_ids(['jenkins_2', 'jenkins_3', 'jenkins_4']).keys()) == \
+        ['jenkins_2', 'jenkins_3']
+
+    # and changes are applied from the change stream
+    directory._apply_change({'operationType' : 'delete', 'documentKey' : {'_id' : user_info['_id']}})
+    assert [u['skype_id'] for u in directory.iter_users()] == ['skype_3']
+
+    # users registered by other instances are no longer unknown
+    unknown_jenkins_ids.set('jenkins_5', True)
+    directory._apply_change({'operationType' : 'insert', 'fullDocument' : {
+        '_id' : 5, 'jenkins_id' : 'jenkins_5', 'skype_id' : 'skype_5', 'conversation_id' : 'conversation_5'}})
+    assert unknown_jenkins_ids.get('jenkins_5') is None
+    assert directory.get_by_jenkins_id('jenkins_5')['skype_id'] == 'skype_5'
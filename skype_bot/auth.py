@@ -1,25 +1,43 @@
 import jwt
 import OpenSSL.crypto
-import requests
 import logging
 import base64
+import hashlib
 import json
+import threading
 import time
 
+from skype_bot.cache import ExpiringCache
+from skype_bot.http_session import create_session
+
+# used when the token endpoint doesn't tell the token lifetime
 bearer_token_exp_period = 3600
 
 server_keys_exp_period = 3600
 
+# bearer token and server keys are renewed this many seconds before they expire
+refresh_margin = 300
+
+# minimum delay between two attempts of the background refresher
+refresh_retry_period = 10
+
+verified_tokens_max_size = 1024
+
 
 class Auth:
     server_keys = []
     server_keys_exp_time = None
 
+    # public keys parsed from server_keys, indexed by key id
+    public_keys = {}
+
     bearer_token = None
     bearer_token_exp_time = None
 
     auth_url = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
 
+    keys_url = 'https://api.aps.skype.com/v1/keys'
+
     bot_app_id = None
     bot_password = None
 
@@ -28,24 +46,50 @@ class Auth:
     # logger.setLevel('DEBUG')
     # logger.addHandler(logging.StreamHandler())
 
-    def __init__(self, bot_app_id, bot_password):
+    def __init__(self, bot_app_id, bot_password, refresh_margin=refresh_margin, start_refresher=True, session=None):
         self.bot_app_id = bot_app_id
         self.bot_password = bot_password
+        self.refresh_margin = refresh_margin
+
+        # pooled keep-alive session, usually shared with the bot
+        if session is None:
+            session = create_session()
+        self.session = session
+
+        # digests of tokens which signature was already verified, expiring with the tokens
+        self.verified_tokens = ExpiringCache(max_size=verified_tokens_max_size)
+
+        # held by whoever is requesting a new bearer token or server keys
+        self._refresh_lock = threading.Lock()
+        self._stop_refresher = threading.Event()
 
         self.get_bearer_token()
         self.update_server_keys()
 
+        if start_refresher:
+            self.start_refresher()
+
     def get_bearer_token(self):
         """
         Function provides authentication against MS servers and returns Bearer token.
-        Token is cached for 1 hour.
+        Token is cached until it expires and renewed in background before that.
         :return: bearer token to be used in send() function
         """
 
         # check if cached token is still valid
-        if self.bearer_token is not None and time.time() < self.bearer_token_exp_time:
+        bearer_token = self.bearer_token
+        if bearer_token is not None and time.time() < self.bearer_token_exp_time:
+            if self._is_expiring(self.bearer_token_exp_time):
+                self._refresh_in_background()
+            return bearer_token
+
+        # no valid token: wait for a refresh in progress or do it ourselves
+        with self._refresh_lock:
+            if self.bearer_token is None or time.time() >= self.bearer_token_exp_time:
+                self._request_bearer_token()
             return self.bearer_token
 
+    def _request_bearer_token(self):
         data = {'client_id': self.bot_app_id,
                 'client_secret': self.bot_password,
                 'grant_type': 'client_credentials',
@@ -54,17 +98,84 @@ class Auth:
 
         header = {'Content-Type': 'application/x-www-form-urlencoded'}
 
-        result = requests.post(self.auth_url, data=data, headers=header)
+        result = self.session.post(self.auth_url, data=data, headers=header)
 
         if result.status_code == 200:
-            bearer_token = json.loads(result.content)['access_token']
+            token_info = json.loads(result.content)
+            bearer_token = token_info['access_token']
             self.logger.debug('token received: {}'.format(bearer_token))
-            self.bearer_token_exp_time = time.time() + bearer_token_exp_period
+            expires_in = int(token_info.get('expires_in', bearer_token_exp_period))
+            self.bearer_token_exp_time = time.time() + expires_in
             self.bearer_token = bearer_token
             return self.bearer_token
         else:
             raise Exception('auth failed')
-            self.bearer_token = None
+
+    def refresh(self):
+        """
+        Function renews the bearer token and the server keys which are about to expire.
+        Only one caller refreshes at a time, concurrent callers wait for it to finish.
+        """
+        with self._refresh_lock:
+            self._refresh_expiring()
+
+    def start_refresher(self):
+        """
+        Function starts a daemon thread renewing the bearer token and the server keys before they expire,
+        so that no request has to wait for them.
+        """
+        self._stop_refresher.clear()
+        refresher = threading.Thread(target=self._run_refresher, name='auth-refresher')
+        refresher.daemon = True
+        refresher.start()
+
+    def stop_refresher(self):
+        self._stop_refresher.set()
+
+    def _run_refresher(self):
+        while not self._stop_refresher.wait(self._get_refresh_delay()):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.exception(e)
+
+    def _get_refresh_delay(self):
+        exp_times = [exp_time for exp_time in (self.bearer_token_exp_time, self.server_keys_exp_time)
+                     if exp_time is not None]
+        if not exp_times:
+            return refresh_retry_period
+        delay = min(exp_times) - self.refresh_margin - time.time()
+        return max(delay, refresh_retry_period)
+
+    def _is_expiring(self, exp_time):
+        return exp_time is None or time.time() >= exp_time - self.refresh_margin
+
+    def _refresh_expiring(self):
+        if self._is_expiring(self.bearer_token_exp_time):
+            self._request_bearer_token()
+        if self._is_expiring(self.server_keys_exp_time):
+            self._request_server_keys()
+
+    def _refresh_in_background(self):
+        # a refresh is already in progress
+        if not self._refresh_lock.acquire(False):
+            return
+
+        def refresh_and_release():
+            try:
+                self._refresh_expiring()
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                self._refresh_lock.release()
+
+        try:
+            refresh_thread = threading.Thread(target=refresh_and_release, name='auth-refresh')
+            refresh_thread.daemon = True
+            refresh_thread.start()
+        except Exception:
+            self._refresh_lock.release()
+            raise
 
     def verify_request(self, auth_header):
         """
@@ -77,18 +188,43 @@ class Auth:
             self.logger.error('Malformed Authorization header: {}')
             return False
         token = parts[1]
+        if self._is_expiring(self.server_keys_exp_time):
+            self._refresh_in_background()
+        if self.verified_tokens.get(self._get_token_digest(token)):
+            return True
         headers = self._get_headers(token)
         kid = headers['kid']  # getting the public key id
         public_key = self._get_public_key_by_kid(kid)
         return self._verify_token_signature(token, public_key, headers['alg'])
 
+    def get_verified_tokens_stats(self):
+        """
+        :return: dict with size, hits and misses of the verified tokens cache
+        """
+        return self.verified_tokens.get_stats()
+
     def update_server_keys(self):
-        if self.server_keys and time.time() < self.bearer_token_exp_time:
+        """
+        Function returns the server keys used to sign incoming requests, requesting them if they are expired.
+        Keys are renewed in background before they expire.
+        :return: list of server keys
+        """
+        if self.server_keys and time.time() < self.server_keys_exp_time:
+            if self._is_expiring(self.server_keys_exp_time):
+                self._refresh_in_background()
+            return self.server_keys
+
+        with self._refresh_lock:
+            if not self.server_keys or time.time() >= self.server_keys_exp_time:
+                self._request_server_keys()
             return self.server_keys
+
+    def _request_server_keys(self):
         try:
-            result = requests.get('https://api.aps.skype.com/v1/keys')
+            result = self.session.get(self.keys_url)
             keys = result.json()['keys']
             # TODO: check if keys are correct?
+            self.public_keys = self._load_public_keys(keys)
             self.server_keys = keys
             self.server_keys_exp_time = time.time() + server_keys_exp_period
             return self.server_keys
@@ -117,39 +253,50 @@ class Auth:
             self.logger.exception(e)
             raise Exception('Token cannot be parsed: {}'.format(token))
 
+    def _load_public_keys(self, keys):
+        """
+        Function parses the certificates of the given server keys and extracts their public keys, so that
+        incoming requests don't need to parse X.509 certificates again.
+        :param keys: list of server keys as returned by the keys endpoint
+        :return: dict mapping key id to public key object
+        """
+        public_keys = {}
+        for key in keys:
+            kid = key.get('kid')
+            try:
+                # parse certificate and load into x509 object
+                x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, base64.b64decode(key['x5c'][0]))
+                # extract public key, already in the form expected by jwt.decode
+                public_keys[kid] = x509.get_pubkey().to_cryptography_key()
+            except Exception as e:
+                self.logger.exception(e)
+                self.logger.error('Public key cannot be extracted. Key id is: {}'.format(kid))
+        return public_keys
+
     def _get_public_key_by_kid(self, kid):
         """
-        Function looks up a certificate by key id in the list of server keys, extracts public key and encodes it to PEM format.
+        Function looks up a public key by key id in the keys parsed from the list of server keys.
         :param kid: key id (taken from token header)
-        :return: public key in PEM format
-        """
-        b64_der_cert = ''
-        cert_found_by_key = False
-        for key in self.server_keys:
-            if key['kid'] == kid:
-                b64_der_cert = key['x5c'][0]
-                cert_found_by_key = True
-                break
-        if not cert_found_by_key:
+        :return: public key object
+        """
+        try:
+            return self.public_keys[kid]
+        except KeyError:
             self.logger.error('Public key with kid = "{}" is absent'.format(kid))
             raise Exception('Public key with kid = {} cannot be found'.format(kid))
-        try:
-            # parse certificate and load into x509 object
-            x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, base64.b64decode(b64_der_cert))
-            # extract public key in DER format
-            der_pub_key = x509.get_pubkey()
-            # dump in PEM format
-            pem_pub_key = OpenSSL.crypto.dump_publickey(OpenSSL.crypto.FILETYPE_PEM, der_pub_key)
-            return pem_pub_key
 
-        except Exception as e:
-            self.logger.exception(e)
-            raise Exception('Public key cannot be extracted. Key id is: {}'.format(kid))
-
-    def _verify_token_signature(self, token, pem_pub_key, algorithm):
+    def _verify_token_signature(self, token, public_key, algorithm):
         try:
-            jwt.decode(token, pem_pub_key, verify=True, algorithms=[algorithm], options={'verify_aud': False})
-            return True
+            payload = jwt.decode(token, public_key, verify=True, algorithms=[algorithm], options={'verify_aud': False})
         except Exception as e:
             self.logger.exception(e)
             return False
+
+        # tokens without expiration are verified on every request
+        exp = payload.get('exp')
+        if exp is not None:
+            self.verified_tokens.set(self._get_token_digest(token), True, expires_at=exp)
+        return True
+
+    def _get_token_digest(self, token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
+import atexit
 import json
 import logging
 
-import requests
-
 from flask import Flask, request
+from skype_bot import dedup, delivery, outbox, rate_limiter
 from skype_bot.config import get_config
+from skype_bot.dedup import EventsDeduplicator, MongoEventsDeduplicator
+from skype_bot.delivery import DeliveryQueue
+from skype_bot.http_session import create_session
+from skype_bot.rate_limiter import RateLimiter
 from skype_bot.users_bot import UsersBot
 
 
@@ -40,18 +44,80 @@ class Bot(Flask):
             logging.basicConfig(level=config['logging_level'],
                                 format='%(asctime)s %(levelname)-8s %(name)-15s %(message)s')
 
-        self.auth = self._get_auth(self.bot_app_id, self.bot_password)
+        # pooled keep-alive session for all the calls to MS servers
+        self.session = create_session(config.get('http'))
+
+        self.auth = self._get_auth(self.bot_app_id, self.bot_password, config.get('auth', {}))
 
         self.users_bot = UsersBot(config)
 
+        rate_limit_config = config.get('rate_limit', {})
+        self.rate_limiter = RateLimiter(
+            rate=rate_limit_config.get('rate', rate_limiter.rate),
+            burst=rate_limit_config.get('burst', rate_limiter.burst),
+            conversation_rate=rate_limit_config.get('conversation_rate', rate_limiter.conversation_rate),
+            conversation_burst=rate_limit_config.get('conversation_burst', rate_limiter.conversation_burst),
+        )
+
+        self.events_deduplicator = self._get_events_deduplicator(config.get('dedup', {}))
+
+        self.outbox = self._get_outbox(config.get('outbox', {}))
+
+        delivery_config = config.get('delivery', {})
+        self.delivery_queue = DeliveryQueue(
+            self._send_notification,
+            workers=delivery_config.get('workers', delivery.delivery_workers),
+            max_retries=delivery_config.get('max_retries', delivery.max_retries),
+            retry_delay=delivery_config.get('retry_delay', delivery.retry_delay),
+            coalesce_window=delivery_config.get('coalesce_window', delivery.coalesce_window),
+            max_message_size=delivery_config.get('max_message_size', delivery.max_message_size),
+            rate_limiter=self.rate_limiter,
+            outbox=self.outbox,
+            max_deferrals=delivery_config.get('max_deferrals', delivery.max_deferrals),
+            max_reply_wait=delivery_config.get('max_reply_wait', delivery.max_reply_wait),
+            enrichment_workers=delivery_config.get('enrichment_workers', delivery.enrichment_workers),
+        )
+        for render_function in (self.users_bot.get_started_message, self.users_bot.get_completed_message,
+                                self.users_bot.get_events_messages, self.users_bot.get_test_errors_messages,
+                                self.users_bot.get_events_test_errors_messages):
+            self.delivery_queue.register(render_function)
+        self.delivery_queue.replay()
+        self.delivery_queue.start_replayer(config.get('outbox', {}).get('replay_interval', delivery.replay_interval))
+
         self.add_url_rule('/api/messages', view_func=self.api_messages, methods=['POST'])
         self.add_url_rule('/job/started', view_func=self.job_started, methods=['GET'])
         self.add_url_rule('/job/completed', view_func=self.job_completed, methods=['GET'])
-
-
-    def _get_auth(self, app_id, app_password):
-        from auth import Auth
-        return Auth(app_id, app_password)
+        self.add_url_rule('/job/events', view_func=self.job_events, methods=['POST'])
+
+
+    def _get_auth(self, app_id, app_password, auth_config):
+        from auth import Auth, refresh_margin
+        return Auth(app_id, app_password, refresh_margin=auth_config.get('refresh_margin', refresh_margin),
+                    session=self.session)
+
+    def _get_events_deduplicator(self, dedup_config):
+        ttl = dedup_config.get('ttl', dedup.events_ttl)
+        max_size = dedup_config.get('max_size', dedup.max_events)
+        reservation_timeout = dedup_config.get('reservation_timeout', dedup.reservation_timeout)
+
+        jenkins_db = self.users_bot.jenkins_db
+        if dedup_config.get('mongo', False) and jenkins_db is not None:
+            return MongoEventsDeduplicator(jenkins_db.jenkins_events, ttl=ttl, max_size=max_size,
+                                           reservation_timeout=reservation_timeout)
+        return EventsDeduplicator(ttl=ttl, max_size=max_size, reservation_timeout=reservation_timeout)
+
+    def _get_outbox(self, outbox_config):
+        if not outbox_config.get('enabled', True):
+            return None
+
+        # stored with the users: in MongoDB, or in the SQLite database
+        bot_outbox = self.users_bot.storage.get_outbox(
+            ack_batch_size=outbox_config.get('ack_batch_size', outbox.ack_batch_size),
+            ack_interval=outbox_config.get('ack_interval', outbox.ack_interval),
+            claim_timeout=outbox_config.get('claim_timeout', outbox.claim_timeout),
+        )
+        atexit.register(bot_outbox.flush)
+        return bot_outbox
 
     def job_started(self, *args):
         '''
@@ -66,8 +132,10 @@ class Bot(Flask):
             &url=job/etk-fb-ETK-ROCKY-v4.0-merge-master-win64-35/1/
         '''
         self.logger.info('job_started: {}'.format(request.args))
-        conversation_id, message = self.users_bot.get_started_message(request.args)
-        self.send(conversation_id, message)
+        build_info = request.args.to_dict()
+        build_info.setdefault('event', self.users_bot.STARTED_EVENT)
+        self._handle_job_events(
+            [build_info], lambda events: self.delivery_queue.put(self.users_bot.get_started_message, build_info))
         return ''
 
     def job_completed(self, *args):
@@ -84,10 +152,87 @@ class Bot(Flask):
             &url=job/rocky30-fb-ETK-ROCKY-v4.0-merge-master-linux64/3/
         '''
         self.logger.info('job_completed: {}'.format(request.args))
-        conversation_id, message = self.users_bot.get_completed_message(request.args)
-        self.send(conversation_id, message)
+        build_info = request.args.to_dict()
+        build_info.setdefault('event', self.users_bot.COMPLETED_EVENT)
+        # failed tests are collected afterwards, not to delay the message
+        self._handle_job_events([build_info], lambda events: self.delivery_queue.put(
+            self.users_bot.get_completed_message, build_info, follow_up=self.users_bot.get_test_errors_messages))
         return ''
 
+    def job_events(self, *args):
+        '''
+        Batch of job events, as a JSON array of objects with the same parameters as /job/started and /job/completed.
+        Events missing parameters are rejected, without preventing the others from being handled.
+        e.g.: [
+            {"event" : "jenkins.job.started", "timestamp" : "1507137597368", "number" : "1", "userId" : "tnobrega",
+             "job_name" : "etk-fb-ETK-ROCKY-v4.0-merge-master-win64-35", "builtOn" : "dev-windows10-win-sv01-ci02",
+             "url" : "job/etk-fb-ETK-ROCKY-v4.0-merge-master-win64-35/1/"},
+            {"event" : "jenkins.job.completed", "duration" : "1940528", "timestamp" : "1507139746158", "number" : "3",
+             "userId" : "tnobrega", "job_name" : "rocky30-fb-ETK-ROCKY-v4.0-merge-master-linux64", "result" : "FAILURE",
+             "url" : "job/rocky30-fb-ETK-ROCKY-v4.0-merge-master-linux64/3/"}
+        ]
+        '''
+        events = request.get_json(silent=True)
+        if not isinstance(events, list):
+            return 'Expected a JSON array of events', 400
+
+        self.logger.info('job_events: {} events'.format(len(events)))
+        # events which can't be notified (e.g. without user) are still applied to the running builds
+        applied_events = []
+        rejected_ids = set()
+        for i, build_info in enumerate(events):
+            error = self.users_bot.get_event_error(build_info)
+            if error is not None:
+                self.logger.warning('job_events: event {} rejected: {}'.format(i, error))
+                rejected_ids.add(id(build_info))
+                if self.users_bot.get_event_error(build_info, notified=False) is not None:
+                    continue
+            applied_events.append(build_info)
+        rejected_count = len(rejected_ids)
+
+        self._handle_job_events(
+            applied_events,
+            lambda events: self.delivery_queue.put_batch(
+                self.users_bot.get_events_messages, events, follow_up=self.users_bot.get_events_test_errors_messages),
+            is_notified=lambda build_info: id(build_info) not in rejected_ids,
+        )
+        if rejected_count:
+            return '{} invalid events rejected'.format(rejected_count)
+        return ''
+
+    def _handle_job_events(self, events, queue_function, is_notified=None):
+        '''
+        Applies the events not handled yet to the running builds, and queues the notification of the events
+        of registered users with `queue_function(events)`.
+
+        :param is_notified: callable(build_info) returning False for the events not to notify, all are by
+            default
+
+        Events are committed as handled once queued (stored in the outbox), and released if that failed, so
+        that Jenkins can send them again.
+        '''
+        reserved_events = [build_info for build_info in events if self.events_deduplicator.reserve(build_info)]
+        if len(reserved_events) < len(events):
+            self.logger.info('{} duplicated events ignored'.format(len(events) - len(reserved_events)))
+
+        try:
+            for build_info in reserved_events:
+                self.users_bot.update_running_builds(build_info)
+            notified_events = [
+                build_info for build_info in reserved_events
+                if (is_notified is None or is_notified(build_info)) and
+                not self.users_bot.is_unknown_jenkins_id(build_info.get('userId'))
+            ]
+            if notified_events:
+                queue_function(notified_events)
+        except Exception:
+            for build_info in reserved_events:
+                self.events_deduplicator.release(build_info)
+            raise
+
+        for build_info in reserved_events:
+            self.events_deduplicator.commit(build_info)
+
 
     def api_messages(self):
         """
@@ -109,7 +254,7 @@ class Bot(Flask):
 
         # answer to MS server ping request
         if request_type == 'ping':
-            self.send(conversation_id=conversation_id, message='')
+            self.delivery_queue.reply(conversation_id, '')
             self.logger.debug('Ping request received.')
             return ''
 
@@ -138,7 +283,7 @@ class Bot(Flask):
             raise Exception(e)
 
         try:
-            self.send(conversation_id=conversation_id, message=answer)
+            self.delivery_queue.reply(conversation_id, answer)
         except Exception as e:
             self.logger.exception(e)
             raise Exception(e)
@@ -164,11 +309,23 @@ class Bot(Flask):
         headers = {'Authorization': 'Bearer ' + self.get_bearer_token()}
         post_url = (self.api_url + send_url).format(conversation_id)
         try :
-            result = requests.post(url=post_url, data=json.dumps(data), headers=headers)
+            result = self.session.post(url=post_url, data=json.dumps(data), headers=headers)
+            if result.status_code == 429:
+                delay = self.rate_limiter.throttled(conversation_id, result.headers.get('Retry-After'))
+                self.logger.warning('Throttled sending to {}, retry after {}s'.format(conversation_id, delay))
             return result.status_code
         except Exception as e:
             self.logger.exception(e)
             raise Exception(e)
 
+    def get_delivery_stats(self):
+        """
+        :return: dict with queued, coalescing and deferred messages counts and rate limiter bucket levels
+        """
+        return self.delivery_queue.get_stats()
+
+    def _send_notification(self, conversation_id, message):
+        return self.send(conversation_id, message)
+
     def run(self, port=None, host=None):
         super(Bot, self).run(debug=True, port=self.bot_port, host=self.bot_host)
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+
+#===================================================================================================
+# ExpiringCache
+#===================================================================================================
+class ExpiringCache(object):
+    '''
+    Thread safe, size bounded mapping whose entries expire.
+
+    Entries are evicted in least recently used order once `max_size` is reached (or once their total
+    weight is over `max_weight`), and are dropped on access once their expiration time is over. Hits and
+    misses are counted so the cache efficiency can be checked at runtime.
+
+    :param max_size: maximum number of entries kept
+    :param ttl: default time to live of entries in seconds, None for entries that never expire
+    :param max_weight: maximum total weight of the entries, None for no limit
+    :param weigh: callable(value) returning the weight of a value, defaults to len
+    '''
+
+    def __init__(self, max_size=1024, ttl=None, max_weight=None, weigh=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at is not None and time.time() >= expires_at:
+                self._remove_weight(value)
+                self.misses += 1
+                return default
+
+            # re-insert to mark entry as the most recently used
+            self._entries[key] = value, expires_at
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value, expires_at=None):
+        '''
+        :param expires_at: absolute expiration time (as in time.time()), defaults to now + ttl
+        '''
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+
+        with self._lock:
+            self._insert(key, value, expires_at)
+
+
+    def add(self, key, value, expires_at=None):
+        '''
+        Sets the key only if it is missing (or expired).
+        :return: True if the key was set
+        '''
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or time.time() < entry[1]):
+                return False
+
+            self._insert(key, value, expires_at)
+            return True
+
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)[0]
+            except KeyError:
+                return default
+            self._remove_weight(value)
+            return value
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get_stats(self):
+        stats = {
+            'size' : len(self._entries),
+            'max_size' : self.max_size,
+            'hits' : self.hits,
+            'misses' : self.misses,
+        }
+        if self.max_weight is not None:
+            stats['weight'] = self.weight
+            stats['max_weight'] = self.max_weight
+        return stats
+
+
+    def _insert(self, key, value, expires_at):
+        try:
+            self._remove_weight(self._entries.pop(key)[0])
+        except KeyError:
+            pass
+
+        self._entries[key] = value, expires_at
+        if self.max_weight is not None:
+            self.weight += self.weigh(value)
+
+        while len(self._entries) > self.max_size or \
+                (self.max_weight is not None and self.weight > self.max_weight and len(self._entries) > 1):
+            self._remove_weight(self._entries.popitem(last=False)[1][0])
+
+
+    def _remove_weight(self, value):
+        if self.max_weight is not None:
+            self.weight -= self.weigh(value)
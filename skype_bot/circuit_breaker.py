@@ -0,0 +1,141 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+failure_threshold = 5
+reset_timeout = 30.0
+max_concurrent_calls = 8
+bulkhead_timeout = 1.0
+
+
+class ServiceUnavailableError(Exception):
+    '''
+    A call was rejected without reaching the service.
+    '''
+
+
+class CircuitOpenError(ServiceUnavailableError):
+    pass
+
+
+class BulkheadFullError(ServiceUnavailableError):
+    pass
+
+
+#===================================================================================================
+# CircuitBreaker
+#===================================================================================================
+class CircuitBreaker(object):
+    '''
+    Rejects the calls to a service after `failure_threshold` consecutive failures, for `reset_timeout`
+    seconds. After that a single trial call is let through: the circuit closes if it succeeds, and opens
+    again otherwise. A trial call whose outcome is still unknown after `reset_timeout` seconds is given up,
+    and another one is let through.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=failure_threshold, reset_timeout=reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+
+    def before_call(self):
+        '''
+        :raise CircuitOpenError: if the call must not be done
+        '''
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.time()
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_started_at = now
+                return
+            if self.state == self.HALF_OPEN and now - self.trial_started_at >= self.reset_timeout:
+                self.trial_started_at = now
+                return
+            raise CircuitOpenError('{} is unavailable'.format(self.name))
+
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info('{}: circuit closed'.format(self.name))
+            self.state = self.CLOSED
+            self.failures = 0
+
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning('{}: circuit opened after {} failures'.format(self.name, self.failures))
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+    def record_cancelled(self):
+        '''
+        The call let through could not be done, e.g. rejected by a bulkhead: another call can be tried.
+        '''
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+    def is_open(self):
+        return self.state != self.CLOSED
+
+
+#===================================================================================================
+# Bulkhead
+#===================================================================================================
+class Bulkhead(object):
+    '''
+    Limits the number of concurrent calls to a service, so that a slow service can't hold all the
+    threads. Calls wait at most `timeout` seconds for a slot.
+
+    Used as a context manager around the calls.
+    '''
+
+    def __init__(self, name, max_concurrent_calls=max_concurrent_calls, timeout=bulkhead_timeout):
+        self.name = name
+        self.max_concurrent_calls = max_concurrent_calls
+        self.timeout = timeout
+
+        self.active_calls = 0
+        self._condition = threading.Condition()
+
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        with self._condition:
+            while self.active_calls >= self.max_concurrent_calls:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise BulkheadFullError('{}: too many concurrent calls'.format(self.name))
+                self._condition.wait(remaining)
+            self.active_calls += 1
+        return self
+
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.active_calls -= 1
+            self._condition.notify()
@@ -0,0 +1,146 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from skype_bot.cache import ExpiringCache
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+events_ttl = 60 * 60
+max_events = 10000
+
+# an event reserved by a handler which didn't commit nor release it in time can be handled again
+reservation_timeout = 5 * 60
+
+
+def get_event_key(build_info):
+    '''
+    :return: key identifying a job event, None if the event can't be identified
+    '''
+    number = build_info.get('number')
+    if number is None:
+        return None
+    return '{}|{}|{}'.format(build_info.get('event'), build_info.get('job_name'), number)
+
+
+#===================================================================================================
+# EventsDeduplicator
+#===================================================================================================
+class EventsDeduplicator(object):
+    '''
+    Remembers the job events handled in the last `ttl` seconds (up to `max_size` events), so that webhooks
+    repeated by Jenkins are handled only once.
+
+    A handler `reserve`s an event before handling it, then `commit`s it once handled, or `release`s it if
+    it failed, so that Jenkins can retry it.
+    '''
+
+    RESERVED = 'reserved'
+    HANDLED = 'handled'
+
+    def __init__(self, ttl=events_ttl, max_size=max_events, reservation_timeout=reservation_timeout):
+        self.ttl = ttl
+        self.reservation_timeout = reservation_timeout
+        self._seen_events = ExpiringCache(max_size=max_size, ttl=ttl)
+
+
+    def reserve(self, build_info):
+        '''
+        :param build_info: job event parameters, with event, job_name and number
+        :return: False if the event is a duplicate, handled or being handled
+        '''
+        event_key = get_event_key(build_info)
+        if event_key is None:
+            return True
+        return self._seen_events.add(event_key, self.RESERVED, expires_at=time.time() + self.reservation_timeout)
+
+
+    def commit(self, build_info):
+        '''
+        Marks a reserved event as handled.
+        '''
+        event_key = get_event_key(build_info)
+        if event_key is not None:
+            self._seen_events.set(event_key, self.HANDLED)
+
+
+    def release(self, build_info):
+        '''
+        Forgets a reserved event, so that it can be handled again.
+        '''
+        event_key = get_event_key(build_info)
+        if event_key is not None:
+            self._seen_events.pop(event_key)
+
+
+#===================================================================================================
+# MongoEventsDeduplicator
+#===================================================================================================
+class MongoEventsDeduplicator(EventsDeduplicator):
+    '''
+    Same as EventsDeduplicator, also recording events in a MongoDB collection so that events are handled once
+    across several bot processes. Recorded events are removed by MongoDB after `ttl` seconds, reservations
+    of a process which stopped can be taken over after `reservation_timeout` seconds.
+
+    :param collection: pymongo collection
+    '''
+
+    def __init__(self, collection, ttl=events_ttl, max_size=max_events, reservation_timeout=reservation_timeout):
+        super(MongoEventsDeduplicator, self).__init__(ttl, max_size, reservation_timeout)
+        self.collection = collection
+        self.collection.create_index('created_at', expireAfterSeconds=ttl)
+
+
+    def reserve(self, build_info):
+        from pymongo.errors import DuplicateKeyError
+
+        if not super(MongoEventsDeduplicator, self).reserve(build_info):
+            return False
+
+        event_key = get_event_key(build_info)
+        if event_key is None:
+            return True
+
+        now = datetime.utcnow()
+        reservation = {'created_at' : now, 'reserved_until' : now + timedelta(seconds=self.reservation_timeout)}
+        try:
+            self.collection.insert_one(dict(reservation, _id=event_key))
+        except DuplicateKeyError:
+            # handled (reserved_until is None), or reserved by another process
+            taken_over = self.collection.find_one_and_update(
+                {'_id' : event_key, 'reserved_until' : {'$lt' : now}}, {'$set' : reservation})
+            if taken_over is None:
+                super(MongoEventsDeduplicator, self).release(build_info)
+                return False
+        except Exception as e:
+            # better to notify twice than not at all
+            logger.exception(e)
+        return True
+
+
+    def commit(self, build_info):
+        super(MongoEventsDeduplicator, self).commit(build_info)
+
+        event_key = get_event_key(build_info)
+        if event_key is None:
+            return
+        try:
+            self.collection.update_one(
+                {'_id' : event_key}, {'$set' : {'created_at' : datetime.utcnow(), 'reserved_until' : None}})
+        except Exception as e:
+            logger.exception(e)
+
+
+    def release(self, build_info):
+        super(MongoEventsDeduplicator, self).release(build_info)
+
+        event_key = get_event_key(build_info)
+        if event_key is None:
+            return
+        try:
+            self.collection.delete_one({'_id' : event_key, 'reserved_until' : {'$ne' : None}})
+        except Exception as e:
+            logger.exception(e)
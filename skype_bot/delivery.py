@@ -0,0 +1,519 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+delivery_workers = 2
+enrichment_workers = 1
+max_retries = 5
+retry_delay = 1.0
+max_retry_delay = 60.0
+max_deferrals = 30
+max_reply_wait = 5.0
+replay_interval = 60.0
+coalesce_window = 1.0
+max_message_size = 4000
+
+# between the messages merged into one
+MESSAGES_SEPARATOR = '\n\n'
+
+
+def is_retriable_status(status_code):
+    '''
+    Throttled (429) and server errors (5xx) are worth retrying, any other status is final.
+    '''
+    return status_code == 429 or status_code >= 500
+
+
+#===================================================================================================
+# DeliveryQueue
+#===================================================================================================
+class DeliveryQueue(object):
+    '''
+    Delivers notifications from a pool of worker threads, so that webhooks return immediately.
+
+    A notification is given as a render function returning a (conversation_id, message) tuple, which is
+    called from a worker, and then sent with `send_function(conversation_id, message)`. Sends failing with
+    an exception or a retriable HTTP status are retried with exponential backoff.
+
+    Messages rendered for the same conversation within `coalesce_window` seconds are merged into one
+    message of at most `max_message_size` characters (a single bigger message is sent alone), so that
+    bursts of notifications don't turn into bursts of API calls.
+
+    Given a `rate_limiter`, sends are deferred until it has a token for the conversation, and throttled
+    sends (429) are deferred for as long as the rate limiter blocks the conversation, without counting
+    them as failed attempts. A message deferred more than `max_deferrals` times is dropped (and left in
+    the outbox).
+
+    Given an `outbox`, notifications are appended to it before being queued (as render tasks, rendered
+    again on replay by the render function registered under the same name) and acknowledged once all
+    their messages are sent (or rejected for good), so that `replay` can deliver again what was left
+    undelivered by a previous run, or by another process.
+
+    A notification can have a follow up, rendered by other workers (`enrichment_workers`) since it can
+    take a while to collect, so that it doesn't hold the delivery workers. The follow up is sent once the
+    notification is sent.
+
+    With no workers notifications (or follow ups) are rendered and sent in the caller thread.
+
+    :param send_function: callable(conversation_id, message) returning the HTTP status code
+    '''
+
+    def __init__(self, send_function, workers=delivery_workers, max_retries=max_retries,
+                 retry_delay=retry_delay, max_retry_delay=max_retry_delay,
+                 coalesce_window=coalesce_window, max_message_size=max_message_size, rate_limiter=None,
+                 outbox=None, max_deferrals=max_deferrals, max_reply_wait=max_reply_wait,
+                 enrichment_workers=enrichment_workers):
+        self.send_function = send_function
+        self.max_retries = max_retries
+        self.max_deferrals = max_deferrals
+        self.max_reply_wait = max_reply_wait
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.coalesce_window = coalesce_window
+        self.max_message_size = max_message_size
+        self.rate_limiter = rate_limiter
+        self.outbox = outbox
+
+        # messages waiting for the rate limiter
+        self.deferred_messages = 0
+        self._deferred_lock = threading.Lock()
+
+        # messages waiting for the coalesce window to finish, by conversation
+        self._pending_messages = {}
+        self._pending_lock = threading.Lock()
+
+        # render functions of the tasks stored in the outbox, by name
+        self._renderers = {}
+        self._stop_replayer = threading.Event()
+
+        self._queue = Queue.Queue()
+        self._workers = self._start_workers(self._queue, workers, 'delivery')
+
+        self._enrichment_queue = Queue.Queue()
+        self._enrichment_workers = self._start_workers(self._enrichment_queue, enrichment_workers, 'enrichment')
+
+
+    def register(self, render_function, name=None):
+        '''
+        Registers the render function of the tasks stored in the outbox under the given name (its
+        function name by default), to render them again on replay.
+        '''
+        self._renderers[name or render_function.__name__] = render_function
+
+
+    def put(self, render_function, *args, **kwargs):
+        '''
+        Queues the notification rendered by `render_function(*args)`.
+
+        :param follow_up: render function called with the same arguments by the enrichment workers,
+            returning a list of (conversation_id, message) tuples sent after the notification
+        :raise: if the notification can't be stored in the outbox
+        '''
+        self._put_task(_Task(render_function, args, follow_up=kwargs.get('follow_up')))
+
+
+    def put_batch(self, render_function, *args, **kwargs):
+        '''
+        Queues the notifications rendered by `render_function(*args)`, returning a list of
+        (conversation_id, message) tuples.
+
+        :param follow_up: same as for `put`
+        :raise: if the notifications can't be stored in the outbox
+        '''
+        self._put_task(_Task(render_function, args, batch=True, follow_up=kwargs.get('follow_up')))
+
+
+    def deliver(self, conversation_id, message):
+        '''
+        Queues an already rendered message.
+        '''
+        entry_id = None
+        if self.outbox is not None and conversation_id is not None:
+            try:
+                entry_id = self.outbox.append(conversation_id, message)
+            except Exception as e:
+                logger.exception(e)
+        self._put(self._coalesce, conversation_id, message, [self._get_receipt(entry_id)])
+
+
+    def reply(self, conversation_id, message):
+        '''
+        Sends a message right away from the caller thread, as an answer to a chat message, waiting at most
+        `max_reply_wait` seconds for the rate limiter. Messages the rate limiter holds longer are queued.
+
+        :return: the HTTP status code, None if queued
+        '''
+        if self.rate_limiter is not None:
+            deadline = time.time() + self.max_reply_wait
+            delay = self.rate_limiter.acquire(conversation_id)
+            while delay > 0:
+                if time.time() + delay > deadline:
+                    logger.debug('Reply to {} rate limited, queued'.format(conversation_id))
+                    self.deliver(conversation_id, message)
+                    return None
+                time.sleep(delay)
+                delay = self.rate_limiter.acquire(conversation_id)
+
+        return self.send_function(conversation_id, message)
+
+
+    def replay(self):
+        '''
+        Queues the notifications left undelivered in the outbox, and not claimed by another process.
+        '''
+        if self.outbox is None:
+            return
+
+        count = 0
+        for entry in self.outbox.claim_undelivered():
+            if 'render' not in entry:
+                self._put(self._coalesce, entry['conversation_id'], entry['message'],
+                          [self._get_receipt(entry['_id'])])
+                count += 1
+                continue
+
+            render_function = self._renderers.get(entry['render'])
+            follow_up = self._renderers.get(entry.get('follow_up'))
+            if render_function is None or (entry.get('follow_up') is not None and follow_up is None):
+                logger.error('No render function {} to replay {}'.format(entry['render'], entry['_id']))
+                continue
+            self._put(self._render_task,
+                      _Task(render_function, entry['args'], entry['batch'], follow_up, entry['_id']))
+            count += 1
+        if count:
+            logger.info('Replaying {} undelivered notifications'.format(count))
+
+
+    def start_replayer(self, interval=replay_interval):
+        '''
+        Starts a daemon thread replaying the outbox every `interval` seconds, to deliver the
+        notifications of the processes which stopped before delivering them.
+        '''
+        if self.outbox is None:
+            return
+
+        self._stop_replayer.clear()
+        replayer = threading.Thread(target=self._run_replayer, args=(interval,), name='delivery-replayer')
+        replayer.daemon = True
+        replayer.start()
+
+
+    def stop_replayer(self):
+        self._stop_replayer.set()
+
+
+    def join(self):
+        '''
+        Blocks until all queued tasks are done (retries scheduled for later are not waited).
+        '''
+        self._queue.join()
+        self._enrichment_queue.join()
+        self._queue.join()
+
+
+    def get_stats(self):
+        stats = {
+            'queued' : self._queue.qsize(),
+            'enriching' : self._enrichment_queue.qsize(),
+            'coalescing' : len(self._pending_messages),
+            'deferred' : self.deferred_messages,
+        }
+        if self.rate_limiter is not None:
+            stats['rate_limiter'] = self.rate_limiter.get_stats()
+        return stats
+
+
+    def _run_replayer(self, interval):
+        while not self._stop_replayer.wait(interval):
+            try:
+                self.replay()
+            except Exception as e:
+                logger.exception(e)
+
+
+    def _start_workers(self, queue, count, name):
+        workers = []
+        for i in range(count):
+            worker = threading.Thread(target=self._run_worker, args=(queue,), name='{}-{}'.format(name, i))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+
+    def _put_task(self, task):
+        if self.outbox is not None:
+            follow_up_name = None
+            if task.follow_up is not None:
+                follow_up_name = self._get_renderer_name(task.follow_up)
+            task.entry_id = self.outbox.append_task(
+                self._get_renderer_name(task.render_function), task.args, task.batch, follow_up_name)
+        self._put(self._render_task, task)
+
+
+    def _get_renderer_name(self, render_function):
+        name = render_function.__name__
+        self._renderers.setdefault(name, render_function)
+        return name
+
+
+    def _put(self, function, *args):
+        if self._workers:
+            self._queue.put((function, args))
+        else:
+            self._run_task(function, args)
+
+
+    def _put_enrichment(self, function, *args):
+        if self._enrichment_workers:
+            self._enrichment_queue.put((function, args))
+        else:
+            self._run_task(function, args)
+
+
+    def _schedule(self, delay, function, *args):
+        timer = threading.Timer(delay, self._put, (function,) + args)
+        timer.daemon = True
+        timer.start()
+
+
+    def _run_worker(self, queue):
+        while True:
+            function, args = queue.get()
+            try:
+                self._run_task(function, args)
+            finally:
+                queue.task_done()
+
+
+    def _run_task(self, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            logger.exception(e)
+
+
+    def _render_task(self, task):
+        # on failure the task is left in the outbox, for the next replay
+        messages = task.render()
+        if task.follow_up is None:
+            self._deliver_all(messages, lambda delivered: self._ack(task.entry_id, delivered))
+            return
+
+        # the follow up is sent once the messages are sent and the follow up is rendered
+        follow_up_messages = []
+
+        def deliver_follow_up(delivered):
+            self._deliver_all(follow_up_messages,
+                              lambda follow_up_delivered: self._ack(task.entry_id, delivered and follow_up_delivered))
+
+        ready = _Countdown(2, deliver_follow_up)
+        self._deliver_all(messages, ready.done)
+        self._put_enrichment(self._render_follow_up, task, follow_up_messages, ready)
+
+
+    def _render_follow_up(self, task, follow_up_messages, ready):
+        try:
+            follow_up_messages.extend(task.follow_up(*task.args))
+        except Exception as e:
+            logger.exception(e)
+            ready.done(False)
+        else:
+            ready.done()
+
+
+    def _deliver_all(self, messages, callback):
+        '''
+        Coalesces the given messages, calling `callback(delivered)` once they are all sent.
+        '''
+        receipt = _Countdown(len(messages) + 1, callback)
+        for conversation_id, message in messages:
+            self._coalesce(conversation_id, message, [receipt])
+        receipt.done()
+
+
+    def _get_receipt(self, entry_id):
+        return _Countdown(1, lambda delivered: self._ack(entry_id, delivered))
+
+
+    def _ack(self, entry_id, delivered):
+        if self.outbox is None or entry_id is None:
+            return
+        if delivered:
+            self.outbox.ack([entry_id])
+        else:
+            logger.warning('Outbox entry {} left undelivered'.format(entry_id))
+
+
+    def _coalesce(self, conversation_id, message, receipts):
+        if self.coalesce_window <= 0 or conversation_id is None or message is None:
+            self._send(conversation_id, message, 0, receipts)
+            return
+
+        full_pending = None
+        with self._pending_lock:
+            pending = self._pending_messages.get(conversation_id)
+            if pending is not None:
+                pending_size = sum(len(m) + len(MESSAGES_SEPARATOR) for m in pending.messages)
+                if pending_size + len(message) <= self.max_message_size:
+                    pending.add(message, receipts)
+                    return
+
+                # full: what is pending is sent now, the new message waits for a new window
+                full_pending = self._pending_messages.pop(conversation_id)
+
+            pending = self._pending_messages[conversation_id] = _PendingMessages()
+            pending.add(message, receipts)
+
+        if full_pending is not None:
+            self._put(self._send, conversation_id, full_pending.get_message(), 0, full_pending.receipts)
+        self._schedule(self.coalesce_window, self._flush, conversation_id, pending)
+
+
+    def _flush(self, conversation_id, pending):
+        with self._pending_lock:
+            # already flushed for being full
+            if self._pending_messages.get(conversation_id) is not pending:
+                return
+            del self._pending_messages[conversation_id]
+
+        self._send(conversation_id, pending.get_message(), 0, pending.receipts)
+
+
+    def _defer(self, delay, conversation_id, message, attempt, receipts, deferrals):
+        if deferrals >= self.max_deferrals:
+            # left in the outbox for the next replay
+            logger.error('Message to {} dropped after being deferred {} times'.format(conversation_id, deferrals))
+            self._done(receipts, False)
+            return
+
+        with self._deferred_lock:
+            self.deferred_messages += 1
+        self._schedule(delay, self._send_deferred, conversation_id, message, attempt, receipts, deferrals + 1)
+
+
+    def _send_deferred(self, conversation_id, message, attempt, receipts, deferrals):
+        with self._deferred_lock:
+            self.deferred_messages -= 1
+        self._send(conversation_id, message, attempt, receipts, deferrals)
+
+
+    def _done(self, receipts, delivered):
+        for receipt in receipts:
+            receipt.done(delivered)
+
+
+    def _send(self, conversation_id, message, attempt, receipts=(), deferrals=0):
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.acquire(conversation_id)
+            if delay > 0:
+                self._defer(delay, conversation_id, message, attempt, receipts, deferrals)
+                return
+
+        try:
+            status_code = self.send_function(conversation_id, message)
+        except Exception as e:
+            logger.exception(e)
+            status_code = None
+
+        if status_code == 429 and self.rate_limiter is not None:
+            delay = self.rate_limiter.get_delay(conversation_id) or self.retry_delay
+            logger.debug('Message to {} throttled, deferred for {}s'.format(conversation_id, delay))
+            self._defer(delay, conversation_id, message, attempt, receipts, deferrals)
+            return
+
+        if status_code is not None and not is_retriable_status(status_code):
+            self._done(receipts, True)
+            return
+
+        if attempt >= self.max_retries:
+            # left in the outbox for the next replay
+            logger.error('Message to {} dropped after {} attempts: {}'.format(conversation_id, attempt + 1, status_code))
+            self._done(receipts, False)
+            return
+
+        delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+        logger.debug('Retrying message to {} in {}s: {}'.format(conversation_id, delay, status_code))
+        self._schedule(delay, self._send, conversation_id, message, attempt + 1, receipts, deferrals)
+
+
+#===================================================================================================
+# _Task
+#===================================================================================================
+class _Task(object):
+    '''
+    Notification to render, with its follow up and its outbox entry.
+    '''
+
+    def __init__(self, render_function, args, batch=False, follow_up=None, entry_id=None):
+        self.render_function = render_function
+        self.args = tuple(args)
+        self.batch = batch
+        self.follow_up = follow_up
+        self.entry_id = entry_id
+
+
+    def render(self):
+        '''
+        :return: list of (conversation_id, message)
+        '''
+        if self.batch:
+            return list(self.render_function(*self.args))
+
+        conversation_id, message = self.render_function(*self.args)
+        # nobody to notify
+        if conversation_id is None:
+            return []
+        return [(conversation_id, message)]
+
+
+#===================================================================================================
+# _Countdown
+#===================================================================================================
+class _Countdown(object):
+    '''
+    Calls `callback(delivered)` once `done` was called `count` times, delivered if no call failed.
+    '''
+
+    def __init__(self, count, callback):
+        self.count = count
+        self.callback = callback
+        self.delivered = True
+        self._lock = threading.Lock()
+
+
+    def done(self, delivered=True):
+        with self._lock:
+            self.delivered = self.delivered and delivered
+            self.count -= 1
+            if self.count > 0:
+                return
+        self.callback(self.delivered)
+
+
+#===================================================================================================
+# _PendingMessages
+#===================================================================================================
+class _PendingMessages(object):
+    '''
+    Messages of a conversation waiting to be merged, with their receipts.
+    '''
+
+    def __init__(self):
+        self.messages = []
+        self.receipts = []
+
+
+    def add(self, message, receipts):
+        self.messages.append(message)
+        self.receipts.extend(receipts)
+
+
+    def get_message(self):
+        return MESSAGES_SEPARATOR.join(self.messages)
@@ -0,0 +1,54 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# default values, can be overriden in config
+pool_connections = 4
+pool_maxsize = 16
+connect_timeout = 5.0
+read_timeout = 30.0
+
+
+#===================================================================================================
+# TimeoutSession
+#===================================================================================================
+class TimeoutSession(requests.Session):
+    '''
+    Session applying a default (connect, read) timeout to requests not giving their own.
+    '''
+
+    def __init__(self, timeout):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+#===================================================================================================
+# create_session
+#===================================================================================================
+def create_session(http_config=None):
+    '''
+    Creates a keep-alive session with a pool of connections per host, shared by all outbound calls.
+
+    :param http_config: dict with optional pool_connections, pool_maxsize, connect_timeout and read_timeout
+    :return: TimeoutSession
+    '''
+    http_config = http_config or {}
+
+    session = TimeoutSession(timeout=(
+        http_config.get('connect_timeout', connect_timeout),
+        http_config.get('read_timeout', read_timeout),
+    ))
+
+    adapter = HTTPAdapter(
+        pool_connections=http_config.get('pool_connections', pool_connections),
+        pool_maxsize=http_config.get('pool_maxsize', pool_maxsize),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -1,89 +1,280 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+import threading
+import time
 import urllib
+import urlparse
 
 import requests
 import logging
+from contextlib import contextmanager
+
+from skype_bot import circuit_breaker
+from skype_bot.cache import ExpiringCache
+from skype_bot.circuit_breaker import Bulkhead, CircuitBreaker, ServiceUnavailableError
+from skype_bot.http_session import create_session
 
 logger = logging.getLogger(__name__)
 
 
 FAIL_TO_RETRIEVE = -1, 'Unable to retrieve jenkins data!'
 
+# default limits of test reports requests, can be overriden in config
+test_report_timeout = 30
+test_report_max_size = 5 * 1024 * 1024
+
+# default timeouts of Jenkins requests, can be overriden in config
+connect_timeout = 5.0
+read_timeout = 30.0
+
+# jobs parameter definitions are cached for this many seconds
+parameter_definitions_ttl = 60 * 60
+parameter_definitions_max_size = 10000
+
+# maximum number of Jenkins urls whose clients are kept
+max_clients = 16
+
+
+# default timeouts of the requests to each kind of Jenkins endpoint, can be overriden in the
+# 'timeouts' of the jenkins config, others use connect_timeout and read_timeout. Timeouts are given in
+# seconds, either as a [connect, read] pair (e.g. `jobs: [5, 60]`) or as a single number for both
+endpoint_timeouts = {
+    # list of all the jobs, can be big
+    'jobs' : (connect_timeout, 60.0),
+    'building_jobs' : (connect_timeout, 10.0),
+    'job' : (connect_timeout, 10.0),
+    'trigger' : (connect_timeout, 10.0),
+}
+
+
 #===================================================================================================
-#
+# JenkinsClient
 #===================================================================================================
-def get_job_url(job_name, config):
-    return config['url'] + 'job/' + job_name
+class JenkinsClient(object):
+    '''
+    Client of the Jenkins JSON API of a given url, sending all its requests through a pooled keep-alive
+    session. The session is shared by all the users of the url: their credentials are given with each
+    request.
 
-def get_jenkins_config(config):
-    return config['url'], config['user'], config['token']
+    Requests go through the `circuit_breaker` and the `bulkhead` of the Jenkins instance, if given, so
+    that they fail fast while Jenkins is unhealthy and can't hold more than a few threads.
+
+    :param config: jenkins config, with url, and optional timeouts and pool sizes (see
+        http_session.create_session)
+    '''
+
+    def __init__(self, config, circuit_breaker=None, bulkhead=None):
+        self.url = config['url']
+        self.circuit_breaker = circuit_breaker
+        self.bulkhead = bulkhead
+
+        self.timeouts = dict(endpoint_timeouts)
+        for endpoint, timeout in config.get('timeouts', {}).items():
+            # pairs read from YAML are lists, requests only accepts tuples
+            self.timeouts[endpoint] = tuple(timeout) if isinstance(timeout, list) else timeout
+
+        self.session = create_session({
+            'connect_timeout' : config.get('connect_timeout', connect_timeout),
+            'read_timeout' : config.get('read_timeout', read_timeout),
+            'pool_connections' : config.get('pool_connections', 1),
+            'pool_maxsize' : config.get('pool_maxsize', 4),
+        })
+        self.session.headers['Accept-Encoding'] = 'gzip'
+
+
+    def request(self, method, query_url, endpoint=None, **kwargs):
+        '''
+        :param endpoint: kind of endpoint queried, selecting the timeout of the request
+        :param kwargs: arguments of requests.Session.request, e.g. the auth of the user
+        :return: the response of the given query, relative to the jenkins url
+        :raise requests.RequestException:
+        :raise ServiceUnavailableError: if the request was rejected by the circuit breaker or the bulkhead
+        '''
+        with self.open_response(method, query_url, endpoint, **kwargs) as response:
+            return response
+
+
+    @contextmanager
+    def open_response(self, method, query_url, endpoint=None, **kwargs):
+        '''
+        Same as `request`, as a context manager giving the response to its block and closing it
+        afterwards.
+
+        The slot of the bulkhead is held until the block exits, and the outcome of the request is only
+        recorded then, so that the content of a streamed response is read within the limits of the
+        bulkhead, and failures to read it open the circuit. Any exception raised by the block counts as a
+        failure.
+        '''
+        if 'timeout' not in kwargs and endpoint in self.timeouts:
+            kwargs['timeout'] = self.timeouts[endpoint]
+
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.before_call()
+
+        success = False
+        try:
+            with self.bulkhead if self.bulkhead is not None else _no_bulkhead():
+                response = self.session.request(method, self.url + query_url, **kwargs)
+                try:
+                    yield response
+                finally:
+                    response.close()
+            success = response.status_code < 500
+        except ServiceUnavailableError:
+            # no answer from Jenkins: let a half open circuit try again
+            success = None
+            raise
+        finally:
+            self._record_result(success)
+
+
+    def get(self, query_url, endpoint=None, **kwargs):
+        return self.request('GET', query_url, endpoint, **kwargs)
+
+
+    def get_json(self, query_url, endpoint=None, timeout=None, auth=None):
+        '''
+        :return: the parsed JSON response, {} if not JSON, None if the request failed
+        '''
+        try:
+            response = self.get(query_url, endpoint, auth=auth, **self._get_timeout_kwargs(timeout))
+        except (requests.RequestException, ServiceUnavailableError) as e:
+            logger.debug('Failed to request {}: {}'.format(query_url, e))
+            return None
+        return parse_json_response(response)
+
+
+    def post(self, query_url, endpoint='trigger', timeout=None, auth=None):
+        '''
+        :return: True if the request succeeded
+        '''
+        try:
+            response = self.request('POST', query_url, endpoint, auth=auth, **self._get_timeout_kwargs(timeout))
+        except (requests.RequestException, ServiceUnavailableError) as e:
+            logger.debug('Failed to post {}: {}'.format(query_url, e))
+            return False
+
+        logger.debug('post_jenkins_json_request: {} = {}' .format(query_url, response.status_code))
+        return response.status_code in (200, 201)
+
+
+    def is_available(self):
+        '''
+        :return: False while the circuit breaker rejects requests
+        '''
+        return self.circuit_breaker is None or not self.circuit_breaker.is_open()
+
+
+    def _get_timeout_kwargs(self, timeout):
+        # the endpoint (or session) timeout applies when none is given
+        return {} if timeout is None else {'timeout' : timeout}
+
+
+    def _record_result(self, success):
+        if self.circuit_breaker is None:
+            return
+        if success is None:
+            self.circuit_breaker.record_cancelled()
+        elif success:
+            self.circuit_breaker.record_success()
+        else:
+            self.circuit_breaker.record_failure()
 
 
-def get_job_parameters(job_name, config):
-    jenkins_url, user, token = get_jenkins_config(config)
+@contextmanager
+def _no_bulkhead():
+    yield
 
-    url = jenkins_url + 'job/' + job_name + \
-        '/api/json?pretty=true&tree=actions[parameterDefinitions[name]]'
 
-    r = requests.get(url, auth=(user, token))
-    if r.status_code != 200:
+def parse_json_response(response):
+    '''
+    :return: the parsed JSON of a Jenkins response, {} if not JSON, None if the request failed
+    '''
+    if response.status_code not in [200, 201]:
         return None
 
     try:
-        result = json.loads(r.text)
-    except:
-        return None
+        return json.loads(response.text)
+    except ValueError:
+        return {}
 
-    actions = result.get('actions')
-    if actions:
-        for action in actions:
-            parameterDefinitions = action.get('parameterDefinitions')
-            if parameterDefinitions:
-                params = []
-                for param in parameterDefinitions:
-                    params.append(param['name'])
-                return params
 
-    return []
+# clients of each Jenkins url, with their circuit breaker and bulkhead
+_clients = ExpiringCache(max_size=max_clients)
+_clients_lock = threading.Lock()
+
+def get_client(config):
+    '''
+    :return: the JenkinsClient shared by the calls for the url of the given config
+    '''
+    with _clients_lock:
+        client = _clients.get(config['url'])
+        if client is None:
+            client = JenkinsClient(config, *_get_guards(config))
+            _clients.set(config['url'], client)
+        return client
+
+
+def _get_guards(config):
+    circuit_breaker_config = config.get('circuit_breaker', {})
+    return (
+        CircuitBreaker(
+            'jenkins',
+            failure_threshold=circuit_breaker_config.get('failure_threshold', circuit_breaker.failure_threshold),
+            reset_timeout=circuit_breaker_config.get('reset_timeout', circuit_breaker.reset_timeout),
+        ),
+        Bulkhead(
+            'jenkins',
+            max_concurrent_calls=config.get('max_concurrent_calls', circuit_breaker.max_concurrent_calls),
+            timeout=config.get('bulkhead_timeout', circuit_breaker.bulkhead_timeout),
+        ),
+    )
+
+
+def get_auth(config):
+    '''
+    :return: the credentials of the user of the given config, given with each request
+    '''
+    user = config.get('user')
+    return (user, config.get('token')) if user is not None else None
 
 
-def get_jenkins_json_request(query_url, config):
+def is_jenkins_available(config):
     '''
-    returns None if fails to request
+    :return: False while requests to the Jenkins of the config fail fast
     '''
-    jenkins_url, user, token = get_jenkins_config(config)
+    return get_client(config).is_available()
 
-    url = jenkins_url + query_url
 
-    r = requests.get(url, auth=(user, token))
-    if r.status_code not in [200, 201]:
-        return None
+#===================================================================================================
+#
+#===================================================================================================
+def get_job_url(job_name, config):
+    return config['url'] + 'job/' + job_name
 
-    try:
-        return json.loads(r.text)
-    except:
-        return {}
+def get_jenkins_config(config):
+    return config['url'], config['user'], config['token']
 
 
-def post_jenkins_json_request(query_url, config):
-    jenkins_url, user, token = get_jenkins_config(config)
+def get_jenkins_json_request(query_url, config, endpoint=None):
+    '''
+    returns None if fails to request
+    '''
+    return get_client(config).get_json(query_url, endpoint, auth=get_auth(config))
 
-    url = jenkins_url + query_url
 
-    r = requests.post(url, auth=(user, token))
-    logger.debug('post_jenkins_json_request: {} = {}' .format(query_url, r.status_code))
-    return r.status_code in (200, 201)
+def post_jenkins_json_request(query_url, config):
+    return get_client(config).post(query_url, auth=get_auth(config))
 
 
 def get_build_parameters(job_name, build_number, config):
     if build_number is None:
         build_number = 'lastBuild'
 
-    query = 'job/{}/{}/api/json?pretty=true&tree=actions[parameters[name,value]]'.format(job_name, build_number)
+    query = 'job/{}/{}/api/json?tree=actions[parameters[name,value]]'.format(job_name, build_number)
 
-    json_result = get_jenkins_json_request(query, config)
+    json_result = get_jenkins_json_request(query, config, 'job')
     if json_result is None:
         return None
 
@@ -111,13 +302,13 @@ def get_last_build_info(job_name, config):
     }
     '''
     build_number = 'lastBuild'
-    query = 'job/{}/{}/api/json?pretty=true&tree=building,number'.format(job_name, build_number)
+    query = 'job/{}/{}/api/json?tree=building,number'.format(job_name, build_number)
 
-    return get_jenkins_json_request(query, config)
+    return get_jenkins_json_request(query, config, 'job')
 
 
 def list_jobs(config):
-    result = get_jenkins_json_request('api/json?pretty=true&tree=jobs[fullName]', config)
+    result = get_jenkins_json_request('api/json?tree=jobs[fullName]', config, 'jobs')
 
     if result is None or 'jobs' not in result:
         return []
@@ -126,52 +317,102 @@ def list_jobs(config):
 
 
 def rebuild_job(job_name, config):
-    parameters = get_build_parameters(job_name, None, config)
-    if parameters is None:
-        return FAIL_TO_RETRIEVE
+    '''
+    Triggers a build of the job with the parameters of its last build.
+    '''
+    return trigger_build(job_name, config, 'Rebuild triggered: {}')
 
-    if len(parameters) > 0:
-        post_url = 'job/{}/buildWithParameters?{}'.format(job_name, urllib.urlencode(parameters))
-    else:
-        post_url = 'job/{}/build'.format(job_name)
 
-    if post_jenkins_json_request(post_url, config):
-        return 0, 'Rebuild triggered: {}'.format(job_name)
-    else:
-        return FAIL_TO_RETRIEVE
+def build_job(job_name, config):
+    '''
+    Triggers a build of the job, with the parameters of its last build if any, or else the default ones.
+    '''
+    return trigger_build(job_name, config, 'Build triggered: {}')
+
+
+# (parameter definitions, number of the last build when they were requested) of the jobs, by (jenkins
+# url, job name)
+_parameter_definitions = ExpiringCache(max_size=parameter_definitions_max_size, ttl=parameter_definitions_ttl)
+
+LAST_BUILD_PARAMETERS_TREE = 'lastBuild[number,actions[parameters[name,value]]]'
+PARAMETER_DEFINITIONS_TREE = 'property[parameterDefinitions[name]],actions[parameterDefinitions[name]]'
 
 
-def get_builds(job_name, config):
-    result = get_jenkins_json_request('job/{}/api/json?pretty=true&tree=builds[number]'.format(job_name), config)
-    if result is None or 'builds' not in result:
+def get_build_metadata(job_name, config):
+    '''
+    Gets what is needed to trigger a build of the job in a single request, the parameter definitions
+    being only requested when not cached, or when a build newer than the cached ones has a parameter
+    they don't define (i.e. a parameter was added to the job).
+
+    :return: dict with 'parameters' (values of the last build, for the parameters still defined) and
+        'parameter_definitions' (names), or None if the request failed
+    '''
+    key = config['url'], job_name
+    cached = _parameter_definitions.get(key)
+
+    result = _get_job_metadata(job_name, config, with_definitions=cached is None)
+    if result is not None and cached is not None:
+        parameter_definitions, build_number = cached
+        last_build_number = (result.get('lastBuild') or {}).get('number')
+        if last_build_number > build_number and any(
+                name not in parameter_definitions for name, _ in _get_last_build_parameters(result)):
+            cached = None
+            result = _get_job_metadata(job_name, config, with_definitions=True)
+    if result is None:
         return None
 
-    return result['builds']
+    if cached is None:
+        parameter_definitions = []
+        for item in (result.get('property') or []) + (result.get('actions') or []):
+            for definition in (item or {}).get('parameterDefinitions') or []:
+                if definition['name'] not in parameter_definitions:
+                    parameter_definitions.append(definition['name'])
+        _parameter_definitions.set(key, (parameter_definitions, (result.get('lastBuild') or {}).get('number')))
+
+    return {
+        'parameters' : [
+            (name, value) for name, value in _get_last_build_parameters(result) if name in parameter_definitions],
+        'parameter_definitions' : parameter_definitions,
+    }
 
-def build_job(job_name, config):
-    builds = get_builds(job_name, config)
 
-    if builds is None:
-        return FAIL_TO_RETRIEVE
+def _get_job_metadata(job_name, config, with_definitions):
+    tree = LAST_BUILD_PARAMETERS_TREE
+    if with_definitions:
+        tree += ',' + PARAMETER_DEFINITIONS_TREE
+    return get_jenkins_json_request('job/{}/api/json?tree={}'.format(job_name, tree), config, 'job')
 
-    if len(builds) == 0:
-        # Jobs was never built
-        params = get_job_parameters(job_name, config)
-        if params is None:
-            return FAIL_TO_RETRIEVE
 
-        if len(params) == 0:
-            post_url = 'job/{}/build'.format(job_name)
-        else:
-            post_url = 'job/{}/buildWithParameters'.format(job_name)
+def _get_last_build_parameters(result):
+    parameters = []
+    for action in (result.get('lastBuild') or {}).get('actions') or []:
+        for parameter in (action or {}).get('parameters') or []:
+            parameters.append((parameter['name'], parameter['value']))
+    return parameters
 
-        if post_jenkins_json_request(post_url, config):
-            return 0, 'Build triggered: {}'.format(job_name)
-        else:
-            return FAIL_TO_RETRIEVE
 
+def invalidate_parameter_definitions(job_name, config):
+    _parameter_definitions.pop((config['url'], job_name))
+
+
+def trigger_build(job_name, config, message):
+    metadata = get_build_metadata(job_name, config)
+    if metadata is None:
+        return FAIL_TO_RETRIEVE
+
+    if metadata['parameters']:
+        post_url = 'job/{}/buildWithParameters?{}'.format(job_name, urllib.urlencode(metadata['parameters']))
+    elif metadata['parameter_definitions']:
+        post_url = 'job/{}/buildWithParameters'.format(job_name)
     else:
-        return rebuild_job(job_name, config)
+        post_url = 'job/{}/build'.format(job_name)
+
+    if post_jenkins_json_request(post_url, config):
+        return 0, message.format(job_name)
+
+    # e.g. parameters changed since they were cached
+    invalidate_parameter_definitions(job_name, config)
+    return FAIL_TO_RETRIEVE
 
 
 def stop_job(job_name, config):
@@ -191,22 +432,42 @@ def stop_job(job_name, config):
     return -1, 'Unable to determine job progress: ' + job_name
 
 
-def get_build_test_errors(job_name, build_number, config):
-    jenkins_url, user, token = get_jenkins_config(config)
-
+def get_build_test_errors(job_name, build_number, config, timeout=test_report_timeout,
+                          max_size=test_report_max_size):
+    '''
+    Returns the failed test cases of a build, or an empty list if the test report can't be retrieved
+    in `timeout` seconds or is bigger than `max_size` bytes.
+    '''
     if build_number is None:
         build_number = 'lastBuild'
 
     # A more complete query can be done:
-    # '/{}/testReport/api/json?pretty=true&tree=suites[cases[className,name,status,errorStackTrace]]'.format(build_number)
-    url = jenkins_url + 'job/' + job_name + \
-        '/{}/testReport/api/json?pretty=true&tree=suites[cases[name,status]]'.format(build_number)
-    r = requests.get(url, auth=(user, token))
-    if r.status_code != 200:
+    # '/{}/testReport/api/json?tree=suites[cases[className,name,status,errorStackTrace]]'.format(build_number)
+    url = 'job/' + job_name + '/{}/testReport/api/json?tree=suites[cases[name,status]]'.format(build_number)
+    deadline = time.time() + timeout
+    content = []
+    try:
+        with get_client(config).open_response(
+                'GET', url, timeout=timeout, stream=True, auth=get_auth(config)) as r:
+            if r.status_code != 200:
+                return []
+
+            size = 0
+            for chunk in r.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > max_size:
+                    logger.debug('Test report bigger than {} bytes: {}'.format(max_size, url))
+                    return []
+                if time.time() > deadline:
+                    logger.debug('Test report not retrieved in {}s: {}'.format(timeout, url))
+                    return []
+                content.append(chunk)
+    except (requests.RequestException, ServiceUnavailableError) as e:
+        logger.debug('Failed to get test report: {}: {}'.format(url, e))
         return []
 
     try:
-        result = json.loads(r.text)
+        result = json.loads(b''.join(content))
     except:
         return []
 
@@ -245,24 +506,122 @@ def format_build_info(last_build):
     return last_build
 
 
-def get_job_last_build(job_name):
-    url = jenkins_url + 'job/'  + job_name + '/lastBuild/api/json?pretty=true&tree=building,number,duration,builtOn,timestamp,result,estimatedDuration,actions[causes[*]]'
-    r = requests.get(url, auth=(JENKINS_USER, JENKINS_TOKEN))
-    if r.status_code != 200:
-        logger.debug('Failed to get building jobs: {}' .format(url))
+BUILD_INFO_TREE = 'building,number,duration,builtOn,timestamp,result,estimatedDuration,actions[causes[*]]'
+
+def get_job_last_build(job_name, config):
+    url = 'job/' + job_name + '/lastBuild/api/json?tree=' + BUILD_INFO_TREE
+    result = get_jenkins_json_request(url, config, 'job')
+    if result is None:
+        logger.debug('Failed to get last build: {}' .format(url))
         return {}
 
-    result = json.loads(r.text)
     return format_build_info(result)
 
 
 def get_building_jobs(config):
-    url = config['url'] + 'api/json?pretty=true&tree=jobs[fullName,lastBuild[building,number,duration,builtOn,timestamp,result,estimatedDuration,actions[causes[*]]]]'
-    JENKINS_USER = config['user']
-    JENKINS_TOKEN = config['token']
-    r = requests.get(url, auth=(JENKINS_USER, JENKINS_TOKEN))
+    '''
+    :return: dict of the jobs currently building, by full name, with their (last) running build info
+    '''
+    return query_building_jobs(config) or {}
+
+
+def query_building_jobs(config):
+    '''
+    Same as `get_building_jobs`.
+    :return: None if Jenkins can't be queried
+    '''
+    status_code, building_jobs = _query_running_builds(config)
+    # no permission to read the computers: timeouts and server errors don't deserve the bigger query
+    if status_code in (403, 404):
+        logger.debug('Not allowed to get running builds, scanning jobs')
+        building_jobs = scan_building_jobs(config)
+    return building_jobs
+
 
-    result = json.loads(r.text)
+# builds running on the executors of all the computers (including the flyweight executors of pipelines)
+EXECUTABLE_TREE = 'currentExecutable[url,{}]'.format(BUILD_INFO_TREE)
+RUNNING_BUILDS_QUERY = 'computer/api/json?tree=computer[displayName,executors[{0}],oneOffExecutors[{0}]]'.format(
+    EXECUTABLE_TREE)
+
+
+def get_running_builds(config):
+    '''
+    Same as `get_building_jobs`, querying only the builds on executors, so that the cost of the query
+    depends on the number of running builds instead of the number of jobs.
+
+    :return: None if the computers can't be queried
+    '''
+    return _query_running_builds(config)[1]
+
+
+def _query_running_builds(config):
+    '''
+    :return: (status code of the response, None if no response, running builds as `get_running_builds`)
+    '''
+    try:
+        response = get_client(config).get(RUNNING_BUILDS_QUERY, 'building_jobs', auth=get_auth(config))
+    except (requests.RequestException, ServiceUnavailableError) as e:
+        logger.debug('Failed to get running builds: {}'.format(e))
+        return None, None
+
+    result = parse_json_response(response)
+    if not result or 'computer' not in result:
+        return response.status_code, None
+
+    building_jobs = {}
+    for computer in result['computer']:
+        for executor in (computer.get('executors') or []) + (computer.get('oneOffExecutors') or []):
+            build = (executor or {}).get('currentExecutable')
+            # idle executor, or a pipeline step running on a node (its build has a flyweight executor)
+            if not build or build.get('number') is None:
+                continue
+
+            job_name = get_build_job_name(build.get('url', ''), config)
+            if job_name is None:
+                continue
+
+            previous_build = building_jobs.get(job_name)
+            if previous_build is not None and previous_build['number'] > build['number']:
+                continue
+
+            build = format_build_info(build)
+            del build['url']
+            if not build.get('builtOn'):
+                build['builtOn'] = computer.get('displayName', '')
+            building_jobs[job_name] = build
+
+    return response.status_code, building_jobs
+
+
+def get_build_job_name(build_url, config):
+    '''
+    :return: full name of the job of a build, from the build url, e.g. 'folder/job_a' for
+        'http://jenkins/job/folder/job/job_a/12/', None if not a job build url
+    '''
+    jenkins_path = urlparse.urlparse(config['url']).path
+    path = urlparse.urlparse(build_url).path
+    if path.startswith(jenkins_path):
+        path = path[len(jenkins_path):]
+
+    parts = [part for part in path.strip('/').split('/') if part]
+    # job/<name>[/job/<name>...]/<number>
+    if len(parts) < 3 or len(parts) % 2 == 0 or not parts[-1].isdigit():
+        return None
+    if any(part != 'job' for part in parts[:-1:2]):
+        return None
+    return '/'.join(urllib.unquote(part) for part in parts[1:-1:2])
+
+
+def scan_building_jobs(config):
+    '''
+    Same as `get_building_jobs`, looking at the last build of every job.
+    :return: None if the jobs can't be queried
+    '''
+    result = get_jenkins_json_request(
+        'api/json?tree=jobs[fullName,lastBuild[{}]]'.format(BUILD_INFO_TREE), config, 'building_jobs')
+    if result is None or 'jobs' not in result:
+        logger.debug('Failed to get building jobs')
+        return None
     jobs = result['jobs']
 
     building_jobs = {}
@@ -0,0 +1,142 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+
+from skype_bot import jenkins_jobs
+from skype_bot.jobs_index import JobsIndex
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+refresh_interval = 5 * 60
+
+
+#===================================================================================================
+# JobsCatalog
+#===================================================================================================
+class JobsCatalog(object):
+    '''
+    In memory list of the Jenkins jobs, and search index over them, so that commands like `find` don't
+    download it every time.
+
+    The list is loaded on first use and reloaded once older than `refresh_interval` seconds: by a
+    background thread if started with `start_refresher`, otherwise by the first caller finding it stale
+    (other callers get the stale list meanwhile). Refreshes are single-flight: concurrent callers wait for
+    the refresh in progress instead of requesting Jenkins again.
+
+    :param jenkins_config: config of the Jenkins requests listing the jobs
+    '''
+
+    def __init__(self, jenkins_config, refresh_interval=refresh_interval):
+        self.jenkins_config = jenkins_config
+        self.refresh_interval = refresh_interval
+
+        self.jobs = None
+        self.index = JobsIndex([])
+        self.loaded_at = None
+        # end of the last load, successful or not
+        self._attempted_at = None
+
+        self._refresh_lock = threading.Lock()
+        self._stop_refresher = threading.Event()
+
+
+    def get_jobs(self):
+        '''
+        :return: list of job names, refreshed if stale
+        '''
+        if self.jobs is None:
+            self.refresh()
+        elif self._is_stale():
+            self._refresh_in_background()
+        return self.jobs or []
+
+
+    def get_index(self):
+        '''
+        :return: JobsIndex of the jobs, refreshed if stale
+        '''
+        self.get_jobs()
+        return self.index
+
+
+    def refresh(self):
+        '''
+        Reloads the jobs from Jenkins, unless another refresh finished while waiting for it, even a failed
+        one: callers arriving while Jenkins fails don't request it one after another.
+        '''
+        requested_at = time.time()
+        with self._refresh_lock:
+            if self._attempted_at is not None and self._attempted_at >= requested_at:
+                return
+            self._load()
+
+
+    def start_refresher(self):
+        '''
+        Starts a daemon thread reloading the jobs every `refresh_interval` seconds.
+        '''
+        self._stop_refresher.clear()
+        refresher = threading.Thread(target=self._run_refresher, name='jobs-catalog-refresher')
+        refresher.daemon = True
+        refresher.start()
+
+
+    def stop_refresher(self):
+        self._stop_refresher.set()
+
+
+    def get_stats(self):
+        return {
+            'jobs' : len(self.jobs or []),
+            'age' : time.time() - self.loaded_at if self.loaded_at is not None else None,
+        }
+
+
+    def _run_refresher(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception(e)
+            if self._stop_refresher.wait(self.refresh_interval):
+                return
+
+
+    def _is_stale(self):
+        return self.loaded_at is None or time.time() - self.loaded_at >= self.refresh_interval
+
+
+    def _refresh_in_background(self):
+        # a refresh is already in progress
+        if not self._refresh_lock.acquire(False):
+            return
+
+        def _refresh():
+            try:
+                self._load()
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self._refresh_lock.release()
+
+        refresher = threading.Thread(target=_refresh, name='jobs-catalog-refresh')
+        refresher.daemon = True
+        refresher.start()
+
+
+    def _load(self):
+        try:
+            jobs = jenkins_jobs.list_jobs(self.jenkins_config)
+        finally:
+            self._attempted_at = time.time()
+        # an empty list is most probably a failed request: keep the previous jobs
+        if jobs or self.jobs is None:
+            # indexed before being published, so that the index matches the jobs
+            self.index = JobsIndex(jobs)
+            self.jobs = jobs
+        if jobs:
+            self.loaded_at = time.time()
+        logger.debug('JobsCatalog: {} jobs'.format(len(jobs)))
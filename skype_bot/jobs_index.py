@@ -0,0 +1,143 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import fnmatch
+import re
+from array import array
+
+# minimum share of trigrams a job name must have with the query to be a fuzzy match
+fuzzy_threshold = 0.3
+
+# glob wildcards, splitting the literal fragments of a pattern
+GLOB_WILDCARDS = re.compile(r'\*|\?|\[!?\]?[^\]]*\]')
+
+# upper bound of the names starting with a given prefix
+_PREFIX_END = '\uffff'
+
+
+def get_trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def is_glob(query):
+    return GLOB_WILDCARDS.search(query) is not None
+
+
+#===================================================================================================
+# JobsIndex
+#===================================================================================================
+class JobsIndex(object):
+    '''
+    Search index over job names, made of trigram postings (ids of the jobs containing each trigram of
+    their lower cased name) and of the lower cased names sorted for prefix lookups.
+
+    Queries only check the jobs sharing their trigrams or their prefix instead of all the jobs:
+    - glob patterns (as fnmatch, case sensitive) in the order of the jobs;
+    - substrings (case insensitive), exact and prefix matches first;
+    - typo tolerant (fuzzy) queries, the names sharing most trigrams with the query first.
+
+    :param list(unicode) jobs: job names
+    '''
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+        self._lower_jobs = [job_name.lower() for job_name in jobs]
+
+        self._trigrams = {}
+        for job_id, job_name in enumerate(self._lower_jobs):
+            for trigram in get_trigrams(job_name):
+                try:
+                    postings = self._trigrams[trigram]
+                except KeyError:
+                    postings = self._trigrams[trigram] = array(b'i')
+                postings.append(job_id)
+
+        sorted_jobs = sorted((job_name, job_id) for job_id, job_name in enumerate(self._lower_jobs))
+        self._sorted_names = [job_name for job_name, _job_id in sorted_jobs]
+        self._sorted_ids = array(b'i', (job_id for _job_name, job_id in sorted_jobs))
+
+
+    def __len__(self):
+        return len(self.jobs)
+
+
+    def search(self, query, limit=None):
+        '''
+        :return: jobs matching the glob pattern, or containing the query, or else similar to the query
+        '''
+        if is_glob(query):
+            return self.glob(query, limit)
+        return self.substring(query, limit) or self.fuzzy(query, limit)
+
+
+    def glob(self, pattern, limit=None):
+        match = re.compile(fnmatch.translate(pattern)).match
+
+        fragments = GLOB_WILDCARDS.split(pattern)
+        candidates = self._get_candidates(
+            prefix=fragments[0].lower(),
+            trigrams=set().union(*[get_trigrams(fragment.lower()) for fragment in fragments]),
+        )
+        return [self.jobs[job_id] for job_id in candidates if match(self.jobs[job_id])][:limit]
+
+
+    def substring(self, text, limit=None):
+        text = text.lower()
+        if not text:
+            return []
+
+        candidates = self._get_candidates(trigrams=get_trigrams(text))
+        matches = []
+        for job_id in candidates:
+            position = self._lower_jobs[job_id].find(text)
+            if position >= 0:
+                # exact match, then by position of the text in the name, then shortest names
+                matches.append((self._lower_jobs[job_id] != text, position, len(self.jobs[job_id]), job_id))
+        matches.sort()
+        return [self.jobs[match[-1]] for match in matches[:limit]]
+
+
+    def fuzzy(self, text, limit=None, threshold=fuzzy_threshold):
+        query_trigrams = get_trigrams(text.lower())
+        if not query_trigrams:
+            return []
+
+        shared_counts = {}
+        for trigram in query_trigrams:
+            for job_id in self._trigrams.get(trigram, ()):
+                shared_counts[job_id] = shared_counts.get(job_id, 0) + 1
+
+        matches = []
+        for job_id, shared_count in shared_counts.items():
+            # Dice coefficient of the trigrams sets
+            job_trigrams_count = max(len(self._lower_jobs[job_id]) - 2, 1)
+            score = 2.0 * shared_count / (len(query_trigrams) + job_trigrams_count)
+            if score >= threshold:
+                matches.append((-score, len(self.jobs[job_id]), job_id))
+        matches.sort()
+        return [self.jobs[match[-1]] for match in matches[:limit]]
+
+
+    def _get_candidates(self, prefix='', trigrams=()):
+        '''
+        :return: sorted ids of the jobs which may start with the prefix and contain the trigrams
+        '''
+        candidates = None
+        if prefix:
+            start = bisect.bisect_left(self._sorted_names, prefix)
+            end = bisect.bisect_left(self._sorted_names, prefix + _PREFIX_END, start)
+            candidates = set(self._sorted_ids[start:end])
+
+        # rarest trigrams first, to keep the intersection small
+        for postings in sorted((self._trigrams.get(trigram, ()) for trigram in trigrams), key=len):
+            if candidates is None:
+                candidates = set(postings)
+            else:
+                candidates.intersection_update(postings)
+            if not candidates:
+                break
+
+        if candidates is None:
+            return range(len(self.jobs))
+        return sorted(candidates)
@@ -0,0 +1,286 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+ack_batch_size = 50
+ack_interval = 1.0
+claim_timeout = 15 * 60
+
+# delivered entries are removed after this many seconds
+delivered_expiration = 24 * 60 * 60
+
+
+#===================================================================================================
+# Outbox
+#===================================================================================================
+class Outbox(object):
+    '''
+    Append-only log of outgoing notifications, so that notifications not delivered yet can be replayed
+    after a restart. Entries are either rendered messages, or render tasks (the name of a render function
+    and its arguments) stored before being rendered.
+
+    Entries are appended one by one before being delivered, while acknowledgements of delivered entries
+    are written in batches of `ack_batch_size` entries, or after `ack_interval` seconds. An entry delivered
+    but not acknowledged yet when the process stops is delivered again on replay.
+
+    Entries are claimed by the process delivering them for `claim_timeout` seconds: other processes
+    sharing the outbox only replay the entries which claim expired. Undelivered entries are claimed in
+    bulk, with a single write.
+
+    Entries are dicts with an '_id' key, and either 'conversation_id' and 'message' keys, or 'render',
+    'args', 'batch' and 'follow_up' keys (see `append_task`).
+
+    :param owner: id of the process in the claims, a random one by default
+    '''
+
+    def __init__(self, ack_batch_size=ack_batch_size, ack_interval=ack_interval, claim_timeout=claim_timeout,
+                 owner=None):
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+        self.claim_timeout = claim_timeout
+        self.owner = owner if owner is not None else uuid.uuid4().hex
+
+        self._acked_ids = []
+        self._ack_timer = None
+        self._lock = threading.Lock()
+
+
+    def append(self, conversation_id, message):
+        '''
+        :return: id of the new entry, claimed by this process
+        '''
+        return self._insert({
+            'conversation_id' : conversation_id,
+            'message' : message,
+        })
+
+
+    def append_task(self, render, args, batch=False, follow_up=None):
+        '''
+        :param render: name of the render function
+        :param args: list of arguments of the render function
+        :param batch: True if the render function returns a list of messages
+        :param follow_up: name of the render function of the follow up messages, if any
+        :return: id of the new entry, claimed by this process
+        '''
+        return self._insert({
+            'render' : render,
+            'args' : list(args),
+            'batch' : batch,
+            'follow_up' : follow_up,
+        })
+
+
+    def ack(self, entry_ids):
+        '''
+        Marks the given entries as delivered.
+        '''
+        with self._lock:
+            self._acked_ids.extend(entry_ids)
+            if len(self._acked_ids) < self.ack_batch_size:
+                if self._ack_timer is None and self._acked_ids:
+                    self._ack_timer = threading.Timer(self.ack_interval, self.flush)
+                    self._ack_timer.daemon = True
+                    self._ack_timer.start()
+                return
+
+        self.flush()
+
+
+    def flush(self):
+        '''
+        Writes pending acknowledgements.
+        '''
+        with self._lock:
+            acked_ids = self._acked_ids
+            self._acked_ids = []
+            if self._ack_timer is not None:
+                self._ack_timer.cancel()
+                self._ack_timer = None
+
+        if acked_ids:
+            try:
+                self._set_delivered(acked_ids)
+            except Exception as e:
+                logger.exception(e)
+
+
+    def iter_undelivered(self):
+        '''
+        :return: iterator of undelivered entries, oldest first
+        '''
+        raise NotImplementedError()
+
+
+    def claim_undelivered(self):
+        '''
+        Claims the undelivered entries which are not claimed by another process.
+
+        :return: iterator of the claimed entries, oldest first
+        '''
+        raise NotImplementedError()
+
+
+    def _insert(self, entry):
+        '''
+        Inserts the entry, claimed by this process.
+        :return: id of the entry
+        '''
+        raise NotImplementedError()
+
+
+    def _set_delivered(self, entry_ids):
+        raise NotImplementedError()
+
+
+    def _get_claim_id(self):
+        # claims of a replay, told apart from the entries appended by this process
+        return '{}-{}'.format(self.owner, uuid.uuid4().hex)
+
+
+#===================================================================================================
+# MongoOutbox
+#===================================================================================================
+class MongoOutbox(Outbox):
+    '''
+    Outbox stored in a MongoDB collection, which removes the delivered entries.
+
+    :param collection: pymongo collection
+    '''
+
+    def __init__(self, collection, **kwargs):
+        super(MongoOutbox, self).__init__(**kwargs)
+        self.collection = collection
+
+        self.collection.create_index('delivered_at', expireAfterSeconds=delivered_expiration)
+
+
+    def iter_undelivered(self):
+        for entry in self.collection.find({'delivered_at' : None}).sort('_id'):
+            yield entry
+
+
+    def claim_undelivered(self):
+        claim = self._get_claim(self._get_claim_id())
+        self.collection.update_many(
+            {
+                'delivered_at' : None,
+                '$or' : [{'claimed_until' : None}, {'claimed_until' : {'$lt' : datetime.utcnow()}}],
+            },
+            {'$set' : claim},
+        )
+        for entry in self.collection.find({'delivered_at' : None, 'claimed_by' : claim['claimed_by']}).sort('_id'):
+            yield entry
+
+
+    def _insert(self, entry):
+        entry.update(self._get_claim(self.owner), created_at=datetime.utcnow(), delivered_at=None)
+        return self.collection.insert_one(entry).inserted_id
+
+
+    def _set_delivered(self, entry_ids):
+        self.collection.update_many({'_id' : {'$in' : entry_ids}}, {'$set' : {'delivered_at' : datetime.utcnow()}})
+
+
+    def _get_claim(self, claimed_by):
+        return {
+            'claimed_by' : claimed_by,
+            'claimed_until' : datetime.utcnow() + timedelta(seconds=self.claim_timeout),
+        }
+
+
+#===================================================================================================
+# SqliteOutbox
+#===================================================================================================
+class SqliteOutbox(Outbox):
+    '''
+    Outbox stored in the `outbox` table of a SQLite database, in WAL mode so that appends don't wait for
+    the replays. Entries are stored as JSON, the render tasks arguments must be JSON serializable.
+    Delivered entries are removed on replay.
+
+    :param path: database file, shared with the storage of the bot (see storage.SqliteStorage)
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data TEXT NOT NULL,
+            claimed_by TEXT,
+            claimed_until REAL,
+            delivered_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_delivered_at ON outbox (delivered_at);
+    '''
+
+    def __init__(self, path, **kwargs):
+        super(SqliteOutbox, self).__init__(**kwargs)
+        self.path = path
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection_lock = threading.Lock()
+        with self._transaction() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.executescript(self.SCHEMA)
+
+
+    def iter_undelivered(self):
+        with self._transaction() as cursor:
+            rows = cursor.execute('SELECT id, data FROM outbox WHERE delivered_at IS NULL ORDER BY id').fetchall()
+        return (self._load_entry(row) for row in rows)
+
+
+    def claim_undelivered(self):
+        claimed_by = self._get_claim_id()
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM outbox WHERE delivered_at < ?', (now - delivered_expiration,))
+            cursor.execute(
+                'UPDATE outbox SET claimed_by = ?, claimed_until = ? '
+                'WHERE delivered_at IS NULL AND (claimed_until IS NULL OR claimed_until < ?)',
+                (claimed_by, now + self.claim_timeout, now),
+            )
+            rows = cursor.execute(
+                'SELECT id, data FROM outbox WHERE delivered_at IS NULL AND claimed_by = ? ORDER BY id',
+                (claimed_by,),
+            ).fetchall()
+        return (self._load_entry(row) for row in rows)
+
+
+    def _insert(self, entry):
+        with self._transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO outbox (data, claimed_by, claimed_until) VALUES (?, ?, ?)',
+                (json.dumps(entry), self.owner, time.time() + self.claim_timeout),
+            )
+            return cursor.lastrowid
+
+
+    def _set_delivered(self, entry_ids):
+        with self._transaction() as cursor:
+            cursor.execute(
+                'UPDATE outbox SET delivered_at = ? WHERE id IN ({})'.format(', '.join('?' * len(entry_ids))),
+                [time.time()] + list(entry_ids),
+            )
+
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection_lock, self._connection:
+            yield self._connection.cursor()
+
+
+    def _load_entry(self, row):
+        _id, data = row
+        entry = json.loads(data)
+        entry['_id'] = _id
+        return entry
@@ -0,0 +1,171 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import email.utils
+import threading
+import time
+
+# default values, can be overriden in config
+rate = 20.0
+burst = 40
+conversation_rate = 1.0
+conversation_burst = 5
+
+# used when a throttled response has no (valid) Retry-After header
+default_retry_after = 1.0
+
+# idle per-conversation buckets are dropped above this number
+max_conversations = 10000
+
+
+def parse_retry_after(retry_after, now=None):
+    '''
+    :param retry_after: Retry-After header value, either a number of seconds or a HTTP date
+    :return: number of seconds to wait
+    '''
+    if now is None:
+        now = time.time()
+
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            date = email.utils.parsedate_tz(retry_after)
+            if date is not None:
+                return max(email.utils.mktime_tz(date) - now, 0.0)
+
+    return default_retry_after
+
+
+#===================================================================================================
+# TokenBucket
+#===================================================================================================
+class TokenBucket(object):
+    '''
+    Bucket holding up to `capacity` tokens, refilled at `rate` tokens per second.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = float(capacity)
+        self.blocked_until = 0.0
+        self._last_update = time.time()
+
+
+    def get_delay(self, now):
+        '''
+        :return: seconds to wait until a token is available, 0 if one is available right now
+        '''
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.level >= 1:
+            return 0.0
+        return (1 - self.level) / self.rate
+
+
+    def take(self):
+        self.level -= 1
+
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.level >= self.capacity and now >= self.blocked_until
+
+
+    def _refill(self, now):
+        if now > self._last_update:
+            self.level = min(self.capacity, self.level + (now - self._last_update) * self.rate)
+            self._last_update = now
+
+
+#===================================================================================================
+# RateLimiter
+#===================================================================================================
+class RateLimiter(object):
+    '''
+    Limits outgoing messages with a global token bucket and a token bucket per conversation.
+
+    Throttled responses block the conversation bucket for the time given in their Retry-After header.
+    '''
+
+    def __init__(self, rate=rate, burst=burst, conversation_rate=conversation_rate,
+                 conversation_burst=conversation_burst):
+        self.conversation_rate = conversation_rate
+        self.conversation_burst = conversation_burst
+
+        self._bucket = TokenBucket(rate, burst)
+        self._conversation_buckets = {}
+        self._lock = threading.Lock()
+
+
+    def acquire(self, conversation_id):
+        '''
+        Takes a token for sending a message to the given conversation.
+
+        :return: seconds to wait before trying again, 0 if the message can be sent right now
+        '''
+        now = time.time()
+        with self._lock:
+            conversation_bucket = self._get_conversation_bucket(conversation_id, now)
+            delay = max(self._bucket.get_delay(now), conversation_bucket.get_delay(now))
+            if delay == 0:
+                self._bucket.take()
+                conversation_bucket.take()
+            return delay
+
+
+    def get_delay(self, conversation_id):
+        '''
+        :return: seconds to wait before a message can be sent to the given conversation, without taking a token
+        '''
+        now = time.time()
+        with self._lock:
+            conversation_bucket = self._get_conversation_bucket(conversation_id, now)
+            return max(self._bucket.get_delay(now), conversation_bucket.get_delay(now))
+
+
+    def throttled(self, conversation_id, retry_after):
+        '''
+        Blocks the conversation after a throttled (429) response.
+
+        :param retry_after: Retry-After header value of the response
+        :return: seconds the conversation is blocked
+        '''
+        now = time.time()
+        delay = parse_retry_after(retry_after, now)
+        with self._lock:
+            self._get_conversation_bucket(conversation_id, now).block(now + delay)
+        return delay
+
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            self._bucket.get_delay(now)
+            return {
+                'level' : self._bucket.level,
+                'conversations' : dict(
+                    (conversation_id, bucket.level) for conversation_id, bucket in self._conversation_buckets.items()
+                    if not bucket.is_idle(now)
+                ),
+            }
+
+
+    def _get_conversation_bucket(self, conversation_id, now):
+        try:
+            return self._conversation_buckets[conversation_id]
+        except KeyError:
+            pass
+
+        if len(self._conversation_buckets) >= max_conversations:
+            for idle_id in [i for i, b in self._conversation_buckets.items() if b.is_idle(now)]:
+                del self._conversation_buckets[idle_id]
+
+        bucket = self._conversation_buckets[conversation_id] = TokenBucket(self.conversation_rate,
+                                                                           self.conversation_burst)
+        return bucket
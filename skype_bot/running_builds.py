@@ -0,0 +1,285 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import threading
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+reconcile_interval = 10 * 60
+snapshot_ttl = 15
+
+
+def _get_build_number(build_info):
+    try:
+        return int(build_info.get('number'))
+    except (TypeError, ValueError):
+        return None
+
+
+#===================================================================================================
+# RunningBuilds
+#===================================================================================================
+class RunningBuilds(object):
+    '''
+    Table of the builds in progress, by job name and indexed by user id, kept up to date from the job
+    started/completed events, so that `status` doesn't have to query Jenkins.
+
+    Events can be missed (bot down, webhook failures): `reconcile` replaces the table with the running
+    builds reported by Jenkins, keeping the changes of the events received since that report was asked.
+
+    Given a MongoDB `collection`, the table is persisted there and loaded back on start. The writes are
+    queued with the changes of the table, and done in that order by a writer thread, so that a slow
+    database doesn't hold the callers.
+
+    :param collection: pymongo collection, None to keep the table in memory only
+    '''
+
+    def __init__(self, collection=None):
+        self.collection = collection
+
+        self._builds = {}
+        self._by_user_id = {}
+        # job name: (build number, time) of the last events, for reconciliations in progress
+        self._events = {}
+        # job name: number of the last completed build, so that late started events are ignored
+        self._completed = {}
+        self._lock = threading.Lock()
+        self._stop_reconciler = threading.Event()
+        self._writes = Queue.Queue()
+
+        if self.collection is not None:
+            self._load()
+            writer = threading.Thread(target=self._run_writer, name='running-builds-writer')
+            writer.daemon = True
+            writer.start()
+
+
+    def started(self, build_info):
+        job_name = build_info['job_name']
+        build_info = dict(build_info, number=_get_build_number(build_info))
+        with self._lock:
+            previous_build = self._builds.get(job_name)
+            if previous_build is not None and previous_build['number'] > build_info['number']:
+                return
+            # started event received after the completed one
+            completed_number = self._completed.get(job_name)
+            if completed_number is not None and completed_number >= build_info['number']:
+                return
+            self._events[job_name] = build_info['number'], time.time()
+            self._set(job_name, build_info)
+            self._persist('replace_one', {'_id' : job_name}, dict(build_info, _id=job_name), upsert=True)
+
+
+    def completed(self, build_info):
+        job_name = build_info['job_name']
+        number = _get_build_number(build_info)
+        with self._lock:
+            self._events[job_name] = number, time.time()
+            if number is not None and number > self._completed.get(job_name, -1):
+                self._completed[job_name] = number
+            previous_build = self._builds.get(job_name)
+            if previous_build is None or previous_build['number'] > number:
+                return
+            self._remove(job_name)
+            self._persist('delete_one', {'_id' : job_name, 'number' : {'$lte' : number}})
+
+
+    def get_user_builds(self, user_id):
+        '''
+        :return: dict of the running builds started by the user, by job name
+        '''
+        with self._lock:
+            return dict((job_name, dict(self._builds[job_name])) for job_name in self._by_user_id.get(user_id, ()))
+
+
+    def __len__(self):
+        return len(self._builds)
+
+
+    def reconcile(self, get_building_jobs):
+        '''
+        Replaces the table with the running builds reported by Jenkins.
+
+        :param get_building_jobs: callable returning a dict of the running builds by job name, as
+            jenkins_jobs.get_running_builds, or None if Jenkins can't tell
+        :return: (added, removed) sets of job names, None if Jenkins can't tell
+        '''
+        requested_at = time.time()
+        building_jobs = get_building_jobs()
+        if building_jobs is None:
+            logger.warning('Unable to get the running builds to reconcile')
+            return None
+
+        with self._lock:
+            builds = {}
+            for job_name, build_info in building_jobs.items():
+                builds[job_name] = dict(build_info, job_name=job_name, number=_get_build_number(build_info))
+
+            # events received meanwhile are more recent than the report
+            for job_name, (number, event_time) in self._events.items():
+                if event_time < requested_at:
+                    continue
+                current_build = self._builds.get(job_name)
+                if current_build is not None and current_build['number'] == number:
+                    builds[job_name] = current_build
+                elif job_name in builds and builds[job_name]['number'] <= number:
+                    del builds[job_name]
+
+            self._events = dict(
+                (job_name, event) for job_name, event in self._events.items() if event[1] >= requested_at)
+
+            added = set(builds) - set(self._builds)
+            removed = set(self._builds) - set(builds)
+            self._builds = {}
+            self._by_user_id = {}
+            for job_name, build_info in builds.items():
+                self._set(job_name, build_info)
+
+            self._persist('delete_many', {'_id' : {'$nin' : list(builds)}})
+            for job_name, build_info in builds.items():
+                self._persist('replace_one', {'_id' : job_name}, dict(build_info, _id=job_name), upsert=True)
+
+        logger.debug('RunningBuilds.reconcile: {} builds, {} added, {} removed'.format(
+            len(builds), len(added), len(removed)))
+        return added, removed
+
+
+    def start_reconciler(self, get_building_jobs, interval=reconcile_interval):
+        '''
+        Starts a daemon thread reconciling the table every `interval` seconds.
+        '''
+        self._stop_reconciler.clear()
+        reconciler = threading.Thread(
+            target=self._run_reconciler, args=(get_building_jobs, interval), name='running-builds-reconciler')
+        reconciler.daemon = True
+        reconciler.start()
+
+
+    def stop_reconciler(self):
+        self._stop_reconciler.set()
+
+
+    def _run_reconciler(self, get_building_jobs, interval):
+        while True:
+            try:
+                self.reconcile(get_building_jobs)
+            except Exception as e:
+                logger.exception(e)
+            if self._stop_reconciler.wait(interval):
+                return
+
+
+    def flush(self):
+        '''
+        Waits for the queued writes to be done.
+        '''
+        self._writes.join()
+
+
+    def _persist(self, method_name, *args, **kwargs):
+        # called with the lock held, so that the writes are queued in the order of the changes
+        if self.collection is not None:
+            self._writes.put((getattr(self.collection, method_name), args, kwargs))
+
+
+    def _run_writer(self):
+        while True:
+            write, args, kwargs = self._writes.get()
+            try:
+                write(*args, **kwargs)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self._writes.task_done()
+
+
+    def _load(self):
+        with self._lock:
+            for document in self.collection.find():
+                job_name = document.pop('_id')
+                self._set(job_name, document)
+
+
+    def _set(self, job_name, build_info):
+        self._remove(job_name)
+        self._builds[job_name] = build_info
+        self._by_user_id.setdefault(build_info.get('userId'), set()).add(job_name)
+
+
+    def _remove(self, job_name):
+        build_info = self._builds.pop(job_name, None)
+        if build_info is None:
+            return
+
+        user_jobs = self._by_user_id.get(build_info.get('userId'))
+        if user_jobs is not None:
+            user_jobs.discard(job_name)
+            if not user_jobs:
+                del self._by_user_id[build_info.get('userId')]
+
+
+#===================================================================================================
+# BuildingJobsSnapshot
+#===================================================================================================
+class BuildingJobsSnapshot(object):
+    '''
+    Building jobs reported by Jenkins, shared by all the callers for `ttl` seconds.
+
+    Fetches are single-flight: callers finding the snapshot expired while another caller is fetching it
+    wait for that fetch instead of querying Jenkins again.
+
+    When a fetch fails the previous snapshot is kept, flagged `stale`, for another `ttl` seconds.
+
+    :param get_building_jobs: callable returning a dict of the running builds by job name, as
+        jenkins_jobs.query_building_jobs, or None if Jenkins can't tell
+    '''
+
+    def __init__(self, get_building_jobs, ttl=snapshot_ttl):
+        self.get_building_jobs = get_building_jobs
+        self.ttl = ttl
+
+        self.building_jobs = None
+        self.taken_at = None
+        self.stale = False
+        self._lock = threading.Lock()
+
+
+    def get(self):
+        '''
+        :return: dict of the running builds by job name, not to be modified, None if Jenkins never told
+        '''
+        if self._is_fresh():
+            return self.building_jobs
+
+        with self._lock:
+            if not self._is_fresh():
+                building_jobs = self.get_building_jobs()
+                self.stale = building_jobs is None
+                if self.stale:
+                    logger.warning('Unable to get the building jobs, keeping the previous ones')
+                else:
+                    self.building_jobs = building_jobs
+                self.taken_at = time.time()
+            return self.building_jobs
+
+
+    def get_user_builds(self, user_id):
+        '''
+        :return: (count of all the running builds, dict of the running builds of the user by job name),
+            count None if Jenkins never told
+        '''
+        building_jobs = self.get()
+        if building_jobs is None:
+            return None, {}
+        return len(building_jobs), dict(
+            (job_name, build_info) for job_name, build_info in building_jobs.items()
+            if build_info.get('userId') == user_id
+        )
+
+
+    def _is_fresh(self):
+        taken_at = self.taken_at
+        return taken_at is not None and time.time() - taken_at < self.ttl
@@ -0,0 +1,116 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import zlib
+from datetime import datetime, timedelta
+
+from skype_bot.cache import ExpiringCache
+
+# default values, can be overriden in config
+session_ttl = 60 * 60
+max_sessions = 10000
+max_bytes = 16 * 1024 * 1024
+
+JOBS_SEPARATOR = '\n'
+
+
+def encode_jobs(jobs):
+    '''
+    :param list(unicode) jobs: job names
+    :return: compressed bytes of the job names, which share a lot of prefixes and suffixes
+    '''
+    return zlib.compress(JOBS_SEPARATOR.join(jobs).encode('utf-8'))
+
+
+def decode_jobs(data):
+    text = zlib.decompress(bytes(data)).decode('utf-8')
+    return text.split(JOBS_SEPARATOR) if text else []
+
+
+#===================================================================================================
+# SessionStore
+#===================================================================================================
+class SessionStore(object):
+    '''
+    Lists of job names (e.g. the result of the last `find`) kept for each user between two commands.
+
+    Entries expire after `ttl` seconds, and the least recently used ones are evicted once they take more
+    than `max_bytes` (lists are kept compressed).
+    '''
+
+    def __init__(self, ttl=session_ttl, max_sessions=max_sessions, max_bytes=max_bytes):
+        self.ttl = ttl
+        self._cache = ExpiringCache(max_size=max_sessions, ttl=ttl, max_weight=max_bytes)
+
+
+    def get_jobs(self, skype_id, name):
+        '''
+        :return: list of job names, None if there is none
+        '''
+        data = self._cache.get((skype_id, name))
+        if data is not None:
+            return decode_jobs(data)
+
+
+    def set_jobs(self, skype_id, name, jobs):
+        '''
+        :param jobs: list of job names, None to clear it
+        '''
+        if jobs is None:
+            self._cache.pop((skype_id, name))
+        else:
+            self._cache.set((skype_id, name), encode_jobs(jobs))
+
+
+    def get_stats(self):
+        return self._cache.get_stats()
+
+
+#===================================================================================================
+# MongoSessionStore
+#===================================================================================================
+class MongoSessionStore(SessionStore):
+    '''
+    Session store shared by the bot processes, kept in a MongoDB collection, so that a `build` can be
+    handled by another process than the `find` it refers to.
+
+    Expired entries are removed by a TTL index.
+
+    :param collection: pymongo collection
+    '''
+
+    def __init__(self, collection, ttl=session_ttl):
+        self.ttl = ttl
+        self.collection = collection
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+
+    def get_jobs(self, skype_id, name):
+        session = self.collection.find_one({'_id' : self._get_key(skype_id, name)})
+        # TTL indexes are only applied every minute
+        if session is not None and session['expires_at'] > datetime.utcnow():
+            return decode_jobs(session['jobs'])
+
+
+    def set_jobs(self, skype_id, name, jobs):
+        from bson.binary import Binary
+
+        key = self._get_key(skype_id, name)
+        if jobs is None:
+            self.collection.delete_one({'_id' : key})
+        else:
+            self.collection.replace_one(
+                {'_id' : key},
+                {
+                    'jobs' : Binary(encode_jobs(jobs)),
+                    'expires_at' : datetime.utcnow() + timedelta(seconds=self.ttl),
+                },
+                upsert=True,
+            )
+
+
+    def get_stats(self):
+        return {'size' : self.collection.count()}
+
+
+    def _get_key(self, skype_id, name):
+        return '{}|{}'.format(skype_id, name)
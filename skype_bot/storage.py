@@ -0,0 +1,407 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# default values, can be overriden in config
+history_size = 20
+sqlite_path = 'skype_bot.db'
+
+# (collection, field, options) of the indexes required by the queries of the bot
+REQUIRED_INDEXES = [
+    ('skype_users', 'skype_id', {'unique' : True}),
+    ('skype_users', 'jenkins_id', {}),
+    ('users_jobs', 'jenkins_id', {'unique' : True}),
+]
+
+
+def _iter_plan_stages(plan):
+    yield plan.get('stage')
+    for input_plan in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if input_plan:
+            for stage in _iter_plan_stages(input_plan):
+                yield stage
+
+
+#===================================================================================================
+# Storage
+#===================================================================================================
+class Storage(object):
+    '''
+    Persistence of the registered users and of their jobs history.
+
+    Users are dicts with at least 'skype_id' and 'jenkins_id' keys, and an '_id' key once saved.
+    '''
+
+    # whether `watch_users` is supported
+    can_watch = False
+
+    def iter_users(self):
+        raise NotImplementedError()
+
+
+    def find_user(self, key, value):
+        '''
+        :param key: 'skype_id' or 'jenkins_id'
+        :return: the first user with the given value, or None
+        '''
+        raise NotImplementedError()
+
+
+    def find_users_by_jenkins_ids(self, jenkins_ids):
+        raise NotImplementedError()
+
+
+    def save_user(self, user_info):
+        '''
+        Inserts or updates (given its '_id') the user.
+        :return: id of the user
+        '''
+        raise NotImplementedError()
+
+
+    def watch_users(self):
+        '''
+        :return: context manager iterating over the changes of users, as MongoDB change events
+        '''
+        raise NotImplementedError()
+
+
+    def get_history(self, jenkins_id, limit=None):
+        '''
+        :return: list of the last jobs started by the user, most recent first
+        '''
+        raise NotImplementedError()
+
+
+    def add_history(self, jobs):
+        '''
+        Moves (or adds) the jobs to the top of their users history.
+        :param jobs: list of (jenkins_id, job_name) in the order they were started
+        '''
+        raise NotImplementedError()
+
+
+    def get_outbox(self, **kwargs):
+        '''
+        :param kwargs: options of the outbox (see outbox.Outbox)
+        :return: outbox.Outbox of the notifications, stored next to the users
+        '''
+        raise NotImplementedError()
+
+
+#===================================================================================================
+# JobsHistory
+#===================================================================================================
+class JobsHistory(object):
+    '''
+    Last jobs started by each user, most recent first, capped to `max_size` jobs.
+    '''
+
+    def __init__(self, jobs_db, max_size=history_size):
+        self.jobs_db = jobs_db
+        self.max_size = max_size
+
+
+    def get_history(self, jenkins_id, limit=None):
+        '''
+        :param limit: maximum number of jobs fetched, defaults to `max_size`
+        '''
+        if self.jobs_db is not None:
+            if limit is None:
+                limit = self.max_size
+            return self.jobs_db.find_one({'jenkins_id' : jenkins_id}, {'history' : {'$slice' : limit}})
+
+    def get_jobs_history(self, jenkins_id, limit=None):
+        user_history = self.get_history(jenkins_id, limit)
+        logger.debug('get_jobs_history: {} = {}'.format(jenkins_id, user_history))
+        if user_history:
+            return user_history['history']
+        else:
+            return []
+
+
+    def add_job(self, jenkins_id, job_name):
+        self.add_jobs([(jenkins_id, job_name)])
+
+
+    def add_jobs(self, jobs):
+        '''
+        Moves (or adds) the jobs to the top of their users history.
+
+        The history of each user is replaced with a single write, made only if it didn't change since it
+        was read (retried otherwise), so that concurrent updates can't interleave.
+
+        :param jobs: list of (jenkins_id, job_name) in the order they were started
+        '''
+        if self.jobs_db is None or not jobs:
+            return
+
+        jobs_by_user = OrderedDict()
+        for jenkins_id, job_name in jobs:
+            jobs_by_user.setdefault(jenkins_id, []).append(job_name)
+
+        for jenkins_id, job_names in jobs_by_user.items():
+            self._add_user_jobs(jenkins_id, job_names)
+
+
+    MAX_UPDATE_ATTEMPTS = 5
+
+    def _add_user_jobs(self, jenkins_id, job_names):
+        from pymongo.errors import DuplicateKeyError
+
+        for _attempt in range(self.MAX_UPDATE_ATTEMPTS):
+            user_history = self.jobs_db.find_one({'jenkins_id' : jenkins_id}, {'history' : 1})
+            if user_history is None:
+                try:
+                    self.jobs_db.insert_one({'jenkins_id' : jenkins_id, 'history' : self._move_to_top([], job_names)})
+                    return
+                except DuplicateKeyError:
+                    # inserted meanwhile
+                    continue
+
+            history = user_history.get('history', [])
+            result = self.jobs_db.update_one(
+                {'_id' : user_history['_id'], 'history' : history},
+                {'$set' : {'history' : self._move_to_top(history, job_names)}},
+            )
+            if result.matched_count:
+                return
+
+        raise RuntimeError('History of {} updated concurrently {} times'.format(jenkins_id, self.MAX_UPDATE_ATTEMPTS))
+
+
+    def _move_to_top(self, history, job_names):
+        for job_name in job_names:
+            history = [job_name] + [name for name in history if name != job_name]
+        return history[:self.max_size]
+
+
+#===================================================================================================
+# MongoStorage
+#===================================================================================================
+class MongoStorage(Storage):
+    '''
+    Users and history stored in the `skype_users` and `users_jobs` collections of a MongoDB database.
+
+    :param jenkins_db: pymongo database
+    '''
+
+    can_watch = True
+
+    def __init__(self, jenkins_db, history_size=history_size):
+        self.jenkins_db = jenkins_db
+        self.users_db = jenkins_db.skype_users
+        self.jobs_history = JobsHistory(jenkins_db.users_jobs, max_size=history_size)
+
+
+    def ensure_indexes(self):
+        '''
+        Creates the indexes required by the bot queries, if they don't exist yet.
+        '''
+        for collection_name, field, options in REQUIRED_INDEXES:
+            try:
+                self.jenkins_db[collection_name].create_index([(field, 1)], **options)
+            except Exception as e:
+                # e.g. duplicated values preventing an unique index
+                logger.error('Unable to create index {}.{} {}: {}'.format(collection_name, field, options, e))
+
+
+    def check_query_plans(self):
+        '''
+        Startup diagnostic: logs a warning for the bot queries which would scan a whole collection.
+        :return: list of (collection, field) of those queries
+        '''
+        collection_scans = []
+        for collection_name, field, _options in REQUIRED_INDEXES:
+            try:
+                explain = self.jenkins_db[collection_name].find({field : ''}).explain()
+            except Exception as e:
+                logger.debug('Unable to explain query on {}.{}: {}'.format(collection_name, field, e))
+                continue
+
+            winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+            if 'COLLSCAN' in _iter_plan_stages(winning_plan):
+                logger.warning('Query on {}.{} scans the whole collection'.format(collection_name, field))
+                collection_scans.append((collection_name, field))
+        return collection_scans
+
+
+    def iter_users(self):
+        return self.users_db.find()
+
+
+    def find_user(self, key, value):
+        return self.users_db.find_one({key : value})
+
+
+    def find_users_by_jenkins_ids(self, jenkins_ids):
+        return self.users_db.find({'jenkins_id' : {'$in' : list(jenkins_ids)}})
+
+
+    def save_user(self, user_info):
+        if '_id' in user_info:
+            self.users_db.replace_one({'_id' : user_info['_id']}, user_info, upsert=True)
+            return user_info['_id']
+        return self.users_db.insert_one(dict(user_info)).inserted_id
+
+
+    def watch_users(self):
+        return self.users_db.watch(full_document='updateLookup')
+
+
+    def get_history(self, jenkins_id, limit=None):
+        return self.jobs_history.get_jobs_history(jenkins_id, limit)
+
+
+    def add_history(self, jobs):
+        self.jobs_history.add_jobs(jobs)
+
+
+    def get_outbox(self, **kwargs):
+        from skype_bot.outbox import MongoOutbox
+        return MongoOutbox(self.jenkins_db.outbox, **kwargs)
+
+
+#===================================================================================================
+# SqliteStorage
+#===================================================================================================
+class SqliteStorage(Storage):
+    '''
+    Users and history stored in an embedded SQLite database, in WAL mode so that reads don't wait for
+    writes.
+
+    Users are stored as JSON, next to the skype_id and jenkins_id columns they are looked up by, and the
+    history as one row per (user, job), ordered by the time the job was last started.
+
+    :param path: database file, relative to the working directory; ':memory:' for a database lost when
+        the bot stops
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            skype_id TEXT NOT NULL UNIQUE,
+            jenkins_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_jenkins_id ON users (jenkins_id);
+
+        CREATE TABLE IF NOT EXISTS jobs_history (
+            jenkins_id TEXT NOT NULL,
+            job_name TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (jenkins_id, job_name)
+        );
+        CREATE INDEX IF NOT EXISTS jobs_history_position ON jobs_history (jenkins_id, position);
+    '''
+
+    def __init__(self, path=sqlite_path, history_size=history_size):
+        self.path = path
+        self.history_size = history_size
+
+        # a single connection, shared by the threads, so that in memory databases work as well
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._transaction() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+
+
+    def iter_users(self):
+        with self._transaction() as cursor:
+            rows = cursor.execute('SELECT id, data FROM users').fetchall()
+        return [self._load_user(row) for row in rows]
+
+
+    def find_user(self, key, value):
+        if key not in ('skype_id', 'jenkins_id'):
+            raise ValueError('Users can not be looked up by {}'.format(key))
+
+        with self._transaction() as cursor:
+            row = cursor.execute(
+                'SELECT id, data FROM users WHERE {} = ? ORDER BY id LIMIT 1'.format(key), (value,)
+            ).fetchone()
+        if row is not None:
+            return self._load_user(row)
+
+
+    def find_users_by_jenkins_ids(self, jenkins_ids):
+        jenkins_ids = list(jenkins_ids)
+        if not jenkins_ids:
+            return []
+
+        with self._transaction() as cursor:
+            rows = cursor.execute(
+                'SELECT id, data FROM users WHERE jenkins_id IN ({}) ORDER BY id'.format(
+                    ', '.join('?' * len(jenkins_ids))),
+                jenkins_ids,
+            ).fetchall()
+        return [self._load_user(row) for row in rows]
+
+
+    def save_user(self, user_info):
+        data = dict(user_info)
+        _id = data.pop('_id', None)
+        with self._transaction() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO users (id, skype_id, jenkins_id, data) VALUES (?, ?, ?, ?)',
+                (_id, data['skype_id'], data.get('jenkins_id'), json.dumps(data)),
+            )
+            return cursor.lastrowid if _id is None else _id
+
+
+    def get_history(self, jenkins_id, limit=None):
+        if limit is None:
+            limit = self.history_size
+
+        with self._transaction() as cursor:
+            rows = cursor.execute(
+                'SELECT job_name FROM jobs_history WHERE jenkins_id = ? ORDER BY position DESC LIMIT ?',
+                (jenkins_id, limit),
+            ).fetchall()
+        return [job_name for job_name, in rows]
+
+
+    def add_history(self, jobs):
+        with self._transaction() as cursor:
+            for jenkins_id, job_name in jobs:
+                cursor.execute(
+                    'INSERT OR REPLACE INTO jobs_history (jenkins_id, job_name, position) '
+                    'SELECT ?, ?, COALESCE(MAX(position), 0) + 1 FROM jobs_history WHERE jenkins_id = ?',
+                    (jenkins_id, job_name, jenkins_id),
+                )
+
+            for jenkins_id in set(jenkins_id for jenkins_id, _job_name in jobs):
+                cursor.execute(
+                    'DELETE FROM jobs_history WHERE jenkins_id = ? AND position <= ('
+                    '    SELECT position FROM jobs_history WHERE jenkins_id = ? '
+                    '    ORDER BY position DESC LIMIT 1 OFFSET ?'
+                    ')',
+                    (jenkins_id, jenkins_id, self.history_size),
+                )
+
+
+    def get_outbox(self, **kwargs):
+        from skype_bot.outbox import SqliteOutbox
+        return SqliteOutbox(self.path, **kwargs)
+
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock, self._connection:
+            yield self._connection.cursor()
+
+
+    def _load_user(self, row):
+        _id, data = row
+        user_info = json.loads(data)
+        user_info['_id'] = _id
+        return user_info
@@ -1,60 +1,183 @@
 #!/usr/bin/env python
-import fnmatch
 import inspect
 import re
-
-from skype_bot import jenkins_jobs
-from skype_bot.jenkins_jobs import get_build_test_errors, get_building_jobs, get_job_url, stop_job
+import threading
+import time
+
+from skype_bot import jenkins_jobs, jobs_catalog, running_builds, sessions, storage
+from skype_bot.cache import ExpiringCache
+from skype_bot.jenkins_jobs import get_build_test_errors, get_job_url, stop_job
+from skype_bot.jobs_catalog import JobsCatalog
+from skype_bot.running_builds import BuildingJobsSnapshot, RunningBuilds
+from skype_bot.sessions import MongoSessionStore, SessionStore
 from skype_bot.skype_message import SkypeMessage
+from skype_bot.storage import MongoStorage, SqliteStorage
 import logging
 
 logger = logging.getLogger(__name__)
 
+# default values, can be overriden in config
+unknown_users_ttl = 10 * 60
+max_unknown_users = 10000
+
+# delay before watching users changes again after an error
+watch_retry_period = 30
+
+
 #===================================================================================================
-# JobsHistory
+# UsersDirectory
 #===================================================================================================
-class JobsHistory(object):
+class UsersDirectory(object):
+    '''
+    Write-through cache of the registered users, indexed by skype_id and by jenkins_id.
 
+    Users are loaded at once by `load`, and users missing from the cache are looked up in the storage.
+    With `start_watching`, changes made by other bot instances are applied from the storage changes
+    (a MongoDB change stream).
 
-    def __init__(self, jobs_db):
-        self.jobs_db = jobs_db
+    :param Storage storage:
+    :param unknown_jenkins_ids: ExpiringCache of the jenkins ids without registered user, from which the
+        jenkins ids of the users changed by other instances are removed
+    '''
 
+    def __init__(self, storage, unknown_jenkins_ids=None):
+        self.storage = storage
+        self.unknown_jenkins_ids = unknown_jenkins_ids
 
-    def get_history(self, jenkins_id):
-        if self.jobs_db is not None:
-            users_history = list(self.jobs_db.find({'jenkins_id' : jenkins_id}))
-            if users_history and len(users_history) == 1:
-                return users_history[0]
+        self._by_id = {}
+        self._by_skype_id = {}
+        self._by_jenkins_id = {}
+        self._lock = threading.Lock()
 
-    def get_jobs_history(self, jenkins_id):
-        user_history = self.get_history(jenkins_id)
-        logger.debug('get_jobs_history: {} = {}'.format(jenkins_id, user_history))
-        if user_history:
-            return user_history['history']
-        else:
-            return []
 
+    def load(self):
+        users = list(self.storage.iter_users())
+        with self._lock:
+            self._by_id.clear()
+            self._by_skype_id.clear()
+            self._by_jenkins_id.clear()
+            for user_info in users:
+                self._index(user_info)
+        logger.debug('UsersDirectory.load: {} users'.format(len(users)))
+
+
+    def iter_users(self):
+        with self._lock:
+            users = list(self._by_skype_id.values())
+        for user_info in users:
+            yield dict(user_info)
+
+
+    def get_by_skype_id(self, skype_id):
+        return self._get(self._by_skype_id, 'skype_id', skype_id)
+
+
+    def get_by_jenkins_id(self, jenkins_id):
+        return self._get(self._by_jenkins_id, 'jenkins_id', jenkins_id)
+
+
+    def get_by_jenkins_ids(self, jenkins_ids):
+        '''
+        :return: dict mapping the given jenkins ids to their user info, looking up the missing ones at once
+        '''
+        users = {}
+        with self._lock:
+            for jenkins_id in jenkins_ids:
+                user_info = self._by_jenkins_id.get(jenkins_id)
+                if user_info is not None:
+                    users[jenkins_id] = dict(user_info)
+
+        missing_ids = [jenkins_id for jenkins_id in jenkins_ids if jenkins_id not in users]
+        if missing_ids:
+            for user_info in self.storage.find_users_by_jenkins_ids(missing_ids):
+                with self._lock:
+                    self._index(user_info)
+                users.setdefault(user_info['jenkins_id'], dict(user_info))
+        return users
+
+
+    def save(self, user_info):
+        '''
+        Inserts or updates the given user, in the storage and in the cache.
+        '''
+        user_info = dict(user_info)
+        user_info['_id'] = self.storage.save_user(user_info)
+
+        with self._lock:
+            self._index(user_info)
 
-    def add_job(self, jenkins_id, job_name):
-        user_history = self.get_history(jenkins_id)
-        if user_history:
-            history = user_history['history']
+
+    def start_watching(self):
+        '''
+        Starts a daemon thread applying the changes of the users storage to the cache.
+        Requires a storage which `can_watch` (for MongoDB, a replica set).
+        '''
+        watcher = threading.Thread(target=self._watch, name='users-watcher')
+        watcher.daemon = True
+        watcher.start()
+
+
+    def _watch(self):
+        while True:
             try:
-                entry_index = history.index(job_name)
-            except ValueError:
-                pass
-            else:
-                history.pop(entry_index)
+                with self.storage.watch_users() as changes:
+                    # changes missed while not watching
+                    self.load()
+                    for change in changes:
+                        self._apply_change(change)
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(watch_retry_period)
+
+
+    def _apply_change(self, change):
+        with self._lock:
+            if change['operationType'] == 'delete':
+                self._unindex(change['documentKey']['_id'])
+            elif change.get('fullDocument') is not None:
+                self._index(change['fullDocument'])
+                # registered by another instance
+                if self.unknown_jenkins_ids is not None:
+                    self.unknown_jenkins_ids.pop(change['fullDocument'].get('jenkins_id'))
+
+
+    def _get(self, index, key, value):
+        with self._lock:
+            user_info = index.get(value)
+        if user_info is None:
+            user_info = self.storage.find_user(key, value)
+            if user_info is not None:
+                with self._lock:
+                    self._index(user_info)
+
+        if user_info is not None:
+            return dict(user_info)
+
+
+    def _index(self, user_info):
+        _id = user_info.get('_id')
+        if _id is not None:
+            self._unindex(_id)
+            self._by_id[_id] = user_info
 
-            history.insert(0, job_name)
-            logger.debug('save history: {}'.format(user_history))
-            self.jobs_db.save(user_history)
+        previous_info = self._by_skype_id.get(user_info['skype_id'])
+        if previous_info is not None and self._by_jenkins_id.get(previous_info['jenkins_id']) is previous_info:
+            del self._by_jenkins_id[previous_info['jenkins_id']]
+
+        self._by_skype_id[user_info['skype_id']] = user_info
+        self._by_jenkins_id.setdefault(user_info['jenkins_id'], user_info)
+
+
+    def _unindex(self, _id):
+        user_info = self._by_id.pop(_id, None)
+        if user_info is None:
+            return
+
+        if self._by_skype_id.get(user_info['skype_id']) is user_info:
+            del self._by_skype_id[user_info['skype_id']]
+        if self._by_jenkins_id.get(user_info['jenkins_id']) is user_info:
+            del self._by_jenkins_id[user_info['jenkins_id']]
 
-        elif self.jobs_db:
-            self.jobs_db.insert_one({
-                'jenkins_id' : jenkins_id,
-                'history' : [job_name]
-            })
 
 
 #===================================================================================================
@@ -68,18 +191,64 @@ class UsersBot(object):
 
         self.jenkins_config = _config.get('jenkins', {'url' : ''})
 
-        self._users_data = {}
-
-        self._users_db = None
-        self._users_history = None
-        mongodb_config = _config.get('mongodb')
-        if mongodb_config:
-            self._setup_mongo_db(mongodb_config.get('url'))
+        # jenkins ids with no registered user, so that their job events don't query users over and over
+        users_cache_config = _config.get('users_cache', {})
+        self._unknown_jenkins_ids = ExpiringCache(
+            max_size=users_cache_config.get('max_unknown_users', max_unknown_users),
+            ttl=users_cache_config.get('unknown_users_ttl', unknown_users_ttl),
+        )
+
+        self.jenkins_db = None
+        self.storage = self._get_storage(_config.get('storage', {}))
+
+        self._sessions = self._get_sessions(_config.get('sessions', {}))
+
+        jobs_catalog_config = _config.get('jobs_catalog', {})
+        self.jobs_catalog = JobsCatalog(
+            self.jenkins_config,
+            refresh_interval=jobs_catalog_config.get('refresh_interval', jobs_catalog.refresh_interval),
+        )
+        if jobs_catalog_config.get('background_refresh', False):
+            self.jobs_catalog.start_refresher()
+
+        self.running_builds = self._get_running_builds(_config.get('running_builds', {}))
+        self._building_jobs_snapshot = BuildingJobsSnapshot(
+            lambda: jenkins_jobs.query_building_jobs(self.jenkins_config),
+            ttl=_config.get('status', {}).get('snapshot_ttl', running_builds.snapshot_ttl),
+        )
+
+        self._users_directory = UsersDirectory(self.storage, self._unknown_jenkins_ids)
+        self._users_directory.load()
+        if self.storage.can_watch and users_cache_config.get('watch', False):
+            self._users_directory.start_watching()
 
         self.register_handlers()
 
 
-    # JenkinsDB ------------------------------------------------------------------------------------
+    # Storage ------------------------------------------------------------------------------------
+    def _get_storage(self, storage_config):
+        '''
+        :return: the storage selected by the 'type' of the storage config: 'mongodb' (default when a
+            mongodb config is given) or 'sqlite'
+        '''
+        mongodb_config = self.config.get('mongodb')
+        storage_type = storage_config.get('type', 'mongodb' if mongodb_config else 'sqlite')
+        jobs_history_size = storage_config.get('history_size', storage.history_size)
+
+        if storage_type == 'mongodb':
+            mongo_storage = self._setup_mongo_db((mongodb_config or {}).get('url'), jobs_history_size)
+            if mongo_storage is not None:
+                return mongo_storage
+
+        elif storage_type != 'sqlite':
+            raise ValueError('Unknown storage type: {}'.format(storage_type))
+
+        sqlite_path = storage_config.get('path', storage.sqlite_path)
+        if storage_type == 'mongodb':
+            logger.warning('No MongoDB to connect to, users are stored in {}'.format(sqlite_path))
+        return SqliteStorage(sqlite_path, history_size=jobs_history_size)
+
+
     def _get_jenkins_db(self, mongodb_url):
         if mongodb_url is not None:
             from pymongo import MongoClient
@@ -88,73 +257,133 @@ class UsersBot(object):
             return client.jenkins
 
 
-    def _setup_mongo_db(self, mongodb_url):
+    def _setup_mongo_db(self, mongodb_url, history_size=storage.history_size):
         jenkins_db = self._get_jenkins_db(mongodb_url)
         logger.debug('_setup_mongo_db: {}'.format(jenkins_db))
         if jenkins_db is not None:
-            self._users_db = jenkins_db.skype_users
-            self._users_history = JobsHistory(jenkins_db.users_jobs)
+            self.jenkins_db = jenkins_db
+            mongo_storage = MongoStorage(jenkins_db, history_size=history_size)
 
+            if self.config.get('mongodb', {}).get('ensure_indexes', True):
+                mongo_storage.ensure_indexes()
+                mongo_storage.check_query_plans()
+            return mongo_storage
 
-    def _get_users_db(self):
-        return self._users_db
 
-    def _get_user_history(self, jenkins_id):
-        if self._users_history:
-            return self._users_history.get_jobs_history(jenkins_id)
-        else:
-            return []
+    def _get_user_history(self, jenkins_id, limit=None):
+        return self.storage.get_history(jenkins_id, limit)
 
 
     def _add_user_history(self, jenkins_id, job_name):
-        if self._users_history:
-            return self._users_history.add_job(jenkins_id, job_name)
+        self.storage.add_history([(jenkins_id, job_name)])
 
-    def _setup_users(self):
-        users_db = self._get_users_db()
-        if users_db:
-            for user_info in users_db.find():
-                self._known_contacts.append(user_info)
+    def _add_users_history(self, jobs):
+        if jobs:
+            self.storage.add_history(jobs)
 
     # Users Data -----------------------------------------------------------------------------------
-    def _add_user_data(self, skype_id, name, data):
-        try:
-            user_data = self._users_data[skype_id]
-        except:
-            user_data = self._users_data[skype_id] = {}
+    def _get_sessions(self, sessions_config):
+        ttl = sessions_config.get('ttl', sessions.session_ttl)
+        if sessions_config.get('shared', False) and self.jenkins_db is not None:
+            return MongoSessionStore(self.jenkins_db.user_sessions, ttl=ttl)
 
-        user_data[name] = data
+        return SessionStore(
+            ttl=ttl,
+            max_sessions=sessions_config.get('max_sessions', sessions.max_sessions),
+            max_bytes=sessions_config.get('max_bytes', sessions.max_bytes),
+        )
+
+    def _add_user_data(self, skype_id, name, jobs):
+        self._sessions.set_jobs(skype_id, name, jobs)
 
     def _get_user_data(self, skype_id, name):
-        try:
-            user_data = self._users_data[skype_id]
-        except:
+        return self._sessions.get_jobs(skype_id, name)
+
+
+    # Running Builds -------------------------------------------------------------------------------
+    def _get_running_builds(self, running_builds_config):
+        '''
+        :return: RunningBuilds fed by the job events, None if status should query Jenkins instead
+        '''
+        if not running_builds_config.get('enabled', False):
             return None
 
-        return user_data.get(name)
+        collection = None
+        if running_builds_config.get('persist', False) and self.jenkins_db is not None:
+            collection = self.jenkins_db.running_builds
+
+        builds = RunningBuilds(collection)
+        builds.start_reconciler(
+            lambda: jenkins_jobs.get_running_builds(self.jenkins_config),
+            interval=running_builds_config.get('reconcile_interval', running_builds.reconcile_interval),
+        )
+        return builds
+
+    def update_running_builds(self, build_info):
+        '''
+        Applies a job started/completed event to the running builds.
+
+        Builds are keyed by the full name of their job, as reported by Jenkins on reconciliation: it is
+        taken from the build url of the event when given, its job_name being the short name of the job.
+        '''
+        if self.running_builds is None or not build_info.get('job_name'):
+            return
+
+        job_name = jenkins_jobs.get_build_job_name(build_info.get('url') or '', self.jenkins_config)
+        if job_name is not None:
+            build_info = dict(build_info, job_name=job_name)
+
+        event = build_info.get('event')
+        if event == self.STARTED_EVENT:
+            self.running_builds.started(build_info)
+        elif event == self.COMPLETED_EVENT:
+            self.running_builds.completed(build_info)
 
 
     # Jenkins --------------------------------------------------------------------------------------
     def iter_users_info(self):
-        for user_info in self._users_db.find():
-            yield user_info
+        return self._users_directory.iter_users()
+
+    def is_unknown_jenkins_id(self, jenkins_id):
+        '''
+        :return: True if there is no registered user with the given jenkins id, as far as recently checked
+        '''
+        return not jenkins_id or self._unknown_jenkins_ids.get(jenkins_id, False)
 
     def get_jenkins_conversation_id(self, jenkins_id):
-        user_info = self._users_db.find_one({'jenkins_id' : jenkins_id})
+        if self.is_unknown_jenkins_id(jenkins_id):
+            return None
+
+        user_info = self._users_directory.get_by_jenkins_id(jenkins_id)
         if user_info:
             return user_info['conversation_id']
         else:
+            self._unknown_jenkins_ids.set(jenkins_id, True)
             return None
 
-        for user_info in self._known_contacts:
-            if user_info['jenkins_id'] == jenkins_id:
-                return user_info['conversation_id']
+    def get_jenkins_conversation_ids(self, jenkins_ids):
+        '''
+        :return: dict mapping registered jenkins ids to their conversation id
+        '''
+        jenkins_ids = [jenkins_id for jenkins_id in jenkins_ids if not self.is_unknown_jenkins_id(jenkins_id)]
+        if not jenkins_ids:
+            return {}
+
+        conversation_ids = dict(
+            (jenkins_id, user_info['conversation_id'])
+            for jenkins_id, user_info in self._users_directory.get_by_jenkins_ids(jenkins_ids).items()
+        )
+
+        for jenkins_id in jenkins_ids:
+            if jenkins_id not in conversation_ids:
+                self._unknown_jenkins_ids.set(jenkins_id, True)
+        return conversation_ids
 
     def get_contact_info(self, skype_id):
-        return self._users_db.find_one({'skype_id' : skype_id})
+        return self._users_directory.get_by_skype_id(skype_id)
 
     def get_contact_jenkins_id(self, skype_id):
-        user_info = self._users_db.find_one({'skype_id' : skype_id})
+        user_info = self._users_directory.get_by_skype_id(skype_id)
         if user_info:
             return user_info['jenkins_id']
         else:
@@ -168,7 +397,7 @@ class UsersBot(object):
 
     def get_contact_jenkins_config(self, skype_id):
         '''
-        Jenkins, URL, user and token
+        Jenkins, URL, user and token (along with the other settings of the jenkins config, e.g. timeouts)
         '''
         user_info = self.get_contact_info(skype_id)
         if user_info is None:
@@ -178,11 +407,12 @@ class UsersBot(object):
         if jenkins_token is None:
             return self.UNKNOWN_USER_TOKEN_MSG.format(self.jenkins_config['url'])
 
-        return {
-            'url' : self.jenkins_config['url'],
+        jenkins_config = dict(self.jenkins_config)
+        jenkins_config.update({
             'user' : user_info['jenkins_id'],
             'token' : user_info['jenkins_token'],
-        }
+        })
+        return jenkins_config
 
 
     def _register_jenkins_user(self, jenkins_id, conversation_id, skype_name, skype_id):
@@ -193,19 +423,15 @@ class UsersBot(object):
             'skype_name' : skype_name,
             'conversation_id' : conversation_id
         }
+        self._unknown_jenkins_ids.pop(jenkins_id)
         if contact_info is None:
             logger.debug('new_contact_info: {}'.format(new_contact_info))
-            users_db = self._get_users_db()
-            print('_register_jenkins_user', users_db)
-            if users_db is not None:
-                _id = users_db.insert(new_contact_info)
-                logger.debug('users_db.insert: {}'.format(_id))
+            self._users_directory.save(new_contact_info)
 
         else:
             contact_info.update(new_contact_info)
             logger.debug('updating contact_info: {}'.format(contact_info))
-            users_db = self._get_users_db()
-            users_db.save(contact_info)
+            self._users_directory.save(contact_info)
 
 
     def _register_jenkins_token(self, jenkins_token, conversation_id, skype_name, skype_id):
@@ -215,8 +441,7 @@ class UsersBot(object):
 
         else:
             contact_info['jenkins_token'] = jenkins_token
-            users_db = self._get_users_db()
-            users_db.save(contact_info)
+            self._users_directory.save(contact_info)
             return 'Token registered'
 
 
@@ -230,7 +455,7 @@ class UsersBot(object):
         start_millis = int(build_info['timestamp'])
         start_time = datetime.fromtimestamp(start_millis / 1000)
         message += '\nStarted: <b>{}</b>'.format(start_time)
-        message += '\nBuilding On: <b>{}</b>'.format(build_info['builtOn'])
+        message += '\nBuilding On: <b>{}</b>'.format(build_info.get('builtOn', ''))
 
         return message
 
@@ -243,24 +468,17 @@ class UsersBot(object):
         '''
         :param build_info:
         '''
-        from datetime import datetime
-
         jenkins_id = build_info['userId']
         conversation_id = self.get_jenkins_conversation_id(jenkins_id)
         if conversation_id is None:
             return None, None
 
-        job_name = build_info['job_name']
-        self._add_user_history(jenkins_id, job_name)
-
-        job_link = SkypeMessage.link(get_job_url(job_name, self.jenkins_config), job_name)
-
-        message = '(skate) <b>Started:</b> {}'.format(job_link)
-
-        start_millis = int(build_info['timestamp'])
-        start_time = datetime.fromtimestamp(start_millis / 1000)
-        message += '\nStarted: <b>{}</b>'.format(start_time)
-        message += '\nBuilt On: <b>{}</b>'.format(build_info['builtOn'])
+        message = self._format_started_message(build_info)
+        # the history is not worth losing the notification
+        try:
+            self._add_user_history(jenkins_id, build_info['job_name'])
+        except Exception as e:
+            logger.exception(e)
         return conversation_id, message
 
 
@@ -269,13 +487,110 @@ class UsersBot(object):
 
         :param build_info:
         '''
-        from datetime import datetime
-
         user_id = build_info['userId']
         conversation_id = self.get_jenkins_conversation_id(user_id)
         if conversation_id is None:
             return None, None
 
+        return conversation_id, self._format_completed_message(build_info)
+
+
+    STARTED_EVENT = 'jenkins.job.started'
+    COMPLETED_EVENT = 'jenkins.job.completed'
+
+    # parameters needed to notify each event
+    EVENT_FIELDS = {
+        STARTED_EVENT : ('job_name', 'number', 'timestamp', 'userId'),
+        COMPLETED_EVENT : ('job_name', 'number', 'timestamp', 'userId', 'result', 'duration'),
+    }
+    # parameters needed to apply an event to the running builds, which don't need its user (e.g. builds
+    # started by a timer)
+    RUNNING_BUILD_FIELDS = ('job_name', 'number')
+
+    def get_event_error(self, build_info, notified=True):
+        '''
+        :param build_info: job event, as passed to get_events_messages
+        :param notified: False to only check what is needed to apply the event to the running builds
+        :return: why the event can't be notified (or applied), None if it can
+        '''
+        if not isinstance(build_info, dict):
+            return 'not an object'
+
+        fields = self.EVENT_FIELDS.get(build_info.get('event'))
+        if fields is None:
+            return 'unknown event: {}'.format(build_info.get('event'))
+        if not notified:
+            fields = self.RUNNING_BUILD_FIELDS
+
+        missing_fields = [field for field in fields if build_info.get(field) in (None, '')]
+        if missing_fields:
+            return 'missing {}'.format(', '.join(missing_fields))
+
+        try:
+            int(build_info['number'])
+            if notified:
+                int(build_info['timestamp'])
+                float(build_info.get('duration', 0))
+        except (TypeError, ValueError):
+            return 'invalid number, timestamp or duration'
+        return None
+
+    def get_events_messages(self, events):
+        '''
+        Messages for a batch of started and completed events, looking up all users at once.
+        Events of unregistered users or with unknown event names are skipped.
+
+        :param events: list of build_info dicts, as passed to get_started_message/get_completed_message, with
+            their event name
+        :return: list of (conversation_id, message)
+        '''
+        conversation_ids = self.get_jenkins_conversation_ids(set(e.get('userId') for e in events))
+
+        messages = []
+        started_jobs = []
+        for build_info in events:
+            conversation_id = conversation_ids.get(build_info.get('userId'))
+            if conversation_id is None:
+                continue
+
+            # a malformed event doesn't prevent the others from being notified
+            event = build_info.get('event')
+            try:
+                if event == self.STARTED_EVENT:
+                    messages.append((conversation_id, self._format_started_message(build_info)))
+                    started_jobs.append((build_info['userId'], build_info['job_name']))
+                elif event == self.COMPLETED_EVENT:
+                    messages.append((conversation_id, self._format_completed_message(build_info)))
+                else:
+                    logger.warning('Unknown event: {}'.format(event))
+            except Exception as e:
+                logger.exception(e)
+
+        try:
+            self._add_users_history(started_jobs)
+        except Exception as e:
+            logger.exception(e)
+        return messages
+
+
+    def _format_started_message(self, build_info):
+        from datetime import datetime
+
+        job_name = build_info['job_name']
+        job_link = SkypeMessage.link(get_job_url(job_name, self.jenkins_config), job_name)
+
+        message = '(skate) <b>Started:</b> {}'.format(job_link)
+
+        start_millis = int(build_info['timestamp'])
+        start_time = datetime.fromtimestamp(start_millis / 1000)
+        message += '\nStarted: <b>{}</b>'.format(start_time)
+        message += '\nBuilt On: <b>{}</b>'.format(build_info.get('builtOn', ''))
+        return message
+
+
+    def _format_completed_message(self, build_info):
+        from datetime import datetime
+
         job_name = build_info['job_name']
         job_link = SkypeMessage.link(get_job_url(job_name, self.jenkins_config), job_name)
 
@@ -294,27 +609,60 @@ class UsersBot(object):
         start_time = datetime.fromtimestamp(start_millis / 1000)
         message += '\nStarted: <b>{}</b>'.format(start_time)
 
+        return message
+
+
+    def get_test_errors_messages(self, build_info):
+        '''
+        Follow up message of a failed build with its failed tests, which can take a while to collect.
+
+        :param build_info: same as for get_completed_message
+        :return: list with a single (conversation_id, message), or empty if not a failed build of a registered user
+        '''
         build_number = build_info.get('number')
-        if job_result == 'FAILURE' and build_number is not None:
-            test_errors = get_build_test_errors(job_name, int(build_number), self.jenkins_config)
-            message += '\n<b>Errors:</b>'
-            if len(test_errors) == 0:
-                message += ' Unable to collect'
-            else:
-                message += ' {}\n'.format(len(test_errors))
+        if build_info.get('result') != 'FAILURE' or build_number is None:
+            return []
+
+        conversation_id = self.get_jenkins_conversation_id(build_info.get('userId'))
+        if conversation_id is None:
+            return []
+
+        job_name = build_info['job_name']
+        test_errors = get_build_test_errors(
+            job_name,
+            int(build_number),
+            self.jenkins_config,
+            timeout=self.jenkins_config.get('test_report_timeout', jenkins_jobs.test_report_timeout),
+            max_size=self.jenkins_config.get('test_report_max_size', jenkins_jobs.test_report_max_size),
+        )
+
+        message = '(no) <b>Errors:</b> {}'.format(self.get_job_link_message(job_name))
+        if len(test_errors) == 0:
+            message += ' Unable to collect'
+        else:
+            message += ' {}\n'.format(len(test_errors))
 
-            i = 0;
-            for error in test_errors:
-                message += '   <b>{}</b>\n'.format(error['name'])
-                i += 1
-                if i >= 10:
-                    break
+        for error in test_errors[:10]:
+            message += '   <b>{}</b>\n'.format(error['name'])
 
-            if len(test_errors) > 10:
-                message += '<b>There is more</b>\n'
+        if len(test_errors) > 10:
+            message += '<b>There is more</b>\n'
 
+        return [(conversation_id, message)]
 
-        return conversation_id, message
+
+    def get_events_test_errors_messages(self, events):
+        '''
+        Follow up messages of the failed builds of a batch of events.
+
+        :param events: same as for get_events_messages
+        :return: list of (conversation_id, message)
+        '''
+        messages = []
+        for build_info in events:
+            if build_info.get('event') == self.COMPLETED_EVENT:
+                messages.extend(self.get_test_errors_messages(build_info))
+        return messages
 
 
     REGISTER_USER_MSG = "Thanks. You are registered as: '{}'"
@@ -406,12 +754,12 @@ class UsersBot(object):
         if jenkins_id is None:
             return 'No history, since you are not registered! ;)'
 
-        history = self._get_user_history(jenkins_id)
+        history_number = int(history_number) - 1
+        history = self._get_user_history(jenkins_id, limit=max(history_number + 1, 1))
         if history is None or len(history) == 0:
             return 'No history!'
 
-        history_number = int(history_number) - 1
-        if history_number < 0 or history_number > len(history):
+        if history_number < 0 or history_number >= len(history):
             return 'Invalid history number: {}'.format(history_number)
 
         jenkins_config = self.get_contact_jenkins_config(skype_id)
@@ -446,7 +794,7 @@ class UsersBot(object):
 
     def find(self, message_text, message_type, conversation_id, skype_name, skype_id):
         '''
-        Find jobs with a given pattern
+        Find jobs with a given pattern, part of their name or approximate name
            <b>usage</b>: find rocky30*5050*linux64
         '''
         self._add_user_data(skype_id, self.USER_JOBS_LIST, None)
@@ -455,24 +803,21 @@ class UsersBot(object):
         if pattern is None:
             return 'No pattern from message: {}'.format(message_text)
 
-        jobs_list = jenkins_jobs.list_jobs(self.jenkins_config)
-        if len(jobs_list) == 0:
+        jobs_index = self.jobs_catalog.get_index()
+        if len(jobs_index) == 0:
+            if not jenkins_jobs.is_jenkins_available(self.jenkins_config):
+                return self.JENKINS_UNAVAILABLE
             return 'No jobs found!'
 
-        filtered_list = []
-        for job_name in jobs_list:
-            if fnmatch.fnmatch(job_name, pattern):
-                filtered_list.append(job_name)
-
+        filtered_list = jobs_index.search(pattern)
         if len(filtered_list) == 0:
             return 'Found no jobs matching: {}'.format(pattern)
 
         message = '<b>Found jobs:</b>'
         for i, job_name in enumerate(filtered_list[:10]):
-            if fnmatch.fnmatch(job_name, pattern):
-                message += '\n{} - {}'.format(i+1, self.get_job_link_message(job_name))
+            message += '\n{} - {}'.format(i+1, self.get_job_link_message(job_name))
 
-        if len(filtered_list[:-10]) > 10:
+        if len(filtered_list) > 10:
             message += '<b>\n...</b>'
 
         self._add_user_data(skype_id, self.USER_JOBS_LIST, filtered_list)
@@ -508,6 +853,8 @@ class UsersBot(object):
 
     USER_RUNNING_JOBS = 'running_jobs'
 
+    JENKINS_UNAVAILABLE = 'Jenkins is not responding, please try again later'
+
     def status(self, message_text, message_type, conversation_id, skype_name, skype_id):
         '''
         Return current running jobs status started by you!
@@ -515,17 +862,27 @@ class UsersBot(object):
         '''
         self._add_user_data(skype_id, self.USER_RUNNING_JOBS, None)
 
-        building_jobs = get_building_jobs(self.jenkins_config)
-        if len(building_jobs) == 0:
-            return ' There is not jobs running!'
+        jenkins_id = self.get_contact_jenkins_id(skype_id)
+        if self.running_builds is not None:
+            building_jobs_count = len(self.running_builds)
+            building_jobs = self.running_builds.get_user_builds(jenkins_id)
+        else:
+            building_jobs_count, building_jobs = self._building_jobs_snapshot.get_user_builds(jenkins_id)
+            if building_jobs_count is None:
+                return self.JENKINS_UNAVAILABLE
 
-        msg = 'There are {} jobs running!'.format(len(building_jobs))
+        if building_jobs_count == 0:
+            msg = ' There is not jobs running!'
+        else:
+            msg = 'There are {} jobs running!'.format(building_jobs_count)
 
-        jenkins_id = self.get_contact_jenkins_id(skype_id)
-        user_jobs = []
-        for job_name, job_info in building_jobs.items():
-            if job_info.get('userId') == jenkins_id:
-                user_jobs.append(job_name)
+        if self.running_builds is None and self._building_jobs_snapshot.stale:
+            msg += '\n(Jenkins is not responding, this status may be out of date)'
+
+        if building_jobs_count == 0:
+            return msg
+
+        user_jobs = sorted(building_jobs)
 
         if len(user_jobs) == 0:
             msg += '\nYou have none jobs running!'